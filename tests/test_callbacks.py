@@ -0,0 +1,140 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for notification payload decoding and the columnar sample block"""
+import struct
+
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SAMPLE_DTYPE, CapData, SampleBlock, decode_packets
+from uci_cbp_demo.backend.bluetooth.constants import CAP1_CHAR_UUID, CLK_PERIOD
+
+# tick, cap, acc xyz, gyro xyz, mag xyz, covering both ends of every field
+PACKETS = [(0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+           (1, 1, 1, -1, 2, -2, 3, -3, 4, -4, 5),
+           (32768, 2 ** 23, 16384, -16384, 8192, 100, -100, 1000, 16, -16, 32),
+           (65535, 2 ** 24 - 1, 32767, -32768, 32767, -32768, 32767, -32768, 32767, -32768, 32767),
+           (12345, 4242424, -7, 11, -13, 17, -19, 23, -29, 31, -37)]
+
+
+def _expected(packet):
+    """Scale one unpacked packet by hand, field by field"""
+    tick, cap, *imu = packet
+    acc = [4 * v / 2 ** 15 for v in imu[0:3]]
+    gyro = [7.6e-3 * v / 2 ** 15 for v in imu[3:6]]
+    mag = [v / 16 for v in imu[6:9]]
+    return tick * CLK_PERIOD, 8 * cap / (2 ** 24 - 1), acc, gyro, mag
+
+
+def test_decode_packets():
+    payload = b"".join(struct.pack("HIhhhhhhhhh", *p) for p in PACKETS)
+    assert len(payload) == 26 * len(PACKETS)
+    columns = decode_packets(payload)
+    assert set(columns) == {"time", "cap", "acc", "gyro", "mag"}
+    for i, packet in enumerate(PACKETS):
+        time_stamp, cap, acc, gyro, mag = _expected(packet)
+        assert columns["time"][i] == pytest.approx(time_stamp, rel=1e-15)
+        assert columns["cap"][i] == pytest.approx(cap, rel=1e-15)
+        assert columns["acc"][i].tolist() == pytest.approx(acc, rel=1e-15)
+        assert columns["gyro"][i].tolist() == pytest.approx(gyro, rel=1e-15)
+        assert columns["mag"][i].tolist() == pytest.approx(mag, rel=1e-15)
+
+    columns = decode_packets(payload, no_imu=True)
+    assert set(columns) == {"time", "cap"}
+    assert len(decode_packets(b"")["time"]) == 0
+
+
+def test_decode_packets_rejects_partial_payload():
+    payload = b"".join(struct.pack("HIhhhhhhhhh", *p) for p in PACKETS)
+    with pytest.raises(ValueError):
+        decode_packets(payload[:-1])
+
+
+@pytest.mark.parametrize("packet", PACKETS)
+def test_cap_data_matches_decode_packets(packet):
+    payload = struct.pack("HIhhhhhhhhh", *packet)
+    sample = CapData.from_bytes(CAP1_CHAR_UUID, payload)
+    columns = decode_packets(payload)
+    time_stamp, cap, acc, gyro, mag = _expected(packet)
+    assert sample.channel == 1
+    assert sample.time == pytest.approx(time_stamp, rel=1e-15) and sample.time == columns["time"][0]
+    assert sample.cap == pytest.approx(cap, rel=1e-15) and sample.cap == pytest.approx(columns["cap"][0], rel=1e-15)
+    for name, expected in [("acc", acc), ("gyro", gyro), ("mag", mag)]:
+        axes = getattr(sample, name)
+        assert [axes.x, axes.y, axes.z] == pytest.approx(expected, rel=1e-15)
+        assert [axes.x, axes.y, axes.z] == pytest.approx(columns[name][0].tolist(), rel=1e-15)
+
+    sample = CapData.from_bytes("other", payload, no_imu=True)
+    assert sample.channel == 2 and sample.acc is None and sample.gyro is None and sample.mag is None
+    with pytest.raises(struct.error):
+        CapData.from_bytes(CAP1_CHAR_UUID, payload[:-1])
+
+
+def _assert_same(got, expected):
+    for name in SampleBlock.__slots__:
+        assert np.array_equal(getattr(got, name), getattr(expected, name), equal_nan=True), name
+        assert getattr(got, name).dtype == getattr(expected, name).dtype, name
+
+
+def _block(rng, n):
+    imu = rng.normal(0, 1, (n, 3))
+    imu[rng.random(n) < 0.5] = np.nan
+    return SampleBlock(np.cumsum(rng.uniform(0.005, 0.015, n)), rng.integers(1, 3, n), rng.uniform(0, 8, n),
+                       imu, 2 * imu, 3 * imu, rx_monotonic_ns=rng.integers(0, 2 ** 62, n),
+                       rx_time_ns=1_700_000_000_000_000_000 + rng.integers(0, 10 ** 9, n))
+
+
+def test_sample_block_from_bytes():
+    payload = b"".join(struct.pack("HIhhhhhhhhh", *p) for p in PACKETS)
+    columns = decode_packets(payload)
+    block = SampleBlock.from_bytes(CAP1_CHAR_UUID, payload, rx_monotonic_ns=5, rx_time_ns=7)
+    assert len(block) == len(PACKETS)
+    assert np.array_equal(block.time, columns["time"]) and np.array_equal(block.cap, columns["cap"])
+    for name in ["acc", "gyro", "mag"]:
+        assert np.array_equal(getattr(block, name), columns[name])
+    assert (block.channel == 1).all() and (block.rx_monotonic_ns == 5).all() and (block.rx_time_ns == 7).all()
+    assert block.has_imu.all()
+
+    block = SampleBlock.from_bytes("other", payload, no_imu=True)
+    assert (block.channel == 2).all() and not block.has_imu.any() and np.isnan(block.mag).all()
+    for i, packet in enumerate(PACKETS):
+        sample, expected = block[i], CapData.from_bytes("other", struct.pack("HIhhhhhhhhh", *packet), no_imu=True)
+        assert (sample.time, sample.channel, sample.acc) == (expected.time, expected.channel, None)
+        assert sample.cap == pytest.approx(expected.cap, rel=1e-15)
+
+
+def test_sample_block_records_round_trip():
+    block = _block(np.random.default_rng(0), 50)
+    records = block.to_records()
+    assert records.dtype == SAMPLE_DTYPE and len(records) == len(block)
+    _assert_same(SampleBlock.from_records(records), block)
+    # records survive being moved as raw bytes
+    _assert_same(SampleBlock.from_records(np.frombuffer(records.tobytes(), dtype=SAMPLE_DTYPE)), block)
+
+    out = np.zeros(len(block) + 10, dtype=SAMPLE_DTYPE)
+    block.to_records(out[3:3 + len(block)])
+    _assert_same(SampleBlock.from_records(out[3:3 + len(block)]), block)
+    assert len(SampleBlock.from_records(SampleBlock.empty().to_records())) == 0
+
+
+def test_sample_block_concatenate_and_select():
+    rng = np.random.default_rng(1)
+    blocks = [_block(rng, 7), SampleBlock.empty(), _block(rng, 1), _block(rng, 20)]
+    joined = SampleBlock.concatenate(blocks)
+    assert len(joined) == 28
+    for name in SampleBlock.__slots__:
+        assert np.array_equal(getattr(joined, name), np.concatenate([getattr(b, name) for b in blocks]),
+                              equal_nan=True)
+    assert SampleBlock.concatenate([blocks[1], blocks[2]]) is blocks[2]
+    assert len(SampleBlock.concatenate([])) == 0
+
+    keep = joined.channel == 2
+    selected = joined.select(keep)
+    _assert_same(selected, joined.select_channel(2))
+    _assert_same(selected, joined[keep])
+    _assert_same(joined.select(slice(7, 8)), blocks[2])
+    for name in SampleBlock.__slots__:
+        assert np.array_equal(getattr(selected, name), getattr(joined, name)[keep], equal_nan=True)
+    # selections are copies, not views into the source block
+    selected.cap[:] = -1
+    assert (joined.cap >= 0).all()
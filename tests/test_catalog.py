@@ -0,0 +1,102 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the SQLite session catalog"""
+import datetime
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SampleBlock
+from uci_cbp_demo.backend.catalog import SessionCatalog
+from uci_cbp_demo.backend.data_export import SessionSummary
+
+
+def test_summary_reaches_catalog(tmp_path):
+    summary = SessionSummary()
+    t = np.arange(100) * 0.011
+    summary.update(SampleBlock(t, 1, np.sin(t), rx_monotonic_ns=0, rx_time_ns=np.arange(100) * 11_000_000))
+    catalog = SessionCatalog(tmp_path)
+    catalog.session_opened(tmp_path / "a", mac="AA", channels=[1], started_ns=0)
+    catalog.session_closed(tmp_path / "a", summary.to_dict(), ended_ns=1)
+    row, = catalog.query()
+    expected = summary.to_dict()
+    for column in ["cap1_mean", "cap1_std", "cap1_rate", "cap1_jitter"]:
+        assert np.isclose(row[column], expected[column])
+    assert row["cap2_rate"] is None
+    catalog.close()
+
+
+def test_old_catalog_is_migrated(tmp_path):
+    db = sqlite3.connect(str(tmp_path / SessionCatalog.FILE))
+    db.execute("CREATE TABLE sessions (path TEXT PRIMARY KEY, prefix TEXT, started_ns INTEGER, ended_ns INTEGER, "
+               "duration REAL, mac TEXT, channels TEXT, dac1 INTEGER, dac2 INTEGER, samples INTEGER, "
+               "cap1_samples INTEGER, cap1_mean REAL, cap1_min REAL, cap1_max REAL, "
+               "cap2_samples INTEGER, cap2_mean REAL, cap2_min REAL, cap2_max REAL)")
+    db.execute("INSERT INTO sessions (path, started_ns) VALUES ('old', 5)")
+    db.commit()
+    db.close()
+    catalog = SessionCatalog(tmp_path)
+    catalog.session_closed("old", {"cap1_rate": 90.9, "cap1_jitter": 0.001}, ended_ns=10)
+    row, = catalog.query()
+    assert (row["path"], row["cap1_rate"], row["cap1_jitter"], row["cap2_std"]) == ("old", 90.9, 0.001, None)
+    catalog.close()
+    # opening an already migrated catalog again is a no-op
+    SessionCatalog(tmp_path).close()
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = SessionCatalog(tmp_path)
+    day = datetime.datetime(2026, 3, 1, 12, 0)
+    sessions = [("a", "AA:BB", [1], 0, 10.0), ("b", "aa:bb", [1, 2], 1, 20.0), ("c", "CC:DD", [2], 2, None),
+                ("d", "CC:DD", [1, 2], 3, 5.0)]
+    for name, mac, channels, days, duration in sessions:
+        started_ns = int((day + datetime.timedelta(days=days)).timestamp() * 1e9)
+        catalog.session_opened(tmp_path / name, prefix="bp" if name < "c" else "rest", mac=mac, channels=channels,
+                               dac1=days, dac2=0, started_ns=started_ns)
+        if duration is not None:
+            catalog.session_closed(tmp_path / name, {"duration": duration, "samples": 100},
+                                   ended_ns=started_ns + int(duration * 1e9))
+    yield catalog
+    catalog.close()
+
+
+def _names(rows):
+    return [Path(r["path"]).name for r in rows]
+
+
+def test_query_filters(catalog):
+    day = datetime.datetime(2026, 3, 1)
+    assert _names(catalog.query()) == ["d", "c", "b", "a"]
+    assert _names(catalog.query(mac="AA:BB")) == ["b", "a"]
+    assert _names(catalog.query(channel=1)) == ["d", "b", "a"]
+    assert _names(catalog.query(channel=2)) == ["d", "c", "b"]
+    assert _names(catalog.query(since=day + datetime.timedelta(days=1), until=day + datetime.timedelta(days=3))) \
+        == ["c", "b"]
+    assert _names(catalog.query(mac="cc:dd", channel=1)) == ["d"]
+    assert _names(catalog.query(min_duration=6, max_duration=15)) == ["a"]
+    assert _names(catalog.query(dac1=2)) == ["c"]
+    assert _names(catalog.query(prefix="rest", channel=2)) == ["d", "c"]
+    assert catalog.query(mac="EE:FF") == []
+
+
+def test_open_sessions_and_recovery(catalog, tmp_path):
+    assert catalog.open_sessions() == [str(tmp_path / "c")]
+    started_ns = catalog.query(dac1=2)[0]["started_ns"]
+    catalog.session_recovered(tmp_path / "c", ended_ns=started_ns + 3 * 10 ** 9)
+    assert catalog.open_sessions() == []
+    row, = catalog.query(dac1=2)
+    assert row["duration"] == 3.0
+
+
+def test_scan_registers_old_session_directories(tmp_path):
+    (tmp_path / "bp_03_01_2026_12_00_00").mkdir()
+    (tmp_path / "not_a_session").mkdir()
+    catalog = SessionCatalog(tmp_path)
+    assert catalog.scan() == 1 and catalog.scan() == 0
+    row, = catalog.query()
+    assert row["prefix"] == "bp" and row["ended_ns"] is not None
+    assert datetime.datetime.fromtimestamp(row["started_ns"] / 1e9) == datetime.datetime(2026, 3, 1, 12, 0, 0)
+    catalog.close()
@@ -0,0 +1,42 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the GUI to BLE process command channel"""
+import asyncio
+from multiprocessing import Pipe
+
+import pytest
+
+from uci_cbp_demo.backend.bluetooth.utils import CommandChannel
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_get_ack_round_trip(loop):
+    gui, ble = Pipe()
+    channel = CommandChannel(ble, loop)
+    gui.send(("DAC1", 12))
+    gui.send(("START", None))
+    assert loop.run_until_complete(asyncio.wait_for(channel.get(), 5)) == ("DAC1", 12)
+    channel.ack("DAC1")
+    assert loop.run_until_complete(asyncio.wait_for(channel.get(), 5)) == ("START", None)
+    channel.ack("START")
+    for expected in ["DAC1", "START"]:
+        assert gui.poll(5)
+        command, (acked, latency) = gui.recv()
+        assert (command, acked) == ("ACK", expected)
+        assert latency == channel.latency[expected] and latency >= 0
+    channel.close()
+
+
+def test_closed_pipe_stops(loop):
+    gui, ble = Pipe()
+    channel = CommandChannel(ble, loop)
+    gui.close()
+    assert loop.run_until_complete(asyncio.wait_for(channel.get(), 5)) == ("STOP", None)
+    # acknowledging into a closed pipe is not an error
+    channel.ack("STOP")
@@ -0,0 +1,105 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the recording writers"""
+import logging
+
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SampleBlock
+from uci_cbp_demo.backend.data_export import BackgroundWriter, FileExporterSession, RecordWriter
+from uci_cbp_demo.backend.processing import ProcessedBlock
+
+
+def _block(start, n, channel=1):
+    t = np.arange(start, start + n, dtype=np.float64)
+    return SampleBlock(t, channel, 10 * t, rx_monotonic_ns=np.arange(start, start + n), rx_time_ns=0)
+
+
+def _row(time, wall_clock, cells):
+    """One record.tsv line the way the per-row writer produced it: str() of each float, NaN left empty"""
+    return "\t".join([str(float(time)), wall_clock] + ["" if np.isnan(x) else str(float(x)) for x in cells])
+
+
+class _Session:
+    """Records what BackgroundWriter hands it; blocks starting at a negative time fail to write"""
+    FLUSH_INTERVAL = 0.1
+
+    def __init__(self):
+        self.written = []
+        self.flushes = 0
+        self.closed = False
+
+    def put(self, block):
+        if block.time[0] < 0:
+            raise ValueError("odd block")
+        self.written.append(block)
+
+    def tick(self):
+        pass
+
+    def flush(self):
+        self.flushes += 1
+
+    def close(self):
+        self.closed = True
+
+
+def test_background_writer_survives_failing_put(caplog):
+    session = _Session()
+    writer = BackgroundWriter(session)
+    with caplog.at_level(logging.ERROR, logger="bp_demo"):
+        writer.put(_block(0, 4))
+        writer.put(_block(-4, 4))
+        writer.put(_block(4, 4))
+        assert writer.flush(timeout=5)
+    assert [b.time[0] for b in session.written] == [0, 4]
+    assert session.flushes == 1
+    assert "Failed to write 4 samples" in caplog.text
+    assert writer.stats["written_batches"] == 3 and writer.stats["queued_bytes"] == 0
+    writer.close(timeout=5)
+    assert session.closed
+    # with the thread gone, commands return at once instead of waiting for it
+    assert writer.flush() is False
+
+
+def test_record_writer_schema(tmp_path):
+    n = 6
+    t = np.arange(n) * 0.011 + 1 / 3
+    channel = np.array([1, 2, 1, 2, 1, 2])
+    cap = np.array([1.5, 2.25, 1e-7, 123456.789, -0.0, 3.0])
+    imu = np.arange(n * 3, dtype=np.float64).reshape(n, 3) / 7
+    imu[3] = np.nan  # a packet without IMU data
+    rx_time_ns = 1_700_000_000_000_000_000 + np.arange(n) * 11_000_000
+    block = SampleBlock(t, channel, cap, imu, 2 * imu, 3 * imu, rx_monotonic_ns=np.arange(n), rx_time_ns=rx_time_ns)
+    writer = RecordWriter(tmp_path / "record.tsv", flush_rows=4, wall_clock_format="ns")
+    writer.put(block)
+    writer.put(block.select(np.arange(2)), imu=False)
+    writer.close()
+
+    lines = (tmp_path / "record.tsv").read_text().split("\n")
+    assert lines[0] == "time\twall_clock\tcap1\tcap2\taccx\taccy\taccz\tgyrox\tgyroy\tgyroz\tmagx\tmagy\tmagz"
+    assert lines[-1] == ""
+    expected = []
+    for i in list(range(n)) + [0, 1]:
+        suppressed = len(expected) >= n
+        caps = [cap[i] if channel[i] == 1 else np.nan, cap[i] if channel[i] == 2 else np.nan]
+        axes = np.full(9, np.nan) if suppressed else np.concatenate([imu[i], 2 * imu[i], 3 * imu[i]])
+        expected.append(_row(t[i], str(rx_time_ns[i]), caps + list(axes)))
+    assert lines[1:-1] == expected
+    assert all(len(line.split("\t")) == 13 for line in lines[1:-1])
+
+
+@pytest.mark.parametrize("export_processed", [False, True])
+def test_processed_export_is_optional(tmp_path, export_processed):
+    session = FileExporterSession(tmp_path, export_processed=export_processed)
+    session.put(_block(0, 4))
+    session.put(ProcessedBlock(np.arange(3) / 100, {"cap1_filtered": np.array([1.0, np.nan, 2.5])}))
+    session.tick()
+    session.flush()
+    session.close()
+    assert session.dataframe_output.is_file()
+    assert session.processed_output.is_file() == export_processed
+    if export_processed:
+        assert session.processed_output.read_text().split("\n") == ["time\tcap1_filtered", "0.0\t1.0", "0.01\t",
+                                                                   "0.02\t2.5", ""]
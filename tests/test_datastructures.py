@@ -0,0 +1,74 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the window extrema and min/max decimation of the display queues, checked against brute force"""
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.datastructures import CapDisplayDataQueue, MinMaxDecimator, MonotonicQueue
+
+
+@pytest.mark.parametrize("mode", ["min", "max"])
+@pytest.mark.parametrize("seed", range(5))
+def test_monotonic_queue_matches_brute_force(mode, seed):
+    rng = np.random.default_rng(seed)
+    reduce = np.min if mode == "min" else np.max
+    q = MonotonicQueue(capacity=4, mode=mode)
+    values = np.empty(0)
+    start = 0
+    for _ in range(300):
+        # small integers repeat often, which exercises ties
+        batch = rng.integers(0, 20, rng.integers(0, 12)).astype(np.float64)
+        q.extend(len(values), batch)
+        values = np.concatenate([values, batch])
+        start = max(start, len(values) - int(rng.integers(1, 40)))
+        q.evict(start)
+        if start < len(values):
+            assert q.value == reduce(values[start:])
+        else:
+            assert np.isnan(q.value)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_queue_extrema_match_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    window = 1.0
+    q = CapDisplayDataQueue(window_size=window, capacity=8)
+    t_all, v_all = np.empty(0), np.empty(0)
+    newest = 0.0
+    for _ in range(300):
+        n = int(rng.integers(1, 15))
+        if rng.random() < 0.2:
+            # out of order: a shuffled batch reaching back past the newest buffered sample
+            t = newest + rng.uniform(-0.5 * window, 0.1, n)
+        else:
+            t = newest + np.cumsum(rng.uniform(0, 0.02, n))
+        v = rng.normal(0, 1, n)
+        q.extend(t, v[:, np.newaxis])
+        t_all, v_all = np.concatenate([t_all, t]), np.concatenate([v_all, v])
+        newest = t_all.max()
+        in_window = t_all >= newest - window
+        assert len(q) == np.count_nonzero(in_window)
+        assert q.extrema("cap") == (v_all[in_window].min(), v_all[in_window].max())
+    assert q.merges > 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_decimator_matches_brute_force_as_window_slides(seed):
+    rng = np.random.default_rng(seed)
+    bucket = 0.05
+    q = CapDisplayDataQueue(window_size=1.0)
+    decimate = MinMaxDecimator(q, "cap", bucket=bucket)
+    t0 = 0.0
+    for _ in range(200):
+        # about 100 Hz with jitter, so the window start lands anywhere inside a bucket
+        t = t0 + np.cumsum(rng.uniform(0.005, 0.015, int(rng.integers(1, 10))))
+        t0 = t[-1]
+        q.extend(t, rng.normal(0, 1, len(t))[:, np.newaxis])
+        t_out, v_out = decimate()
+        k_out = np.floor(t_out / bucket)
+        k_all = np.floor(q.time / bucket)
+        assert np.array_equal(np.unique(k_out), np.unique(k_all))
+        for k in np.unique(k_all):
+            expected = q.cap[k_all == k]
+            assert np.count_nonzero(k_out == k) == 2
+            assert (v_out[k_out == k].min(), v_out[k_out == k].max()) == (expected.min(), expected.max())
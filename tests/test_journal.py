@@ -0,0 +1,88 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for crash repair of recording files"""
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.bluetooth.callbacks import PACKET_STRUCT
+from uci_cbp_demo.backend.journal import GroupCommit, recover_session, repair_fixed, repair_text
+from uci_cbp_demo.backend.raw_capture import CAPTURE_DTYPE, RawCaptureReader, RawCaptureWriter
+
+
+def _truncate(path, size):
+    with open(path, "rb+") as f:
+        f.truncate(size)
+
+
+@pytest.mark.parametrize("cut", [1, 7, 30])
+def test_repair_text_drops_partial_row(tmp_path, cut):
+    path = tmp_path / "record.tsv"
+    rows = ["time\tcap1"] + [f"{i * 0.011!r}\t{i * 1.5!r}" for i in range(1000)]
+    path.write_text("\n".join(rows) + "\n")
+    complete = path.read_bytes()
+    _truncate(path, len(complete) - cut)
+    removed = repair_text(path)
+    repaired = path.read_bytes()
+    assert repaired.endswith(b"\n") and complete.startswith(repaired)
+    assert repaired == complete[:complete.rindex(b"\n", 0, len(complete) - cut) + 1]
+    assert removed == len(complete) - cut - len(repaired)
+    assert repair_text(path) == 0
+
+
+def test_repair_text_longer_than_a_read_chunk(tmp_path):
+    # the last newline is more than one 64 KiB read back from the end
+    path = tmp_path / "record.tsv"
+    path.write_bytes(b"header\n" + b"x" * 200_000)
+    assert repair_text(path) == 200_000
+    assert path.read_bytes() == b"header\n"
+    path.write_bytes(b"no newline at all")
+    repair_text(path)
+    assert path.read_bytes() == b""
+    assert repair_text(tmp_path / "missing.tsv") == 0
+
+
+def test_repair_fixed_drops_partial_record(tmp_path):
+    path = tmp_path / "capture.bin"
+    path.write_bytes(bytes(range(256)) * 4)
+    _truncate(path, 10 * 43 + 17)
+    assert repair_fixed(path, 43) == 17
+    assert path.stat().st_size == 10 * 43
+    assert repair_fixed(path, 43) == 0
+    assert repair_fixed(tmp_path / "missing.bin", 43) == 0
+
+
+def test_recover_session(tmp_path):
+    (tmp_path / "record.tsv").write_text("time\tcap1\n0.0\t1.0\n0.011\t1.")
+    writer = RawCaptureWriter(tmp_path, index_every=4)
+    n = 10
+    payloads = b"".join(PACKET_STRUCT.pack(i, *[0] * 10) for i in range(n))
+    writer.write(np.ones(n), np.arange(n) + 1, np.arange(n) + 1, payloads)
+    writer.close()
+    _truncate(tmp_path / RawCaptureWriter.DATA_FILE, 7 * CAPTURE_DTYPE.itemsize + 5)
+    with open(tmp_path / RawCaptureWriter.INDEX_FILE, "ab") as f:
+        f.write(b"\x01\x02\x03")
+
+    assert recover_session(tmp_path) == len("0.011\t1.") + 5 + 3
+    assert (tmp_path / "record.tsv").read_text() == "time\tcap1\n0.0\t1.0\n"
+    reader = RawCaptureReader(tmp_path)
+    assert len(reader) == 7
+    assert np.array_equal(reader.read(start_ns=reader.clock_offset_ns + 3)["rx_monotonic_ns"], np.arange(3, 8))
+    # a recovered capture can be appended to again
+    writer = RawCaptureWriter(tmp_path, index_every=4)
+    writer.write(np.ones(1), [100], [100], PACKET_STRUCT.pack(7, *[0] * 10))
+    writer.close()
+    assert len(RawCaptureReader(tmp_path)) == 8
+
+
+def test_group_commit_interval(tmp_path):
+    commit = GroupCommit(interval=3600)
+    with open(tmp_path / "f", "wb") as f:
+        f.write(b"x")
+        commit.maybe_commit(f)
+        assert commit.syncs == 0
+        commit.commit(f)
+        assert commit.syncs == 1
+    commit = GroupCommit(interval=0)
+    with open(tmp_path / "f", "wb") as f:
+        commit.maybe_commit(f)
+        assert commit.syncs == 1
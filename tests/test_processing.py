@@ -0,0 +1,137 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the streaming filter and the channel aligner"""
+import numpy as np
+import pytest
+from scipy import signal
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SampleBlock
+from uci_cbp_demo.backend.bluetooth.constants import TARGET_FS, TARGET_TS
+from uci_cbp_demo.backend.processing import BeatDetector, ChannelAligner, ProcessedBlock, PulseTransitEstimator, \
+    StreamingSOSFilter
+
+
+def _chunks(n, rng, max_size=50):
+    """Split range(n) into consecutive slices of random size, empty and single-sample ones included"""
+    edges = np.unique(np.concatenate([[0, n], rng.integers(0, n, size=n // (max_size // 2))]))
+    edges = np.concatenate([edges[:3], edges[2:3], edges[3:]])  # one empty chunk
+    return [slice(a, b) for a, b in zip(edges[:-1], edges[1:])]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_chunked_filter_matches_one_shot(seed):
+    rng = np.random.default_rng(seed)
+    x = np.sin(2 * np.pi * 1.2 * np.arange(2000) / TARGET_FS) + rng.normal(0, 0.1, 2000) + 3
+    sos_filter = StreamingSOSFilter(columns=["cap1"])
+    chunked = np.concatenate([sos_filter.filter("cap1", x[part]) for part in _chunks(len(x), rng)])
+    expected, _ = signal.sosfilt(sos_filter.sos, x, zi=signal.sosfilt_zi(sos_filter.sos) * x[0])
+    assert np.allclose(chunked, expected)
+
+
+def test_chunked_filter_restarts_after_gap():
+    rng = np.random.default_rng(0)
+    x = rng.normal(5, 1, 600)
+    x[200:230] = np.nan
+    sos_filter = StreamingSOSFilter(columns=["cap1"])
+    chunked = np.concatenate([sos_filter.process(ProcessedBlock(np.arange(len(x[part])), {"cap1": x[part]}))
+                              ["cap1_filtered"] for part in _chunks(len(x), rng)])
+    zi = signal.sosfilt_zi(sos_filter.sos)
+    assert np.all(np.isnan(chunked[200:230]))
+    assert np.allclose(chunked[:200], signal.sosfilt(sos_filter.sos, x[:200], zi=zi * x[0])[0])
+    assert np.allclose(chunked[230:], signal.sosfilt(sos_filter.sos, x[230:], zi=zi * x[230])[0])
+
+
+def _two_channels(rng, n=1500):
+    """Interleaved cap1/cap2 notifications, each channel near FS with jitter and its own phase"""
+    blocks = []
+    for c, phase in [(1, 0.013), (2, 0.004)]:
+        t = phase + np.arange(n) * TARGET_TS + rng.uniform(-0.2, 0.2, n) * TARGET_TS
+        blocks.append((t, np.full(n, c), np.cos(t) + c))
+    t, channel, cap = [np.concatenate(columns) for columns in zip(*blocks)]
+    order = np.argsort(t, kind="stable")
+    return t[order], channel[order], cap[order]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_aligner_grid_across_chunks(seed):
+    rng = np.random.default_rng(seed)
+    t, channel, cap = _two_channels(rng)
+    aligner = ChannelAligner()
+    out = ProcessedBlock.concatenate([aligner.put(SampleBlock(t[part], channel[part], cap[part]))
+                                      for part in _chunks(len(t), rng)])
+    # one gapless, duplicate-free run of grid points k * TARGET_TS
+    k = np.round(out.time / TARGET_TS).astype(int)
+    assert np.array_equal(k, np.arange(k[0], k[0] + len(k)))
+    assert np.allclose(out.time, k * TARGET_TS)
+    assert k[0] == int(np.ceil(t[0] * TARGET_FS))
+    for c in (1, 2):
+        mine = channel == c
+        expected = np.interp(out.time, t[mine], cap[mine], left=np.nan, right=np.nan)
+        assert np.allclose(out[f"cap{c}"], expected, equal_nan=True)
+    # everything the one-shot aligner emits for the same data is emitted, with the same values
+    one_shot = ChannelAligner().put(SampleBlock(t, channel, cap))
+    assert np.allclose(out.time[:len(one_shot)], one_shot.time)
+    for c in (1, 2):
+        assert np.allclose(out[f"cap{c}"][:len(one_shot)], one_shot[f"cap{c}"], equal_nan=True)
+
+
+def _pulses(t, rate_bpm=72, width=0.08, delay=0.0):
+    """A pulse train with one Gaussian pulse per beat; amplitudes vary so no two beats look alike"""
+    period = 60 / rate_bpm
+    beats = np.arange(-1, t[-1] / period + 2) * period
+    amplitude = 1 + 0.2 * np.sin(np.arange(len(beats)))
+    return (amplitude * np.exp(-np.square((t[:, np.newaxis] - delay - beats) / width))).sum(axis=1)
+
+
+def _grid(seconds):
+    return np.arange(int(seconds * TARGET_FS)) * TARGET_TS
+
+
+def _chunked(stage, block, rng):
+    parts = [stage.process(ProcessedBlock(block.time[part], {k: v[part] for k, v in block.columns.items()}))
+             for part in _chunks(len(block), rng)]
+    return ProcessedBlock.concatenate(parts)
+
+
+def test_beat_detector_finds_known_rate():
+    t = _grid(30)
+    detector = BeatDetector(column="cap1")
+    out = detector.process(ProcessedBlock(t, {"cap1": _pulses(t)}))
+    ibi = out["beat_ibi"][~np.isnan(out["beat_ibi"])]
+    assert abs(len(ibi) - 30 * 72 / 60) <= 2
+    assert np.all(np.abs(ibi - 60 / 72) <= TARGET_TS)
+    assert abs(detector.pulse_rate - 72) < 1
+    assert abs(out["pulse_rate"][-1] - 72) < 1
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_chunked_beats_match_one_shot(seed):
+    rng = np.random.default_rng(seed)
+    t = _grid(20)
+    block = ProcessedBlock(t, {"cap1": _pulses(t, rate_bpm=65) + rng.normal(0, 0.01, len(t))})
+    one_shot = BeatDetector().process(ProcessedBlock(t, dict(block.columns)))
+    chunked = _chunked(BeatDetector(), block, rng)
+    assert np.array_equal(chunked["beat_ibi"], one_shot["beat_ibi"], equal_nan=True)
+    assert np.allclose(chunked["pulse_rate"], one_shot["pulse_rate"], equal_nan=True)
+
+
+@pytest.mark.parametrize("delay", [0.0, 0.05, 0.123, 0.2])
+def test_pulse_transit_recovers_known_delay(delay):
+    t = _grid(12)
+    estimator = PulseTransitEstimator()
+    out = _chunked(estimator, ProcessedBlock(t, {"cap1": _pulses(t), "cap2": _pulses(t, delay=delay)}),
+                   np.random.default_rng(0))
+    estimates = np.array([ptt for _, ptt in estimator.estimates])
+    assert len(estimates) > 10
+    assert np.all(np.abs(estimates - delay) < TARGET_TS)
+    assert np.all(np.isnan(out["ptt"][:estimator.window_rows - 1]))
+    assert abs(out["ptt"][-1] - delay) < TARGET_TS
+
+
+def test_pulse_transit_nan_without_second_channel():
+    t = _grid(8)
+    # cap2 disabled: the column is missing, or the aligner fills it with NaN
+    for columns in [{"cap1": _pulses(t)}, {"cap1": _pulses(t), "cap2": np.full(len(t), np.nan)}]:
+        estimator = PulseTransitEstimator()
+        out = estimator.process(ProcessedBlock(t, columns))
+        assert np.all(np.isnan(out["ptt"])) and np.isnan(estimator.ptt) and not estimator.estimates
@@ -0,0 +1,77 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the raw notification capture"""
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.bluetooth.callbacks import PACKET_STRUCT, decode_packets
+from uci_cbp_demo.backend.raw_capture import RawCaptureReader, RawCaptureWriter
+
+EPOCH_NS = 1_700_000_000_000_000_000
+
+
+def _packets(n, rng):
+    return b"".join(PACKET_STRUCT.pack(i % 65536, int(rng.integers(0, 2 ** 24)), *rng.integers(-2 ** 15, 2 ** 15, 9))
+                    for i in range(n))
+
+
+@pytest.fixture
+def capture(tmp_path):
+    """A capture of 1000 packets written in uneven batches over two writer sessions, indexed every 16 records"""
+    rng = np.random.default_rng(0)
+    n = 1000
+    payloads = _packets(n, rng)
+    channel = rng.integers(1, 3, n)
+    rx_monotonic_ns = 5_000_000 + np.cumsum(rng.integers(1, 20_000_000, n))
+    edges = [0, 1, 17, 300, 555, 556, 1000]
+    for session in [edges[:4], edges[3:]]:
+        writer = RawCaptureWriter(tmp_path, index_every=16)
+        for a, b in zip(session[:-1], session[1:]):
+            writer.write(channel[a:b], rx_monotonic_ns[a:b], EPOCH_NS + rx_monotonic_ns[a:b],
+                         payloads[a * PACKET_STRUCT.size:b * PACKET_STRUCT.size])
+        writer.close()
+    return tmp_path, payloads, channel, rx_monotonic_ns
+
+
+def test_round_trip(capture):
+    directory, payloads, channel, rx_monotonic_ns = capture
+    reader = RawCaptureReader(directory)
+    assert len(reader) == len(channel)
+    assert np.ascontiguousarray(reader.records["payload"]).tobytes() == payloads
+    assert np.array_equal(reader.records["channel"], channel)
+    assert np.array_equal(reader.records["rx_monotonic_ns"], rx_monotonic_ns)
+    assert np.array_equal(reader.records["rx_time_ns"], EPOCH_NS + rx_monotonic_ns)
+    assert np.array_equal(reader.index["record"], np.arange(0, len(channel), 16))
+
+    samples = reader.read_samples()
+    columns = decode_packets(payloads)
+    assert np.array_equal(samples.time, columns["time"]) and np.array_equal(samples.cap, columns["cap"])
+    assert np.array_equal(samples.acc, columns["acc"]) and np.array_equal(samples.mag, columns["mag"])
+    assert np.array_equal(samples.channel, channel)
+
+
+@pytest.mark.parametrize("start, stop", [(0, 1000), (16, 32), (17, 31), (15, 33), (3, 999), (500, 501), (640, 640),
+                                         (990, 1000), (0, 5)])
+def test_range_read(capture, start, stop):
+    directory, _, _, rx_monotonic_ns = capture
+    reader = RawCaptureReader(directory)
+    # bounds exactly on a record, and just past the previous one (between two records)
+    for offset in [0, -1]:
+        start_ns = EPOCH_NS + rx_monotonic_ns[start] + offset
+        stop_ns = None if stop == len(rx_monotonic_ns) else EPOCH_NS + rx_monotonic_ns[stop] + offset
+        records = reader.read(start_ns, stop_ns)
+        assert np.array_equal(records["rx_monotonic_ns"], rx_monotonic_ns[start:stop])
+
+
+def test_open_ended_and_empty_reads(capture):
+    directory, _, _, rx_monotonic_ns = capture
+    reader = RawCaptureReader(directory)
+    assert len(reader.read(stop_ns=EPOCH_NS + rx_monotonic_ns[40])) == 40
+    assert len(reader.read(start_ns=EPOCH_NS + rx_monotonic_ns[-1] + 1)) == 0
+    assert len(reader.read(stop_ns=EPOCH_NS)) == 0
+
+
+def test_empty_capture(tmp_path):
+    RawCaptureWriter(tmp_path).close()
+    reader = RawCaptureReader(tmp_path)
+    assert len(reader) == 0 and len(reader.read(EPOCH_NS, EPOCH_NS + 1)) == 0 and len(reader.read_samples()) == 0
@@ -0,0 +1,112 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the chunked columnar session store"""
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SampleBlock
+from uci_cbp_demo.backend.session_store import CODECS, ChunkedSessionReader, ChunkedSessionWriter
+
+
+def _blocks(rng, n_blocks=12):
+    blocks, t0 = [], 0.0
+    for _ in range(n_blocks):
+        n = int(rng.integers(1, 60))
+        t = t0 + np.cumsum(rng.uniform(0.005, 0.015, n))
+        t0 = t[-1]
+        imu = rng.normal(0, 1, (n, 3))
+        imu[rng.random(n) < 0.5] = np.nan
+        # the wall clock may step backwards, which the delta encoding must survive
+        blocks.append(SampleBlock(t, rng.integers(1, 3, n), rng.uniform(0, 8, n), imu, 2 * imu, 3 * imu,
+                                  rx_monotonic_ns=(t * 1e9).astype(np.int64),
+                                  rx_time_ns=1_700_000_000_000_000_000 + rng.integers(-10 ** 9, 10 ** 9, n)))
+    return blocks
+
+
+def _assert_equal(got, expected):
+    assert np.array_equal(got.time, expected.time)
+    assert np.array_equal(got.channel, expected.channel)
+    assert np.array_equal(got.cap, expected.cap.astype(np.float32))
+    for name in ["acc", "gyro", "mag"]:
+        assert np.array_equal(getattr(got, name), getattr(expected, name).astype(np.float32), equal_nan=True)
+    assert np.array_equal(got.rx_monotonic_ns, expected.rx_monotonic_ns)
+    assert np.array_equal(got.rx_time_ns, expected.rx_time_ns)
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_round_trip(tmp_path, codec):
+    blocks = _blocks(np.random.default_rng(0))
+    writer = ChunkedSessionWriter(tmp_path, chunk_rows=100, codec=codec)
+    for block in blocks:
+        writer.put(block)
+    writer.close()
+    reader = ChunkedSessionReader(tmp_path)
+    expected = SampleBlock.concatenate(blocks)
+    assert reader.manifest["codec"] == codec and len(reader.chunks) > 2
+    assert len(reader) == len(expected)
+    _assert_equal(reader.read_samples(), expected)
+
+
+@pytest.mark.parametrize("codec", list(CODECS))
+def test_time_range_reads(tmp_path, codec):
+    blocks = _blocks(np.random.default_rng(1))
+    writer = ChunkedSessionWriter(tmp_path, chunk_rows=50, codec=codec)
+    for block in blocks:
+        writer.put(block)
+    writer.close()
+    reader = ChunkedSessionReader(tmp_path)
+    expected = SampleBlock.concatenate(blocks)
+    for start, stop in [(None, None), (1.0, 2.5), (expected.time[10], expected.time[200]), (None, 0.5), (3.0, None),
+                        (100.0, 200.0)]:
+        keep = np.ones(len(expected), dtype=bool)
+        if start is not None:
+            keep &= expected.time >= start
+        if stop is not None:
+            keep &= expected.time < stop
+        _assert_equal(reader.read_samples(start, stop), expected.select(keep))
+        assert np.array_equal(reader.read(["cap"], start, stop)["cap"], expected.cap[keep].astype(np.float32))
+
+
+def test_reopen_appends_with_the_stored_codec(tmp_path):
+    first, second = _blocks(np.random.default_rng(2), 3), _blocks(np.random.default_rng(3), 3)
+    writer = ChunkedSessionWriter(tmp_path, codec="lzma")
+    for block in first:
+        writer.put(block)
+    writer.close()
+    writer = ChunkedSessionWriter(tmp_path, codec="zlib")
+    assert writer.codec == "lzma"
+    for block in second:
+        writer.put(block)
+    writer.close()
+    _assert_equal(ChunkedSessionReader(tmp_path).read_samples(), SampleBlock.concatenate(first + second))
+
+
+def test_interrupted_chunk_is_ignored_and_repaired(tmp_path, monkeypatch):
+    blocks = _blocks(np.random.default_rng(4), 4)
+    writer = ChunkedSessionWriter(tmp_path)
+    writer.put(blocks[0])
+    writer.flush()
+    manifest = (tmp_path / ChunkedSessionWriter.MANIFEST).read_text()
+
+    # crash after the chunk files of the next flush are written but before the manifest is replaced
+    def crash():
+        (tmp_path / (ChunkedSessionWriter.MANIFEST + ".tmp")).write_text("{partial")
+        raise OSError("power cut")
+
+    monkeypatch.setattr(writer, "_write_manifest", crash)
+    writer.put(blocks[1])
+    with pytest.raises(OSError):
+        writer.flush()
+    assert (tmp_path / "cap.000001").is_file()
+    assert (tmp_path / ChunkedSessionWriter.MANIFEST).read_text() == manifest
+    _assert_equal(ChunkedSessionReader(tmp_path).read_samples(), blocks[0])
+
+    assert ChunkedSessionWriter.repair(tmp_path) > 0
+    assert not (tmp_path / "cap.000001").exists()
+    assert not (tmp_path / (ChunkedSessionWriter.MANIFEST + ".tmp")).exists()
+    _assert_equal(ChunkedSessionReader(tmp_path).read_samples(), blocks[0])
+
+
+def test_unknown_codec(tmp_path):
+    with pytest.raises(ValueError):
+        ChunkedSessionWriter(tmp_path, codec="snappy")
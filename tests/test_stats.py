@@ -0,0 +1,82 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the incremental statistics, fed in chunks and checked against numpy over the whole stream"""
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.stats import EWMA, RateMeter, RunningStats
+
+
+def _chunks(values, rng):
+    """values split at random points, with empty, single-value and larger-than-SMALL_BATCH chunks"""
+    edges = np.sort(rng.integers(0, len(values), 12))
+    parts = np.split(values, edges)
+    return parts + [values[:0], values[-1:]]
+
+
+def _ewma(values, alpha):
+    mean, variance = values[0], 0.0
+    for x in values:
+        d = x - mean
+        mean += alpha * d
+        variance = (1 - alpha) * (variance + alpha * d * d)
+    return mean, variance
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_running_stats_matches_numpy(seed):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(3, 2, 500)
+    parts = _chunks(values, rng)
+    stats = RunningStats()
+    for part in parts:
+        stats.update(part)
+    stream = np.concatenate(parts)
+    assert stats.count == len(stream)
+    assert np.isclose(stats.mean, stream.mean())
+    assert np.isclose(stats.variance, stream.var(ddof=1))
+    assert (stats.min, stats.max) == (stream.min(), stream.max())
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_ewma_chunked_matches_recurrence(seed):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(0.011, 0.001, 400)
+    parts = _chunks(values, rng)
+    ewma = EWMA(span=50)
+    for part in parts:
+        ewma.update(part)
+    stream = np.concatenate(parts)
+    mean, variance = _ewma(stream, ewma.alpha)
+    assert ewma.count == len(stream)
+    assert np.isclose(ewma.mean, mean) and np.isclose(ewma.variance, variance)
+
+
+def test_ewma_scalar_path_matches_lfilter_path():
+    values = np.random.default_rng(0).normal(5, 1, 3 * EWMA.SMALL_BATCH)
+    batched, scalar = EWMA(span=20), EWMA(span=20)
+    batched.update(values)  # one lfilter batch
+    for x in values:
+        scalar.update((x,))
+    assert np.isclose(batched.mean, scalar.mean) and np.isclose(batched.variance, scalar.variance)
+
+
+def test_rate_meter_matches_numpy():
+    rng = np.random.default_rng(0)
+    times = np.cumsum(rng.uniform(0.009, 0.013, 2000))
+    # a repeated and a late timestamp: neither is an interval, and the next step is taken from the newest time
+    times = np.concatenate([times[:100], times[99:100], times[100:1000], times[990:991], times[1000:]])
+    parts = _chunks(times, rng)
+    meter = RateMeter(span=100)
+    for part in parts:
+        meter.update(part)
+    steps, newest = [], times[0]
+    for t in np.concatenate(parts)[1:]:
+        if t > newest:
+            steps.append(t - newest)
+            newest = t
+    steps = np.array(steps)
+    mean, variance = _ewma(steps, meter.interval.alpha)
+    assert meter.intervals.count == len(steps)
+    assert np.isclose(meter.intervals.mean, steps.mean())
+    assert np.isclose(meter.rate, 1 / mean) and np.isclose(meter.jitter, np.sqrt(variance))
@@ -0,0 +1,91 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""Tests for the queue and shared-memory ring transports"""
+import logging
+import platform
+import queue
+
+import numpy as np
+import pytest
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SampleBlock
+from uci_cbp_demo.backend.transport import QueueTransport, SharedMemoryRing, default_transport, shared_memory
+
+
+def _block(start, n, channel=1):
+    t = np.arange(start, start + n, dtype=np.float64)
+    return SampleBlock(t, channel, 10 * t, rx_monotonic_ns=np.arange(start, start + n), rx_time_ns=0)
+
+
+@pytest.fixture
+def ring():
+    if shared_memory is None:
+        pytest.skip("requires multiprocessing.shared_memory")
+    ring = SharedMemoryRing(capacity=8)
+    yield ring
+    ring.close()
+
+
+def test_wrap_around(ring):
+    ring.put(_block(0, 6))
+    assert np.array_equal(ring.drain(max_items=4)[0].time, np.arange(4))
+    ring.put(_block(6, 6))  # records 8..11 wrap to the start of the buffer
+    assert len(ring) == 8
+    block, lag = ring.drain()
+    assert np.array_equal(block.time, np.arange(4, 12))
+    assert np.array_equal(block.cap, 10 * np.arange(4, 12))
+    assert (lag.depth, lag.remaining) == (8, 0)
+    assert len(ring) == 0 and ring.dropped == 0
+
+
+def test_partial_drain_lag(ring):
+    ring.put(_block(0, 5))
+    block, lag = ring.drain(max_items=2)
+    assert len(block) == 2
+    assert (lag.depth, lag.remaining) == (5, 3)
+    block, lag = ring.drain()
+    assert np.array_equal(block.time, np.arange(2, 5))
+    assert (lag.depth, lag.remaining) == (3, 0)
+    block, lag = ring.drain()
+    assert len(block) == 0 and lag.depth == 0
+
+
+def test_full_ring_truncates_and_logs(ring, caplog):
+    caplog.set_level(logging.WARNING, logger="bp_demo")
+    ring.put(_block(0, 6))
+    ring.put(_block(6, 5))  # only 2 of these fit
+    ring.put(_block(11, 3))  # nothing fits
+    assert ring.dropped == 6
+    assert len(ring) == 8
+    assert np.array_equal(ring.drain()[0].time, np.arange(8))
+    warnings = [r for r in caplog.records if "ring full" in r.getMessage()]
+    assert len(warnings) == 1  # the first truncation only, until the LOG_EVERY-th
+    ring.put(_block(20, 3))
+    assert np.array_equal(ring.drain()[0].time, np.arange(20, 23))
+
+
+def test_queue_transport_lag_in_samples():
+    transport = QueueTransport({"cap1": queue.Queue(), "cap2": queue.Queue()})
+    transport.put(_block(0, 3, channel=1))
+    transport.put(_block(3, 2, channel=2))
+    transport.put(_block(5, 4, channel=1))
+    # whole blocks are drained, one per channel per round, until max_items samples are reached
+    block, lag = transport.drain(max_items=3)
+    assert sorted(block.time) == [0, 1, 2, 3, 4]
+    assert (lag.depth, lag.remaining) == (9, 4)
+    block, lag = transport.drain()
+    assert np.array_equal(block.time, np.arange(5, 9)) and np.all(block.channel == 1)
+    assert (lag.depth, lag.remaining) == (4, 0)
+    block, lag = transport.drain()
+    assert len(block) == 0 and (lag.depth, lag.remaining, lag.oldest_age) == (0, 0, 0.0)
+
+
+@pytest.mark.parametrize("machine, ring_expected", [("x86_64", True), ("AMD64", True), ("aarch64", False),
+                                                    ("armv7l", False)])
+def test_default_transport_needs_tso(monkeypatch, machine, ring_expected):
+    monkeypatch.setattr(platform, "machine", lambda: machine)
+    transport = default_transport({"cap1": queue.Queue(), "cap2": queue.Queue()})
+    try:
+        assert isinstance(transport, SharedMemoryRing) == (ring_expected and shared_memory is not None)
+    finally:
+        transport.close()
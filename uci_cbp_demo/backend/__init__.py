@@ -3,3 +3,5 @@
 
 from .data_export import FileExporter, FileExporterConf
 from .sensor_board import SensorBoard
+from .processing import BeatDetector, ChannelAligner, ProcessedBlock, ProcessingPipeline, \
+    PulseTransitEstimator, StreamingSOSFilter
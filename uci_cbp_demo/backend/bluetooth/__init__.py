@@ -1,6 +1,6 @@
 #  MIT License
 #  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
 
-from .callbacks import CapData
+from .callbacks import CapData, SampleBlock, SAMPLE_DTYPE, decode_packets
 from .list_characteristics import list_char
 from .scan import scan, check_adaptor
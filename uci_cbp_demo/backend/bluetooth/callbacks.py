@@ -1,23 +1,70 @@
 # MIT License
 # Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
 
+import asyncio
 import datetime
 import logging
 import multiprocessing
 import select
 import struct
 import sys
+import time
+from typing import List
 
 import numpy as np
 
 from uci_cbp_demo.backend.bluetooth.constants import CAP1_CHAR_UUID
 from uci_cbp_demo.backend.bluetooth.constants import CLK_PERIOD
-from uci_cbp_demo.backend.datastructures import IterableQueue
 
 logger = logging.getLogger("bp_demo")
 
+# Notification payload as laid out by the firmware (native alignment of "HIhhhhhhhhh", 2 padding bytes after the tick)
+PACKET_DTYPE = np.dtype({"names": ["tick", "cap", "acc", "gyro", "mag"],
+                         "formats": ["<u2", "<u4", ("<i2", 3), ("<i2", 3), ("<i2", 3)],
+                         "offsets": [0, 4, 8, 14, 20],
+                         "itemsize": 26})
+# The same layout for a single payload, where struct beats building a numpy view
+PACKET_STRUCT = struct.Struct("HIhhhhhhhhh")
+# Fixed-size decoded sample record, used wherever blocks are moved or stored as raw bytes
+SAMPLE_DTYPE = np.dtype([("time", "<f8"), ("rx_monotonic_ns", "<i8"), ("rx_time_ns", "<i8"), ("cap", "<f8"),
+                         ("acc", "<f8", (3,)), ("gyro", "<f8", (3,)), ("mag", "<f8", (3,)), ("channel", "i1")],
+                        align=True)
+ACC_FULL_SCALE = 4
+GYRO_FULL_SCALE = 7.6e-3
+MAG_FULL_SCALE = 1 / 16
+
+
+def decode_packets(bytes_array, no_imu=False):
+    """Decode N concatenated notification payloads into columnar arrays in a single pass"""
+    if len(bytes_array) % PACKET_DTYPE.itemsize:
+        logger.error(f"Length of bytes_array is {len(bytes_array)}")
+        raise ValueError(f"buffer length {len(bytes_array)} is not a multiple of {PACKET_DTYPE.itemsize}")
+    packets = np.frombuffer(bytes_array, dtype=PACKET_DTYPE)
+    columns = {"time": packets["tick"] * CLK_PERIOD,
+               "cap": packets["cap"] * (8 / (2 ** 24 - 1))}
+    if not no_imu:
+        columns["acc"] = packets["acc"] * (ACC_FULL_SCALE / 2.0 ** 15)
+        columns["gyro"] = packets["gyro"] * (GYRO_FULL_SCALE / 2.0 ** 15)
+        columns["mag"] = packets["mag"] * MAG_FULL_SCALE
+    return columns
+
+
+def format_wall_clock(rx_time_ns, fmt="iso"):
+    """Format epoch-nanosecond receive stamps in bulk as local ISO strings ("iso") or integers ("ns")"""
+    rx_time_ns = np.asarray(rx_time_ns, dtype=np.int64)
+    if fmt == "ns":
+        return rx_time_ns.astype(str)
+    if fmt != "iso":
+        raise ValueError(f"unknown wall clock format {fmt}")
+    if len(rx_time_ns) == 0:
+        return np.empty(0, dtype=str)
+    utc_offset = datetime.datetime.fromtimestamp(rx_time_ns[0] / 1e9).astimezone().utcoffset()
+    local_ns = rx_time_ns + int(utc_offset.total_seconds() * 1e9)
+    return np.datetime_as_string(local_ns.astype("datetime64[ns]"), unit="us")
+
 
 class IMUData:
+    __slots__ = ("time", "x", "y", "z")
 
     def __init__(self, time, x, y, z):
         self.time = time
@@ -27,47 +74,45 @@ class IMUData:
 
 
 class CapData:
-    time = None
-    cap = None
-    channel = None
-    acc_full_scale = 4
-    gyro_full_scale = 7.6e-3
-    mag_full_scale = 1 / 16
-
-    def __init__(self, time, cap, channel, acc: "IMUData", gyro: "IMUData", mag: "IMUData"):
-        self.time = time
+    __slots__ = ("time", "cap", "channel", "acc", "gyro", "mag", "rx_time_ns")
+    acc_full_scale = ACC_FULL_SCALE
+    gyro_full_scale = GYRO_FULL_SCALE
+    mag_full_scale = MAG_FULL_SCALE
+
+    def __init__(self, time_stamp, cap, channel, acc: "IMUData", gyro: "IMUData", mag: "IMUData", rx_time_ns=None):
+        self.time = time_stamp
         self.cap = cap
         self.channel = channel
         self.acc = acc
         self.gyro = gyro
         self.mag = mag
-        self.wall_clock = datetime.datetime.now().isoformat()
+        self.rx_time_ns = time.time_ns() if rx_time_ns is None else rx_time_ns
+
+    @property
+    def wall_clock(self):
+        return datetime.datetime.fromtimestamp(self.rx_time_ns / 1e9).isoformat()
 
     @classmethod
     def from_bytes(cls, sender, bytes_array, no_imu=False):
         try:
-            unpacked = struct.unpack("HIhhhhhhhhh", bytes_array)
+            unpacked = PACKET_STRUCT.unpack(bytes_array)
         except struct.error as e:
             logger.error(f"Length of bytes_array is {len(bytes_array)}")
             raise e
         time_stamp = unpacked[0] * CLK_PERIOD
-        cap_readings = 8 * np.array(unpacked[1]) / (2 ** 24 - 1)
+        cap = 8 * unpacked[1] / (2 ** 24 - 1)
         if not no_imu:
-            acc = IMUData(time_stamp, cls.acc_full_scale * unpacked[2] / (2.0 ** 15),
-                          cls.acc_full_scale * unpacked[3] / (2.0 ** 15),
-                          cls.acc_full_scale * unpacked[4] / (2.0 ** 15))
-
-            gyro = IMUData(time_stamp, cls.gyro_full_scale * unpacked[5] / (2.0 ** 15),
-                           cls.gyro_full_scale * unpacked[6] / (2.0 ** 15),
-                           cls.gyro_full_scale * unpacked[7] / (2.0 ** 15))
-            mag = IMUData(time_stamp, cls.mag_full_scale * unpacked[8],
-                          cls.mag_full_scale * unpacked[9],
-                          cls.mag_full_scale * unpacked[10])
-            logger.debug(f"mag: {mag.x:.2f} {mag.y:.2f} {mag.z:.2f}")
+            acc = IMUData(time_stamp, *[cls.acc_full_scale * v / (2.0 ** 15) for v in unpacked[2:5]])
+            gyro = IMUData(time_stamp, *[cls.gyro_full_scale * v / (2.0 ** 15) for v in unpacked[5:8]])
+            mag = IMUData(time_stamp, *[cls.mag_full_scale * v for v in unpacked[8:11]])
         else:
-            acc, mag, gyro = None, None, None
+            acc, gyro, mag = None, None, None
         channel = 1 if sender == CAP1_CHAR_UUID else 2
-        return cls(time_stamp, cap_readings, channel, acc, gyro, mag)
+        return cls(time_stamp, cap, channel, acc, gyro, mag)
+
+    @classmethod
+    def from_batch(cls, sender, bytes_array, no_imu=False):
+        return list(SampleBlock.from_bytes(sender, bytes_array, no_imu=no_imu))
 
     def __repr__(self):
         return f"CH{self.channel} {self.cap:.3f} pF @ {1000 * self.time:.2f} ms"
@@ -86,58 +131,221 @@ class CapData:
         return return_dict
 
 
+class SampleBlock:
+    """Contiguous columns for a batch of samples; IMU columns are NaN where IMU output is absent
+
+    rx_monotonic_ns/rx_time_ns hold the time.monotonic_ns()/time.time_ns() pair taken when the batch was received.
+    """
+    __slots__ = ("time", "channel", "cap", "acc", "gyro", "mag", "rx_monotonic_ns", "rx_time_ns")
+
+    def __init__(self, time_stamp, channel, cap, acc=None, gyro=None, mag=None, rx_monotonic_ns=None,
+                 rx_time_ns=None):
+        self.time = np.asarray(time_stamp, dtype=np.float64)
+        n = len(self.time)
+        self.channel = np.broadcast_to(np.asarray(channel, dtype=np.int8), (n,)).copy()
+        self.cap = np.asarray(cap, dtype=np.float64)
+        self.acc = self._imu_column(acc, n)
+        self.gyro = self._imu_column(gyro, n)
+        self.mag = self._imu_column(mag, n)
+        if rx_monotonic_ns is None or rx_time_ns is None:
+            rx_monotonic_ns, rx_time_ns = time.monotonic_ns(), time.time_ns()
+        self.rx_monotonic_ns = np.broadcast_to(np.asarray(rx_monotonic_ns, dtype=np.int64), (n,)).copy()
+        self.rx_time_ns = np.broadcast_to(np.asarray(rx_time_ns, dtype=np.int64), (n,)).copy()
+
+    @staticmethod
+    def _imu_column(value, n):
+        if value is None:
+            return np.full((n, 3), np.nan)
+        return np.asarray(value, dtype=np.float64).reshape(n, 3)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0), np.empty(0), np.empty(0))
+
+    @classmethod
+    def from_bytes(cls, sender, bytes_array, no_imu=False, rx_monotonic_ns=None, rx_time_ns=None):
+        columns = decode_packets(bytes_array, no_imu=no_imu)
+        channel = 1 if sender == CAP1_CHAR_UUID else 2
+        return cls(columns["time"], channel, columns["cap"],
+                   columns.get("acc"), columns.get("gyro"), columns.get("mag"), rx_monotonic_ns, rx_time_ns)
+
+    @classmethod
+    def from_samples(cls, samples: "List[CapData]"):
+        def _imu(d):
+            return (np.nan,) * 3 if d is None else (d.x, d.y, d.z)
+
+        rx_time_ns = np.array([d.rx_time_ns for d in samples], dtype=np.int64)
+        rx_monotonic_ns = time.monotonic_ns() - (time.time_ns() - rx_time_ns)
+        return cls([d.time for d in samples], [d.channel for d in samples], [d.cap for d in samples],
+                   [_imu(d.acc) for d in samples], [_imu(d.gyro) for d in samples],
+                   [_imu(d.mag) for d in samples], rx_monotonic_ns, rx_time_ns)
+
+    @classmethod
+    def from_records(cls, records):
+        return cls(records["time"], records["channel"], records["cap"], records["acc"], records["gyro"],
+                   records["mag"], records["rx_monotonic_ns"], records["rx_time_ns"])
+
+    def to_records(self, out=None):
+        if out is None:
+            out = np.empty(len(self), dtype=SAMPLE_DTYPE)
+        for c in self.__slots__:
+            out[c] = getattr(self, c)
+        return out
+
+    @classmethod
+    def concatenate(cls, blocks: "List[SampleBlock]"):
+        blocks = [b for b in blocks if len(b)]
+        if len(blocks) == 0:
+            return cls.empty()
+        if len(blocks) == 1:
+            return blocks[0]
+        return cls(*[np.concatenate([getattr(b, c) for b in blocks]) for c in cls.__slots__])
+
+    @property
+    def has_imu(self):
+        return ~np.isnan(self.acc[:, 0])
+
+    def wall_clock(self, fmt="iso"):
+        return format_wall_clock(self.rx_time_ns, fmt)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, c).nbytes for c in self.__slots__)
+
+    def select(self, index):
+        return SampleBlock(*[getattr(self, c)[index] for c in self.__slots__])
+
+    def select_channel(self, channel):
+        return self.select(self.channel == channel)
+
+    def row(self, i):
+        time_stamp = float(self.time[i])
+        if np.isnan(self.acc[i, 0]):
+            acc, gyro, mag = None, None, None
+        else:
+            acc = IMUData(time_stamp, *self.acc[i].tolist())
+            gyro = IMUData(time_stamp, *self.gyro[i].tolist())
+            mag = IMUData(time_stamp, *self.mag[i].tolist())
+        return CapData(time_stamp, float(self.cap[i]), int(self.channel[i]), acc, gyro, mag, int(self.rx_time_ns[i]))
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self.row(item)
+        return self.select(item)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def __repr__(self):
+        return f"SampleBlock({len(self)} samples)"
+
+
 def is_data():
     s = select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], [])
     return s
 
 
 class CapCallback:
-    def __init__(self, queue: dict = None, start_time=0):
+    """Collects notifications and hands them on as one SampleBlock per channel every FLUSH_PACKETS packets
+
+    Notifications arrive one 26-byte payload at a time, so a call only stamps and appends the payload; decoding, tick
+    unwrapping, raw capture and transport writes happen once per batch in flush(). A partial batch is flushed
+    FLUSH_INTERVAL seconds after its first packet by the running event loop, or straight away when there is none.
+    """
+    FLUSH_PACKETS = 32
+    FLUSH_INTERVAL = 0.02  # seconds
+    PERIOD_ALPHA = 2 / 101  # smoothing of the tick period, an EWMA over about 100 steps
+
+    def __init__(self, queue: dict = None, start_time=0, transport=None, raw_capture=None):
         self.start_time = 0
-        self.history = IterableQueue(100)
+        self.period = None  # recent tick-to-tick period, fills in the step across a wrap-around
         if queue is not None:
             for k, v in queue.items():
                 assert isinstance(v, multiprocessing.queues.Queue), \
                     "must assign a dictionary of multiprocessor.Queue to this attribute"
         self.queue = queue
+        self.transport = transport
+        self.raw_capture = raw_capture
         self.prev_time = None
         self.max_time = None
+        self._payloads = bytearray()
+        self._channels = []
+        self._rx_monotonic_ns = []
+        self._rx_time_ns = []
+        self._flush_handle = None
 
     def __call__(self, sender, bytes_array):
-        data = CapData.from_bytes(sender, bytes_array)
+        self._rx_monotonic_ns.append(time.monotonic_ns())
+        self._rx_time_ns.append(time.time_ns())
+        self._channels.append(1 if sender == CAP1_CHAR_UUID else 2)
+        self._payloads += bytes_array
+        if len(self._channels) >= self.FLUSH_PACKETS:
+            self.flush()
+        elif self._flush_handle is None:
+            try:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.FLUSH_INTERVAL, self.flush)
+            except RuntimeError:  # called outside an event loop
+                self.flush()
+
+    def _track_period(self, deltas):
+        """Fold forward tick steps into the period in place; a flush holds at most FLUSH_PACKETS of them"""
+        for delta in deltas:
+            self.period = delta if self.period is None else self.period + self.PERIOD_ALPHA * (delta - self.period)
+
+    def _unwrap(self, block: "SampleBlock"):
+        """Unwrap the 16-bit firmware tick: forward steps accumulate, wrap-arounds advance by the mean period"""
         if self.max_time is None:
-            self.max_time = data.time
-            self.prev_time = data.time
-            logger.debug(data)
-            return data, sender
-
-        if data.time > self.prev_time:
-            delta = data.time - self.prev_time
-            self.prev_time = data.time
-            self.history.put(delta)
-            self.max_time += delta
+            self.max_time = block.time[0]
+            self.prev_time = block.time[0]
+        old_time = block.time[-1]
+        if len(block) == 1:
+            delta = float(block.time[0]) - self.prev_time
+            if delta > 0:
+                self._track_period((delta,))
+            else:
+                delta = self.period or 0
+            block.time[0] = self.max_time + delta
         else:
-            self.prev_time = data.time
-            try:
-                assert len(self.history) != 0, "history shouldn't be empty"
-                self.max_time += np.mean(self.history)
-            except AssertionError:
-                pass
-        old_time = data.time
-        data.time = self.max_time
-        if data.mag is not None:
-            data.mag.time = self.max_time
-        if data.gyro is not None:
-            data.gyro.time = self.max_time
-        if data.acc is not None:
-            data.acc.time = self.max_time
-        logger.debug(f"{data.channel} {old_time:.3f} {self.max_time:.3f}")
-
-        if len(self.history) > 2:
-            logger.debug(f"{data} fs = {1 / np.mean(self.history):.2f}")
+            delta = np.diff(block.time, prepend=self.prev_time)
+            forward = delta > 0
+            fill = self.period or 0
+            self._track_period(delta[forward].tolist())
+            block.time = self.max_time + np.cumsum(np.where(forward, delta, fill))
+        self.prev_time = old_time
+        self.max_time = block.time[-1]
+        logger.debug(f"{block.channel[-1]} {old_time:.3f} {self.max_time:.3f}")
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._channels:
+            return
+        payloads = bytes(self._payloads)
+        channels = np.array(self._channels, dtype=np.int8)
+        rx_monotonic_ns = np.array(self._rx_monotonic_ns, dtype=np.int64)
+        rx_time_ns = np.array(self._rx_time_ns, dtype=np.int64)
+        self._payloads = bytearray()
+        self._channels, self._rx_monotonic_ns, self._rx_time_ns = [], [], []
+
+        if self.raw_capture is not None:
+            self.raw_capture.write(channels, rx_monotonic_ns, rx_time_ns, payloads)
+        columns = decode_packets(payloads)
+        block = SampleBlock(columns["time"], channels, columns["cap"], columns["acc"], columns["gyro"], columns["mag"],
+                            rx_monotonic_ns, rx_time_ns)
+        self._unwrap(block)
+        if self.period:
+            logger.debug(f"{block} fs = {1 / self.period:.2f}")
         else:
-            logger.debug(f"{data}")
+            logger.debug(f"{block}")
 
-        if self.queue is not None:
-            self.queue[f"cap{data.channel}"].put(data)
-        return data, sender
+        for channel in np.unique(channels):
+            channel_block = block if np.all(channels == channel) else block.select_channel(channel)
+            if self.transport is not None:
+                self.transport.put(channel_block)
+            if self.queue is not None:
+                self.queue[f"cap{channel}"].put(channel_block)
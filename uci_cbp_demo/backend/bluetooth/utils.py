@@ -1,6 +1,8 @@
 #  MIT License
 #  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
 import asyncio
+import threading
+import time
 from multiprocessing import Pipe
 
 from bleak import BleakClient
@@ -104,55 +106,113 @@ class SensorState:
         return f"state: {self._session_connected} {self._ch1_active} {self._ch2_active}"
 
 
-async def while_loop(pipe, state, wait_time=None, client=None, callback=None):
+class CommandChannel:
+    """Delivers (command, value) messages from the GUI pipe to the asyncio loop as soon as they arrive
+
+    The pipe is registered with the event loop as a reader; loops without add_reader support (Windows proactor) fall
+    back to a daemon thread blocking on recv(). Every handled command is acknowledged with ("ACK", (command, latency)),
+    where latency is the time from arrival to the end of handling in seconds.
+    """
+
+    def __init__(self, pipe: "Pipe", loop):
+        self.pipe = pipe
+        self.loop = loop
+        self.latency = {}
+        self._queue = asyncio.Queue()
+        self._received_at = None
+        self._reader = False
+        try:
+            loop.add_reader(pipe.fileno(), self._on_readable)
+            self._reader = True
+        except NotImplementedError:
+            threading.Thread(target=self._recv_forever, daemon=True).start()
+
+    def _on_readable(self):
+        try:
+            while self.pipe.poll():
+                self._queue.put_nowait((time.perf_counter(), self.pipe.recv()))
+        except (EOFError, OSError):
+            logger.info("Command pipe closed")
+            self.close()
+            self._queue.put_nowait((time.perf_counter(), ("STOP", None)))
+
+    def _recv_forever(self):
+        while True:
+            try:
+                message = self.pipe.recv()
+            except (EOFError, OSError):
+                message = ("STOP", None)
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, (time.perf_counter(), message))
+            if message[0] == "STOP":
+                break
+
+    async def get(self):
+        self._received_at, message = await self._queue.get()
+        return message
+
+    def ack(self, command):
+        latency = time.perf_counter() - self._received_at
+        self.latency[command] = latency
+        logger.debug(f"{command} handled in {1000 * latency:.2f} ms")
+        try:
+            self.pipe.send(("ACK", (command, latency)))
+        except (BrokenPipeError, OSError):
+            pass
+
+    def close(self):
+        if self._reader:
+            self.loop.remove_reader(self.pipe.fileno())
+            self._reader = False
+
+
+async def while_loop(channel: "CommandChannel", state, wait_time=None, client=None, callback=None):
     if wait_time is not None:
         await asyncio.sleep(wait_time)
     else:
         while True:
-            if pipe.poll():
-                command, value = pipe.recv()
-                logger.info(f"Message: {command} received")
-                if state.ACTIVE and command in ["STOP", "PAUSE"]:
-                    for c in state.caps_active:
-                        logger.info(f"stopping notification of {UUID[f'cap{c}']}")
-                        await client.stop_notify(UUID[f'cap{c}'])
-                    state.stop()
-
-                elif state.PAUSED and command == "START":
-                    await client.write_gatt_char(UUID[f'dac1'], getattr(state, f"dac1"))
-                    await client.write_gatt_char(UUID[f'dac2'], getattr(state, f"dac2"))
-                    for c in state.caps_enabled:
-                        logger.info(f"Resuming notification of {UUID[f'cap{c}']}")
-                        await client.start_notify(UUID[f'cap{c}'], callback)
-                    state.resume()
-
-                if command[:2] == "CH":
-                    ch = command[2]
-                    if value != state.CH1_ACTIVE:
-                        if value:
-                            logger.info(f"starting notification of {UUID[f'cap{ch}']}")
-                            await client.start_notify(UUID[f'cap{ch}'], callback)
-                        else:
-                            logger.info(f"stopping notification of {UUID[f'cap{ch}']}")
-                            await client.stop_notify(UUID[f'cap{ch}'])
-                    state.ch_state(ch, value)
-                if command[:3] == "DAC":
-                    ch = command[3]
-                    setattr(state, f"dac{ch}", value)
-                    await client.write_gatt_char(UUID[f'dac{ch}'], getattr(state, f"dac{ch}"))
-
-                if command == "STOP":
-                    break
-            await asyncio.sleep(1)
+            command, value = await channel.get()
+            logger.info(f"Message: {command} received")
+            if state.ACTIVE and command in ["STOP", "PAUSE"]:
+                for c in state.caps_active:
+                    logger.info(f"stopping notification of {UUID[f'cap{c}']}")
+                    await client.stop_notify(UUID[f'cap{c}'])
+                state.stop()
+
+            elif state.PAUSED and command == "START":
+                await client.write_gatt_char(UUID[f'dac1'], getattr(state, f"dac1"))
+                await client.write_gatt_char(UUID[f'dac2'], getattr(state, f"dac2"))
+                for c in state.caps_enabled:
+                    logger.info(f"Resuming notification of {UUID[f'cap{c}']}")
+                    await client.start_notify(UUID[f'cap{c}'], callback)
+                state.resume()
+
+            if command[:2] == "CH":
+                ch = command[2]
+                if value != state.CH1_ACTIVE:
+                    if value:
+                        logger.info(f"starting notification of {UUID[f'cap{ch}']}")
+                        await client.start_notify(UUID[f'cap{ch}'], callback)
+                    else:
+                        logger.info(f"stopping notification of {UUID[f'cap{ch}']}")
+                        await client.stop_notify(UUID[f'cap{ch}'])
+                state.ch_state(ch, value)
+            if command[:3] == "DAC":
+                ch = command[3]
+                setattr(state, f"dac{ch}", value)
+                await client.write_gatt_char(UUID[f'dac{ch}'], getattr(state, f"dac{ch}"))
+
+            channel.ack(command)
+            if command == "STOP":
+                break
 
 
 async def start_notify_uuid(addr, loop, pipe: "Pipe", callback, wait_time=None):
     state = SensorState()
     uuids = set()
+    channel = CommandChannel(pipe, loop)
     while True:
         logger.info(f"Waiting for commands")
-        pipe.poll(None)
-        command, value = pipe.recv()
+        command, value = await channel.get()
         logger.info(f"{command}, {value} received")
         if command == "CONNECT":
             break
@@ -168,6 +228,10 @@ async def start_notify_uuid(addr, loop, pipe: "Pipe", callback, wait_time=None):
             ch = command[3]
             logger.info(f"dac{ch} value set to {value}")
             setattr(state, f"dac{ch}", value)
+        if command == "CAPTURE":
+            from uci_cbp_demo.backend.raw_capture import RawCaptureWriter
+            callback.raw_capture = RawCaptureWriter(value)
+        channel.ack(command)
 
     logger.info(f"Connecting to {addr}")
     async with BleakClient(addr, loop=loop) as client:
@@ -176,7 +240,14 @@ async def start_notify_uuid(addr, loop, pipe: "Pipe", callback, wait_time=None):
         await client.write_gatt_char(UUID[f'dac1'], state.dac1)
         await client.write_gatt_char(UUID[f'dac2'], state.dac2)
         state.connected()
-        await while_loop(pipe, state, wait_time, client, callback)
+        channel.ack("CONNECT")
+        await while_loop(channel, state, wait_time, client, callback)
+    channel.close()
+    if hasattr(callback, "flush"):
+        callback.flush()
+    if getattr(callback, "raw_capture", None) is not None:
+        callback.raw_capture.close()
+        callback.raw_capture = None
 
 
 def run_until_complete(f, callbacks, wait_time=None):
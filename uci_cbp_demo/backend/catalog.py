@@ -0,0 +1,144 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+import datetime
+import re
+import sqlite3
+import time
+from pathlib import Path
+
+from uci_cbp_demo.logging import logger
+
+SESSION_DIRECTORY = re.compile(r"^(?P<prefix>.*)_(?P<stamp>\d{2}_\d{2}_\d{4}_\d{2}_\d{2}_\d{2})$")
+SESSION_STAMP = "%m_%d_%Y_%H_%M_%S"
+
+
+class SessionCatalog:
+    """SQLite index of recording sessions under the app data directory
+
+    A row is inserted when a session opens and completed with summary statistics when it closes, so listing and
+    filtering sessions never touches the recordings themselves.
+    """
+    FILE = "catalog.sqlite"
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        path TEXT PRIMARY KEY,
+        prefix TEXT,
+        started_ns INTEGER,
+        ended_ns INTEGER,
+        duration REAL,
+        mac TEXT,
+        channels TEXT,
+        dac1 INTEGER,
+        dac2 INTEGER,
+        samples INTEGER,
+        cap1_samples INTEGER,
+        cap1_mean REAL,
+        cap1_min REAL,
+        cap1_max REAL,
+        cap2_samples INTEGER,
+        cap2_mean REAL,
+        cap2_min REAL,
+        cap2_max REAL,
+        cap1_std REAL,
+        cap1_rate REAL,
+        cap1_jitter REAL,
+        cap2_std REAL,
+        cap2_rate REAL,
+        cap2_jitter REAL
+    );
+    CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started_ns);
+    CREATE INDEX IF NOT EXISTS sessions_mac ON sessions (mac);
+    """
+    SUMMARY_COLUMNS = ["duration", "samples",
+                       "cap1_samples", "cap1_mean", "cap1_min", "cap1_max", "cap1_std", "cap1_rate", "cap1_jitter",
+                       "cap2_samples", "cap2_mean", "cap2_min", "cap2_max", "cap2_std", "cap2_rate", "cap2_jitter"]
+    # columns added after the first release, with their types; catalogs created before them are migrated on open
+    ADDED_COLUMNS = {"cap1_std": "REAL", "cap1_rate": "REAL", "cap1_jitter": "REAL",
+                     "cap2_std": "REAL", "cap2_rate": "REAL", "cap2_jitter": "REAL"}
+
+    def __init__(self, app_data_directory):
+        self.app_data_directory = Path(app_data_directory)
+        self.app_data_directory.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.app_data_directory / self.FILE), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(self.SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        existing = {r["name"] for r in self._db.execute("PRAGMA table_info(sessions)")}
+        with self._db:
+            for column, kind in self.ADDED_COLUMNS.items():
+                if column not in existing:
+                    self._db.execute(f"ALTER TABLE sessions ADD COLUMN {column} {kind}")
+                    logger.info(f"Added column {column} to the session catalog")
+
+    def session_opened(self, path, prefix="session", mac=None, channels=(), dac1=None, dac2=None, started_ns=None):
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO sessions (path, prefix, started_ns, mac, channels, dac1, dac2) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (str(path), prefix, time.time_ns() if started_ns is None else started_ns, mac,
+                              ",".join(str(c) for c in channels), dac1, dac2))
+
+    def session_closed(self, path, summary: dict = None, ended_ns=None):
+        summary = {k: v for k, v in (summary or {}).items() if k in self.SUMMARY_COLUMNS}
+        assignments = ", ".join(["ended_ns = ?"] + [f"{k} = ?" for k in summary])
+        with self._db:
+            self._db.execute(f"UPDATE sessions SET {assignments} WHERE path = ?",
+                             [time.time_ns() if ended_ns is None else ended_ns, *summary.values(), str(path)])
+
+    def session_recovered(self, path, ended_ns=None):
+        with self._db:
+            self._db.execute("UPDATE sessions SET ended_ns = COALESCE(?, started_ns), "
+                             "duration = (COALESCE(?, started_ns) - started_ns) / 1e9 WHERE path = ?",
+                             (ended_ns, ended_ns, str(path)))
+
+    def open_sessions(self):
+        return [r["path"] for r in self._db.execute("SELECT path FROM sessions WHERE ended_ns IS NULL")]
+
+    def query(self, since=None, until=None, mac=None, channel=None, min_duration=None, max_duration=None,
+              dac1=None, dac2=None, prefix=None):
+        """Sessions matching every given filter, newest first; since/until are datetimes"""
+        clauses, params = [], []
+        if since is not None:
+            clauses.append("started_ns >= ?")
+            params.append(int(since.timestamp() * 1e9))
+        if until is not None:
+            clauses.append("started_ns < ?")
+            params.append(int(until.timestamp() * 1e9))
+        if mac is not None:
+            clauses.append("mac = ? COLLATE NOCASE")
+            params.append(mac)
+        if channel is not None:
+            clauses.append("(',' || channels || ',') LIKE ?")
+            params.append(f"%,{channel},%")
+        if min_duration is not None:
+            clauses.append("duration >= ?")
+            params.append(min_duration)
+        if max_duration is not None:
+            clauses.append("duration <= ?")
+            params.append(max_duration)
+        for column, value in [("dac1", dac1), ("dac2", dac2), ("prefix", prefix)]:
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return [dict(r) for r in self._db.execute(f"SELECT * FROM sessions {where} ORDER BY started_ns DESC", params)]
+
+    def scan(self):
+        """Register session directories created before the catalog existed (metadata from the directory name only)"""
+        known = {r["path"] for r in self._db.execute("SELECT path FROM sessions")}
+        added = 0
+        for directory in sorted(self.app_data_directory.iterdir()):
+            match = SESSION_DIRECTORY.match(directory.name)
+            if not directory.is_dir() or match is None or str(directory) in known:
+                continue
+            started = datetime.datetime.strptime(match.group("stamp"), SESSION_STAMP)
+            started_ns = int(started.timestamp() * 1e9)
+            self.session_opened(directory, match.group("prefix"), started_ns=started_ns)
+            self.session_closed(directory, ended_ns=int(directory.stat().st_mtime * 1e9))
+            added += 1
+        logger.info(f"Added {added} sessions from {self.app_data_directory}")
+        return added
+
+    def close(self):
+        self._db.close()
@@ -1,60 +1,289 @@
 #  MIT License
 #  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+import queue
+import threading
+import time
 from pathlib import Path
+from typing import Union
 
-import pandas as pd
+import numpy as np
 
-from uci_cbp_demo.backend.bluetooth import CapData
+from uci_cbp_demo.backend.bluetooth import CapData, SampleBlock
+from uci_cbp_demo.backend.bluetooth.callbacks import format_wall_clock
+from uci_cbp_demo.backend.catalog import SessionCatalog, SESSION_STAMP
+from uci_cbp_demo.backend.journal import GroupCommit, recover_session
+from uci_cbp_demo.backend.processing import ProcessedBlock
+from uci_cbp_demo.backend.session_store import ChunkedSessionWriter
+from uci_cbp_demo.backend.stats import RateMeter, RunningStats
 from uci_cbp_demo.logging import logger
 
 
 class FileExporterConf:
     app_data_directory = None
+    wall_clock_format = "iso"  # "iso" for local ISO-8601 strings, "ns" for epoch nanoseconds
+    max_queued_batches = 256  # blocks waiting for the writer thread before new ones are dropped
+    columnar_store = False  # also write chunked compressed columns under <session>/store
+    columnar_codec = "zlib"
+    fsync_interval = 1.0  # seconds of recording that may be lost on a crash
+    export_processed = False  # also write the filtered signal and beat/PTT columns to processed.tsv
+
+
+def format_rows(cells, row_format):
+    """Format a 2-D block of cells with one row_format applied once to all rows; NaN cells are left empty
+
+    Floats are formatted with %r so values round-trip as they did through str(); "nan" only ever comes from a NaN
+    cell, so it is blanked with one replace over the whole text.
+    """
+    return ((row_format + "\n") * len(cells) % tuple(cells.ravel().tolist())).replace("nan", "")
+
+
+class RecordWriter:
+    """Appends SampleBlocks to a TSV file through preallocated column buffers
+
+    Rows are buffered as a float64 matrix (plus the receive stamps for wall_clock) and written with one formatted
+    write once flush_rows rows are buffered or flush_interval seconds have passed since the last write. Writes are
+    fsynced as a group at most every fsync_interval seconds. Missing values (the other cap channel, suppressed IMU) are
+    left empty.
+    """
+    COLUMNS = ["time", "wall_clock", "cap1", "cap2",
+               "accx", "accy", "accz",
+               "gyrox", "gyroy", "gyroz",
+               "magx", "magy", "magz"]
+
+    def __init__(self, path, flush_rows=1024, flush_interval=1.0, wall_clock_format="iso", fsync_interval=1.0):
+        self.path = Path(path)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.group_commit = GroupCommit(fsync_interval)
+        self.wall_clock_format = wall_clock_format
+        self._values = np.empty((flush_rows, len(self.COLUMNS) - 1))
+        self._rx_time_ns = np.empty(flush_rows, dtype=np.int64)
+        self._n = 0
+        self._last_flush = time.monotonic()
+        self._file = open(self.path, "a", newline="")
+        if self._file.tell() == 0:
+            self._file.write("\t".join(self.COLUMNS) + "\n")
+            self.group_commit.commit(self._file)
+
+    def put(self, block: "SampleBlock", imu=True):
+        start = 0
+        while start < len(block):
+            n = min(len(block) - start, self.flush_rows - self._n)
+            rows = slice(self._n, self._n + n)
+            part = slice(start, start + n)
+            channel = block.channel[part]
+            self._values[rows, 0] = block.time[part]
+            self._values[rows, 1] = np.where(channel == 1, block.cap[part], np.nan)
+            self._values[rows, 2] = np.where(channel == 2, block.cap[part], np.nan)
+            if imu:
+                self._values[rows, 3:6] = block.acc[part]
+                self._values[rows, 6:9] = block.gyro[part]
+                self._values[rows, 9:12] = block.mag[part]
+            else:
+                self._values[rows, 3:] = np.nan
+            self._rx_time_ns[rows] = block.rx_time_ns[part]
+            self._n += n
+            start += n
+            if self._n == self.flush_rows:
+                self.flush()
+        self.tick()
+
+    def tick(self):
+        if self._n and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        self.group_commit.maybe_commit(self._file)
+
+    ROW_FORMAT = "\t".join(["%r", "%s"] + ["%r"] * (len(COLUMNS) - 2))
+
+    def format(self, values, rx_time_ns):
+        cells = np.empty((len(values), len(self.COLUMNS)), dtype=object)
+        cells[:, 0] = values[:, 0]
+        cells[:, 1] = format_wall_clock(rx_time_ns, self.wall_clock_format)
+        cells[:, 2:] = values[:, 1:]
+        return format_rows(cells, self.ROW_FORMAT)
+
+    def flush(self):
+        if self._n:
+            self._file.write(self.format(self._values[:self._n], self._rx_time_ns[:self._n]))
+            self._file.flush()
+            self._n = 0
+        self._last_flush = time.monotonic()
+
+    def sync(self):
+        self.flush()
+        self.group_commit.commit(self._file)
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class ProcessedWriter:
+    """Appends ProcessedBlocks to a TSV file; the columns are fixed by the first block written
+
+    Columns a later block lacks are left empty and columns it adds are not written.
+    """
+
+    def __init__(self, path, flush_interval=1.0, fsync_interval=1.0):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.group_commit = GroupCommit(fsync_interval)
+        self.columns = None
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._file = open(self.path, "a", newline="")
+
+    def put(self, block: "ProcessedBlock"):
+        if len(block) == 0:
+            return
+        if self.columns is None:
+            self.columns = block.names
+            if self._file.tell() == 0:
+                self._file.write("\t".join(["time"] + self.columns) + "\n")
+        values = np.column_stack([block.time] + [block.columns.get(c, np.full(len(block), np.nan))
+                                                 for c in self.columns])
+        self._pending.append(values)
+        self.tick()
+
+    def tick(self):
+        if self._pending and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        self.group_commit.maybe_commit(self._file)
+
+    def flush(self):
+        if self._pending:
+            values = np.concatenate(self._pending)
+            self._file.write(format_rows(values, "\t".join(["%r"] * values.shape[1])))
+            self._file.flush()
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def sync(self):
+        self.flush()
+        self.group_commit.commit(self._file)
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class SessionSummary:
+    """Per-channel cap statistics and sample rate plus the receive-time span of everything recorded"""
+
+    def __init__(self):
+        self.samples = 0
+        self.first_rx_ns = None
+        self.last_rx_ns = None
+        self.channels = {c: RunningStats() for c in [1, 2]}
+        self.rates = {c: RateMeter() for c in [1, 2]}
+
+    def update(self, block: "SampleBlock"):
+        if len(block) == 0:
+            return
+        self.samples += len(block)
+        if self.first_rx_ns is None:
+            self.first_rx_ns = int(block.rx_time_ns[0])
+        self.last_rx_ns = int(block.rx_time_ns[-1])
+        for c, stats in self.channels.items():
+            mine = block.channel == c
+            if np.any(mine):
+                stats.update(block.cap[mine])
+                self.rates[c].update(block.time[mine])
+
+    def to_dict(self):
+        summary = {"samples": self.samples,
+                   "duration": 0.0 if self.first_rx_ns is None else (self.last_rx_ns - self.first_rx_ns) / 1e9}
+        for c, stats in self.channels.items():
+            summary[f"cap{c}_samples"] = stats.count
+            if stats.count:
+                summary[f"cap{c}_mean"] = stats.mean
+                summary[f"cap{c}_std"] = stats.std
+                summary[f"cap{c}_min"] = stats.min
+                summary[f"cap{c}_max"] = stats.max
+                summary[f"cap{c}_rate"] = self.rates[c].rate
+                summary[f"cap{c}_jitter"] = self.rates[c].jitter
+        return summary
 
 
 class FileExporterSession:
-    FLUSH_EVERY_N_SAMPLES = 100
+    FLUSH_EVERY_N_SAMPLES = 1024
+    FLUSH_INTERVAL = 1.0  # seconds
 
-    def __init__(self, output_directory=None):
+    def __init__(self, output_directory=None, wall_clock_format="iso", columnar_store=False, columnar_codec="zlib",
+                 fsync_interval=1.0, export_processed=False):
         self.imu_output = True
+        self.wall_clock_format = wall_clock_format
         self.prefix = ""
+        self.summary = SessionSummary()
         self._output_directory = Path(output_directory)
         self._output_directory.mkdir(parents=True, exist_ok=True)
         logger.info(f"Starting new FileExporterSession under {self._output_directory}")
-        self.df = pd.DataFrame(
-            columns=["time", "wall_clock", "cap1", "cap2",
-                     "accx", "accy", "accz",
-                     "gyrox", "gyroy", "gyroz",
-                     "magx", "magy", "magz"])
-        self.df.to_csv(self.dataframe_output, header=True, sep="\t", index=False)
+        self._writer = RecordWriter(self.dataframe_output, flush_rows=self.FLUSH_EVERY_N_SAMPLES,
+                                    flush_interval=self.FLUSH_INTERVAL, wall_clock_format=wall_clock_format,
+                                    fsync_interval=fsync_interval)
+        self._processed = None
+        if export_processed:
+            self._processed = ProcessedWriter(self.processed_output, flush_interval=self.FLUSH_INTERVAL,
+                                              fsync_interval=fsync_interval)
+        self._store = None
+        if columnar_store:
+            self._store = ChunkedSessionWriter(self.store_output, codec=columnar_codec,
+                                               chunk_interval=fsync_interval)
+
+    @property
+    def store_output(self):
+        return self._output_directory / "store"
+
+    @property
+    def output_directory(self):
+        return self._output_directory
 
     @property
     def dataframe_output(self):
         return self._output_directory / "record.tsv"
 
+    @property
+    def processed_output(self):
+        return self._output_directory / "processed.tsv"
+
     @classmethod
-    def new_session_timestamp(cls, app_data_directory, prefix="session"):
+    def new_session_timestamp(cls, app_data_directory, prefix="session", **kwargs):
         from datetime import datetime
-        return cls(app_data_directory / datetime.now().strftime(f"{prefix}_%m_%d_%Y_%H_%M_%S"))
-
-    def put(self, sample: CapData):
-
-        new_row = sample.to_dict()
-        logger.debug(f"{new_row}")
-        if not self.imu_output:
-            new_row["accx"] = None
-            new_row["accy"] = None
-            new_row["accz"] = None
-            new_row["gyrox"] = None
-            new_row["gyroy"] = None
-            new_row["gyroz"] = None
-            new_row["magx"] = None
-            new_row["magy"] = None
-            new_row["magz"] = None
-        self.df = self.df.append(new_row, ignore_index=True)
-        if len(self.df) == self.FLUSH_EVERY_N_SAMPLES:
-            self.df.to_csv(self.dataframe_output, mode="a", header=False, sep="\t", index=False)
-            self.df = self.df.truncate(before=-1, after=-1)
+        return cls(app_data_directory / datetime.now().strftime(f"{prefix}_{SESSION_STAMP}"), **kwargs)
+
+    def put(self, sample: "Union[CapData, SampleBlock, ProcessedBlock]"):
+        if isinstance(sample, ProcessedBlock):
+            if self._processed is not None:
+                self._processed.put(sample)
+            return
+        if not isinstance(sample, SampleBlock):
+            sample = SampleBlock.from_samples([sample])
+        self._writer.put(sample, imu=self.imu_output)
+        self.summary.update(sample)
+        if self._store is not None:
+            if not self.imu_output:
+                sample = SampleBlock(sample.time, sample.channel, sample.cap, rx_monotonic_ns=sample.rx_monotonic_ns,
+                                     rx_time_ns=sample.rx_time_ns)
+            self._store.put(sample)
+
+    def tick(self):
+        self._writer.tick()
+        if self._processed is not None:
+            self._processed.tick()
+        if self._store is not None:
+            self._store.tick()
+
+    def flush(self):
+        self._writer.sync()
+        if self._processed is not None:
+            self._processed.sync()
+
+    def close(self):
+        self._writer.close()
+        if self._processed is not None:
+            self._processed.close()
+        if self._store is not None:
+            self._store.close()
 
     def suppress_imu(self):
         self.imu_output = False
@@ -63,24 +292,189 @@ class FileExporterSession:
         self.imu_output = True
 
 
+class BackgroundWriter:
+    """Hands blocks to a dedicated thread that writes them into a FileExporterSession
+
+    put() never blocks: when max_batches blocks are already waiting the block is dropped and counted. flush() waits
+    until everything queued before it has been written and synced; close() also closes the session and joins the
+    thread. suppress_imu() and incite_imu() are queued like blocks, so they only affect blocks put after them. A block
+    that fails to write is logged and skipped, so one bad block cannot stop the thread.
+    """
+    _FLUSH = "flush"
+    _CLOSE = "close"
+    _SUPPRESS_IMU = "suppress_imu"
+    _INCITE_IMU = "incite_imu"
+
+    def __init__(self, session: "FileExporterSession", max_batches=256):
+        self.session = session
+        self.queued_bytes = 0
+        self.dropped_batches = 0
+        self.written_batches = 0
+        self.write_latency = 0.0
+        self.max_write_latency = 0.0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._thread = threading.Thread(target=self._run, name="FileExporterWriter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.session.FLUSH_INTERVAL / 2)
+            except queue.Empty:
+                # nothing arrived (paused, or a slow board): still honour the flush and fsync intervals
+                try:
+                    self.session.tick()
+                except Exception:
+                    logger.exception("Failed to flush the recording")
+                continue
+            if isinstance(item, tuple):
+                command, done = item
+                try:
+                    if command == self._CLOSE:
+                        self.session.close()
+                    elif command == self._FLUSH:
+                        self.session.flush()
+                    elif command == self._SUPPRESS_IMU:
+                        self.session.suppress_imu()
+                    elif command == self._INCITE_IMU:
+                        self.session.incite_imu()
+                except Exception:
+                    logger.exception(f"Recording command {command} failed")
+                finally:
+                    if done is not None:
+                        done.set()
+                if command == self._CLOSE:
+                    break
+                continue
+            t = time.perf_counter()
+            try:
+                self.session.put(item)
+            except Exception:
+                logger.exception(f"Failed to write {len(item)} samples")
+            latency = time.perf_counter() - t
+            with self._lock:
+                self.queued_bytes -= item.nbytes
+                self.written_batches += 1
+                self.write_latency = latency
+                self.max_write_latency = max(self.max_write_latency, latency)
+
+    def put(self, block: "Union[SampleBlock, ProcessedBlock]"):
+        try:
+            self._queue.put_nowait(block)
+        except queue.Full:
+            with self._lock:
+                self.dropped_batches += 1
+                dropped = self.dropped_batches
+            if dropped == 1 or dropped % 100 == 0:
+                reason = "Recording queue full" if self._thread.is_alive() else "Recording writer stopped"
+                logger.warning(f"{reason}, {dropped} batches dropped so far")
+            return
+        with self._lock:
+            self.queued_bytes += block.nbytes
+
+    def _command(self, command, timeout=None, wait=True):
+        """Queue a command behind the blocks already waiting; False if the writer thread is gone or it timed out"""
+        if not self._thread.is_alive():
+            logger.error(f"Recording writer stopped, {command} not run")
+            return False
+        done = threading.Event() if wait else None
+        self._queue.put((command, done))
+        return done.wait(timeout) if wait else True
+
+    def flush(self, timeout=None):
+        return self._command(self._FLUSH, timeout)
+
+    def suppress_imu(self):
+        self._command(self._SUPPRESS_IMU, wait=False)
+
+    def incite_imu(self):
+        self._command(self._INCITE_IMU, wait=False)
+
+    def close(self, timeout=None):
+        if self._thread.is_alive():
+            self._command(self._CLOSE, timeout)
+            self._thread.join(timeout)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {"queued_bytes": self.queued_bytes, "dropped_batches": self.dropped_batches,
+                    "written_batches": self.written_batches, "write_latency": self.write_latency,
+                    "max_write_latency": self.max_write_latency}
+
+
 class FileExporter:
     def __init__(self, conf: "FileExporterConf"):
         self._conf = conf
         self._session = None
+        self._writer = None
+        self._catalog = None
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = SessionCatalog(self._conf.app_data_directory)
+        return self._catalog
 
     def suppress_imu(self):
-        self._session.suppress_imu()
+        if self._writer is not None:
+            self._writer.suppress_imu()
 
     def incite_imu(self):
-        self._session.incite_imu()
+        if self._writer is not None:
+            self._writer.incite_imu()
 
-    def put(self, sample: CapData):
-        if self._session is not None:
-            self._session.put(sample)
+    def put(self, sample: "Union[CapData, SampleBlock, ProcessedBlock]"):
+        if isinstance(sample, ProcessedBlock) and not self._conf.export_processed:
+            return
+        if self._writer is not None:
+            if not isinstance(sample, (SampleBlock, ProcessedBlock)):
+                sample = SampleBlock.from_samples([sample])
+            self._writer.put(sample)
 
-    def new_session(self, prefix="session"):
+    def new_session(self, prefix="session", metadata: dict = None):
+        self.close_session()
         app_data_directory = Path(self._conf.app_data_directory)
-        self._session = FileExporterSession.new_session_timestamp(app_data_directory, prefix=prefix)
+        self._session = FileExporterSession.new_session_timestamp(app_data_directory, prefix=prefix,
+                                                                  wall_clock_format=self._conf.wall_clock_format,
+                                                                  columnar_store=self._conf.columnar_store,
+                                                                  columnar_codec=self._conf.columnar_codec,
+                                                                  fsync_interval=self._conf.fsync_interval,
+                                                                  export_processed=self._conf.export_processed)
+        self._writer = BackgroundWriter(self._session, max_batches=self._conf.max_queued_batches)
+        self.catalog.session_opened(self._session.output_directory, prefix, **(metadata or {}))
+
+    def flush(self, timeout=None):
+        if self._writer is not None:
+            return self._writer.flush(timeout)
+        return True
+
+    def recover(self):
+        """Repair sessions the catalog still lists as open, i.e. ones a crash or kill did not let us close"""
+        for path in self.catalog.open_sessions():
+            if self._session is not None and str(self._session.output_directory) == path:
+                continue
+            path = Path(path)
+            if path.is_dir():
+                recover_session(path)
+                ended_ns = max(int(f.stat().st_mtime * 1e9) for f in [path, *path.iterdir()])
+            else:
+                ended_ns = None
+            self.catalog.session_recovered(path, ended_ns)
+
+    @property
+    def session_directory(self):
+        return self._session.output_directory if self._session is not None else None
+
+    @property
+    def stats(self):
+        return self._writer.stats if self._writer is not None else {}
 
     def close_session(self):
+        if self._writer is not None:
+            self._writer.close()
+            logger.info(f"Closed FileExporterSession: {self._writer.stats}")
+            self.catalog.session_closed(self._session.output_directory, self._session.summary.to_dict())
+        self._writer = None
         self._session = None
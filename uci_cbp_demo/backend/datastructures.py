@@ -3,38 +3,269 @@
 import numpy as np
 
 
-class RotationalDataQueue(list):
+class MonotonicQueue:
+    """Sliding-window maximum (or minimum) over a stream of samples numbered by an ever-increasing sequence number
+
+    Keeps only the samples that can still become the extremum: a sample is dropped as soon as a later one is at least
+    as large, so the kept values are strictly decreasing and the front is the window maximum. A batch is merged with
+    one reverse cumulative maximum and one binary search, and the kept entries live in a preallocated buffer that is
+    compacted only when its spare half is used up, so each sample costs O(1) amortized and reading is O(1).
+    """
+
+    def __init__(self, capacity=1024, mode="max"):
+        # entries are stored as keys (negated maxima or plain minima) so they increase along the buffer
+        self._sign = -1.0 if mode == "max" else 1.0
+        self._seq = np.empty(2 * max(int(capacity), 1), dtype=np.int64)
+        self._key = np.empty(len(self._seq))
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self):
+        return self._tail - self._head
+
+    @property
+    def value(self):
+        return self._sign * self._key[self._head] if len(self) else np.nan
+
+    def clear(self):
+        self._head, self._tail = 0, 0
+
+    def _reserve(self, n):
+        if self._tail + n <= len(self._seq):
+            return
+        live = len(self)
+        if live + n > len(self._seq) // 2:
+            size = 2 * max(len(self._seq), live + n)
+            seq, key = np.empty(size, dtype=np.int64), np.empty(size)
+            seq[:live], key[:live] = self._seq[self._head:self._tail], self._key[self._head:self._tail]
+            self._seq, self._key = seq, key
+        else:
+            self._seq[:live] = self._seq[self._head:self._tail]
+            self._key[:live] = self._key[self._head:self._tail]
+        self._head, self._tail = 0, live
+
+    def extend(self, first_seq, values):
+        keys = self._sign * np.asarray(values, dtype=np.float64)
+        n = len(keys)
+        if n == 0:
+            return
+        # the batch's own candidates: keys strictly smaller than every later one (the last one always qualifies)
+        later = np.minimum.accumulate(keys[::-1])[::-1]
+        keep = np.flatnonzero(keys[:-1] < later[1:])
+        # old entries survive only if smaller than the batch's smallest key; being sorted, they are a prefix
+        self._tail = self._head + int(np.searchsorted(self._key[self._head:self._tail], later[0], side="left"))
+        self._reserve(len(keep) + 1)
+        end = self._tail + len(keep)
+        self._seq[self._tail:end] = first_seq + keep
+        self._key[self._tail:end] = keys[keep]
+        self._seq[end], self._key[end] = first_seq + n - 1, keys[-1]
+        self._tail = end + 1
+
+    def evict(self, start_seq):
+        """Forget samples numbered below start_seq"""
+        self._head += int(np.searchsorted(self._seq[self._head:self._tail], start_seq, side="left"))
+
+
+class RotationalDataQueue:
+    """Time-windowed buffer keeping samples with time >= newest time - window_size
+
+    Columns live side by side in a preallocated array twice the capacity wide. Appends write past the live region and
+    the live region is moved back to the front only when the spare half is used up, so appends are amortized O(1) and
+    the live region is always one contiguous slice. Eviction is a binary search on the (sorted) time column.
+    Accessors return read-only views of the storage that are cached until the next append. Columns listed in
+    EXTREMA additionally keep their window minimum and maximum in MonotonicQueues.
+    """
+    COLUMNS = ()
+    EXTREMA = ()
+    DEFAULT_CAPACITY = 1024
+
     def head_updated_callback(self):
         pass
 
-    def __init__(self, window_size=10):
-        self._i = 0
+    def __init__(self, window_size=10, capacity=None):
         self.window_size = window_size
-        super(RotationalDataQueue, self).__init__()
+        if capacity is None:
+            capacity = self.DEFAULT_CAPACITY
+        self._capacity = max(int(capacity), 1)
+        self._data = np.empty((1 + len(self.COLUMNS), 2 * self._capacity))
+        self._start = 0
+        self._stop = 0
+        self._views = None
+        self._appended = 0  # sequence number of the next sample, samples keep theirs until evicted
+        self.merges = 0  # out-of-order extends, which rewrite already buffered samples
+        self._extrema = {name: (MonotonicQueue(self._capacity, "min"), MonotonicQueue(self._capacity, "max"))
+                         for name in self.EXTREMA}
+
+    def __len__(self):
+        return self._stop - self._start
 
     @property
     def non_empty(self):
-        return sum([1 if d is not None else 0 for d in self])
+        return len(self)
 
-    def sort_time(self):
-        self.sort(key=lambda x: x.time)
+    def columns(self):
+        if self._views is None:
+            views = []
+            for row in self._data[:, self._start:self._stop]:
+                row.flags.writeable = False
+                views.append(row)
+            self._views = tuple(views)
+        return self._views
 
     @property
     def time(self):
-        return np.array([d.time for d in self])
+        return self.columns()[0]
+
+    def column(self, name):
+        return self.columns()[1 + self.COLUMNS.index(name)]
+
+    def extrema(self, name):
+        """(min, max) of column `name` over the window, O(1)"""
+        low, high = self._extrema[name]
+        return low.value, high.value
+
+    def _update_extrema(self, values, rebuild=False):
+        # values are the newest samples, numbered up to self._appended - 1
+        for name, queues in self._extrema.items():
+            column = values[self.COLUMNS.index(name)]
+            for q in queues:
+                if rebuild:
+                    q.clear()
+                q.extend(self._appended - len(column), column)
 
     @property
     def duration(self):
-        return np.max(self.time) - np.min(self.time)
+        if len(self) == 0:
+            return 0
+        return self._data[0, self._stop - 1] - self._data[0, self._start]
+
+    def _reserve(self, n):
+        if self._stop + n <= self._data.shape[1]:
+            return
+        live = len(self)
+        if live + n > self._capacity:
+            self._capacity = max(2 * self._capacity, live + n)
+            data = np.empty((self._data.shape[0], 2 * self._capacity))
+            data[:, :live] = self._data[:, self._start:self._stop]
+            self._data = data
+        else:
+            self._data[:, :live] = self._data[:, self._start:self._stop]
+        self._start, self._stop = 0, live
+
+    def extend(self, time, values):
+        time = np.asarray(time, dtype=np.float64)
+        n = len(time)
+        if n == 0:
+            return
+        values = np.asarray(values, dtype=np.float64).reshape(n, len(self.COLUMNS))
+        in_order = (len(self) == 0 or time[0] >= self._data[0, self._stop - 1]) and \
+            (n == 1 or bool(np.all(time[1:] >= time[:-1])))
+        if in_order:
+            self._reserve(n)
+            self._data[0, self._stop:self._stop + n] = time
+            self._data[1:, self._stop:self._stop + n] = values.T
+            self._stop += n
+            self._appended += n
+            self._update_extrema(values.T)
+        else:
+            merged = np.concatenate([self._data[:, self._start:self._stop],
+                                     np.vstack([time[np.newaxis, :], values.T])], axis=1)
+            merged = merged[:, np.argsort(merged[0], kind="stable")]
+            self._start, self._stop = 0, 0
+            self._reserve(merged.shape[1])
+            self._data[:, :merged.shape[1]] = merged
+            self._stop = merged.shape[1]
+            # the merged window is renumbered, so the extrema are rebuilt from it
+            self._appended += n
+            self.merges += 1
+            self._update_extrema(merged[1:], rebuild=True)
+        self._evict()
+        self._views = None
+        self.head_updated_callback()
+
+    def _evict(self):
+        cutoff = self._data[0, self._stop - 1] - self.window_size
+        self._start += int(np.searchsorted(self._data[0, self._start:self._stop], cutoff, side="left"))
+        for queues in self._extrema.values():
+            for q in queues:
+                q.evict(self._appended - len(self))
 
     def put(self, value):
-        self.append(value)
-        self.sort_time()
-        while self.duration > self.window_size:
-            self.pop(0)
+        if value is not None:
+            self.extend([value.time], [[getattr(value, c) for c in self.COLUMNS]])
+
+    def clear(self):
+        self._start, self._stop = 0, 0
+        self._views = None
+        for queues in self._extrema.values():
+            for q in queues:
+                q.clear()
 
     def __repr__(self):
-        return ",".join([str(d) for d in self[:5]])
+        return ",".join([f"{t:.3f}" for t in self.time[:5]])
+
+
+class MinMaxDecimator:
+    """Reduces one column of a RotationalDataQueue to its minimum and maximum (in time order) per time bucket
+
+    Buckets are aligned to multiples of `bucket` seconds, so a bucket never changes once the data has moved past it:
+    completed buckets are cached and each call only reduces the samples of the newest, still open bucket plus
+    whatever arrived since the last call, and the oldest bucket again since eviction trims it. With one bucket per
+    pixel column the line keeps its visual envelope while the number of points drawn stays about 2 x width, whatever
+    the sample rate or window length.
+    """
+
+    def __init__(self, queue: "RotationalDataQueue", column, bucket=None):
+        self.queue = queue
+        self.column = column
+        self.bucket = bucket
+        self.reset()
+
+    def reset(self):
+        self._t = np.empty(0)
+        self._v = np.empty(0)
+        self._k = np.empty(0, dtype=np.int64)
+        self._open = None  # index of the open bucket, everything before it is cached
+        self._merges = self.queue.merges
+
+    def set_bucket(self, bucket):
+        if bucket != self.bucket:
+            self.bucket = bucket
+            self.reset()
+
+    @staticmethod
+    def _reduce(k, t, v):
+        """min and max of every bucket as (t, v, k), each pair in time order"""
+        order = np.lexsort((v, k))
+        first = np.flatnonzero(np.diff(k[order], prepend=k[order][0] - 1))
+        low, high = order[first], order[np.append(first[1:], len(k)) - 1]
+        index = np.column_stack([np.minimum(low, high), np.maximum(low, high)]).ravel()
+        return t[index], v[index], k[index]
+
+    def __call__(self):
+        t, v = self.queue.time, self.queue.column(self.column)
+        if self.bucket is None or len(t) < 2 or len(t) <= 2 * (t[-1] - t[0]) / self.bucket + 2:
+            return t, v
+        if self.queue.merges != self._merges:
+            self.reset()
+        start = 0 if self._open is None else int(np.searchsorted(t, self._open * self.bucket, side="left"))
+        k = np.floor(t[start:] / self.bucket).astype(np.int64)
+        new_t, new_v, new_k = self._reduce(k, t[start:], v[start:])
+        done = new_k < k[-1]
+        first = int(np.floor(t[0] / self.bucket))
+        keep = self._k > first
+        head_t, head_v, head_k = np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+        if start > 0 and first < k[0]:
+            # eviction may have cut into the oldest cached bucket, so it is reduced again from what is left of it
+            stop = min(int(np.searchsorted(t, (first + 1) * self.bucket, side="right")) + 1, start)
+            bucket_k = np.floor(t[:stop] / self.bucket).astype(np.int64)
+            stop = int(np.searchsorted(bucket_k, first, side="right"))
+            head_t, head_v, head_k = self._reduce(bucket_k[:stop], t[:stop], v[:stop])
+        self._t = np.concatenate([head_t, self._t[keep], new_t[done]])
+        self._v = np.concatenate([head_v, self._v[keep], new_v[done]])
+        self._k = np.concatenate([head_k, self._k[keep], new_k[done]])
+        self._open = k[-1]
+        return np.concatenate([self._t, new_t[~done]]), np.concatenate([self._v, new_v[~done]])
 
 
 class IterableQueue(list):
@@ -59,40 +290,33 @@ class CapIterableQueue(IterableQueue):
 
 
 class CapDisplayDataQueue(RotationalDataQueue):
-    def __init__(self, window_size):
-        super(CapDisplayDataQueue, self).__init__(window_size)
-
-    @property
-    def cap(self):
-        return np.array([d.cap for d in self if d is not None])
+    COLUMNS = ("cap",)
+    EXTREMA = ("cap",)
 
-    @property
-    def acc(self):
-        return np.array([d.acc for d in self if d is not None])
-
-    @property
-    def gyro(self):
-        return np.array([d.gyro for d in self if d is not None])
+    def __init__(self, window_size, capacity=None):
+        super(CapDisplayDataQueue, self).__init__(window_size, capacity)
 
     @property
-    def mag(self):
-        return np.array([d.mag for d in self if d is not None])
+    def cap(self):
+        return self.column("cap")
 
 
 class IMUDisplayDataQueue(RotationalDataQueue):
-    def __init__(self, window_size):
-        super(IMUDisplayDataQueue, self).__init__(window_size)
+    COLUMNS = ("x", "y", "z")
+
+    def __init__(self, window_size, capacity=None):
+        super(IMUDisplayDataQueue, self).__init__(window_size, capacity)
         self._min_time = 0
         self._prev_min_time = 0
 
     @property
     def x(self):
-        return np.array([d.x for d in self if d is not None])
+        return self.column("x")
 
     @property
     def y(self):
-        return np.array([d.y for d in self if d is not None])
+        return self.column("y")
 
     @property
     def z(self):
-        return np.array([d.z for d in self if d is not None])
+        return self.column("z")
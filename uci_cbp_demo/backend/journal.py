@@ -0,0 +1,80 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+import os
+import time
+from pathlib import Path
+
+from uci_cbp_demo.logging import logger
+
+
+class GroupCommit:
+    """fsyncs a set of files at most once per interval, so at most `interval` seconds of written data can be lost"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.syncs = 0
+        self._last_sync = time.monotonic()
+
+    @property
+    def due(self):
+        return time.monotonic() - self._last_sync >= self.interval
+
+    def commit(self, *files):
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+        self.syncs += 1
+        self._last_sync = time.monotonic()
+
+    def maybe_commit(self, *files):
+        if self.due:
+            self.commit(*files)
+
+
+def repair_text(path):
+    """Drop a partially written last line; returns the number of bytes removed"""
+    path = Path(path)
+    if not path.is_file():
+        return 0
+    size = path.stat().st_size
+    with open(path, "rb+") as f:
+        end = size
+        while end > 0:
+            f.seek(max(end - 65536, 0))
+            chunk = f.read(end - max(end - 65536, 0))
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                end = max(end - 65536, 0) + newline + 1
+                break
+            end = max(end - 65536, 0)
+        f.truncate(end)
+    return size - end
+
+
+def repair_fixed(path, record_size):
+    """Drop a partially written trailing record of a fixed-size record file; returns the number of bytes removed"""
+    path = Path(path)
+    if not path.is_file():
+        return 0
+    size = path.stat().st_size
+    extra = size % record_size
+    if extra:
+        with open(path, "rb+") as f:
+            f.truncate(size - extra)
+    return extra
+
+
+def recover_session(directory):
+    """Repair the files of a session that was not closed cleanly so every reader sees only complete records"""
+    from uci_cbp_demo.backend.raw_capture import RawCaptureWriter, CAPTURE_DTYPE, INDEX_DTYPE
+    from uci_cbp_demo.backend.session_store import ChunkedSessionWriter
+
+    directory = Path(directory)
+    removed = sum(repair_text(path) for path in directory.glob("*.tsv"))
+    removed += repair_fixed(directory / RawCaptureWriter.DATA_FILE, CAPTURE_DTYPE.itemsize)
+    removed += repair_fixed(directory / RawCaptureWriter.INDEX_FILE, INDEX_DTYPE.itemsize)
+    store = directory / "store"
+    if store.is_dir():
+        removed += ChunkedSessionWriter.repair(store)
+    logger.info(f"Recovered {directory} ({removed} bytes of incomplete records removed)")
+    return removed
@@ -0,0 +1,392 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+from collections import deque
+
+import numpy as np
+from scipy import signal
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SampleBlock
+from uci_cbp_demo.backend.bluetooth.constants import CUTOFF, STOP_ATTEN, TARGET_FS
+from uci_cbp_demo.logging import logger
+
+
+class ProcessedBlock:
+    """Signals on the uniform TARGET_FS grid: a time column plus named float columns of the same length
+
+    NaN marks grid points a signal cannot provide (channel disabled, gap in the data, filter still settling).
+    """
+    __slots__ = ("time", "columns")
+
+    def __init__(self, time=None, columns: dict = None):
+        self.time = np.empty(0) if time is None else np.asarray(time, dtype=np.float64)
+        self.columns = {} if columns is None else columns
+
+    @classmethod
+    def empty(cls, names=()):
+        return cls(np.empty(0), {name: np.empty(0) for name in names})
+
+    @classmethod
+    def concatenate(cls, blocks):
+        blocks = [b for b in blocks if len(b)]
+        if not blocks:
+            return cls.empty()
+        names = list(dict.fromkeys(name for b in blocks for name in b.columns))
+        return cls(np.concatenate([b.time for b in blocks]),
+                   {name: np.concatenate([b.columns.get(name, np.full(len(b), np.nan)) for b in blocks])
+                    for name in names})
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    @property
+    def nbytes(self):
+        return self.time.nbytes + sum(v.nbytes for v in self.columns.values())
+
+    def valid(self, name):
+        """time and values of column `name` where it is not NaN"""
+        values = self.columns[name]
+        keep = ~np.isnan(values)
+        return self.time[keep], values[keep]
+
+    def __len__(self):
+        return len(self.time)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        self.columns[name] = values
+
+    def __repr__(self):
+        return f"ProcessedBlock({len(self)} rows, {self.names})"
+
+
+class ChannelAligner:
+    """Joins the cap1 and cap2 notification streams into rows on one uniform time grid
+
+    Each channel keeps only the samples needed to interpolate grid points that have not been emitted yet. A grid point
+    is emitted once every channel has data past it, or max_delay seconds after the newest sample of any channel when
+    one of them stays silent (that channel then reads NaN). Grid points inside a gap longer than max_gap are NaN
+    rather than interpolated across.
+    """
+
+    def __init__(self, fs=TARGET_FS, channels=(1, 2), max_delay=0.5, max_gap=None):
+        self.ts = 1 / fs
+        self.channels = tuple(channels)
+        self.max_delay = max_delay
+        self.max_gap = 4 * self.ts if max_gap is None else max_gap
+        self.reset()
+
+    @property
+    def names(self):
+        return [f"cap{c}" for c in self.channels]
+
+    def set_channels(self, channels):
+        """Wait only for the enabled channels; a disabled one would otherwise delay every row by max_delay"""
+        self.channels = tuple(channels)
+        self.reset()
+
+    def reset(self):
+        self._time = {c: np.empty(0) for c in self.channels}
+        self._cap = {c: np.empty(0) for c in self.channels}
+        self._next = None  # index of the next grid point, grid point k sits at k * ts
+
+    def _append(self, c, t, v):
+        t, v = np.concatenate([self._time[c], t]), np.concatenate([self._cap[c], v])
+        if len(t) > 1 and np.any(t[1:] < t[:-1]):
+            order = np.argsort(t, kind="stable")
+            t, v = t[order], v[order]
+        self._time[c], self._cap[c] = t, v
+
+    def _interp(self, c, grid):
+        t, v = self._time[c], self._cap[c]
+        if len(t) == 0:
+            return np.full(len(grid), np.nan)
+        values = np.interp(grid, t, v, left=np.nan, right=np.nan)
+        if len(t) > 1:
+            j = np.clip(np.searchsorted(t, grid), 1, len(t) - 1)
+            values[(t[j] - t[j - 1]) > self.max_gap] = np.nan
+        return values
+
+    def put(self, block: "SampleBlock") -> "ProcessedBlock":
+        for c in self.channels:
+            mine = block.channel == c
+            if np.any(mine):
+                self._append(c, block.time[mine], block.cap[mine])
+        last = [self._time[c][-1] for c in self.channels if len(self._time[c])]
+        if not last:
+            return ProcessedBlock.empty(self.names)
+        horizon = max(last) - self.max_delay
+        if len(last) == len(self.channels):
+            horizon = max(horizon, min(last))
+        if self._next is None:
+            self._next = int(np.ceil(min(self._time[c][0] for c in self.channels if len(self._time[c])) / self.ts))
+        stop = int(np.floor(horizon / self.ts)) + 1
+        if stop <= self._next:
+            return ProcessedBlock.empty(self.names)
+        grid = np.arange(self._next, stop) * self.ts
+        self._next = stop
+        aligned = ProcessedBlock(grid, {f"cap{c}": self._interp(c, grid) for c in self.channels})
+        for c in self.channels:
+            # keep the last sample at or before the newest grid point as the left neighbour for the next one
+            keep = max(np.searchsorted(self._time[c], grid[-1], side="right") - 1, 0)
+            self._time[c], self._cap[c] = self._time[c][keep:], self._cap[c][keep:]
+        return aligned
+
+
+def _runs(valid):
+    """(start, stop) of every run of True in a boolean array"""
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], valid, [False]]).astype(np.int8)))
+    return edges.reshape(-1, 2)
+
+
+class StreamingSOSFilter:
+    """Chebyshev type II low-pass (stop band from CUTOFF, STOP_ATTEN dB down) applied batch by batch
+
+    Each filtered column keeps its second-order-section state between batches, so consecutive blocks filter exactly
+    like one long signal. The state starts, and restarts after a NaN gap, at the steady state of the first valid
+    sample to avoid a step transient. Output goes to a `<column>_filtered` column.
+    """
+
+    def __init__(self, columns=("cap1", "cap2"), cutoff=CUTOFF, stop_atten=STOP_ATTEN, fs=TARGET_FS, order=4):
+        self.columns = tuple(columns)
+        self.sos = signal.cheby2(order, stop_atten, cutoff, btype="lowpass", output="sos", fs=fs)
+        self._zi_step = signal.sosfilt_zi(self.sos)
+        self._zi = {}
+
+    def set_columns(self, columns):
+        self.columns = tuple(columns)
+        self._zi = {c: zi for c, zi in self._zi.items() if c in self.columns}
+
+    def reset(self):
+        self._zi = {}
+
+    def filter(self, name, values):
+        out = np.full(len(values), np.nan)
+        zi = self._zi.get(name)
+        for start, stop in _runs(~np.isnan(values)):
+            if start > 0 or zi is None:
+                zi = self._zi_step * values[start]
+            out[start:stop], zi = signal.sosfilt(self.sos, values[start:stop], zi=zi)
+        # the state only carries over into the next batch if the batch ends on a valid sample; an empty batch keeps it
+        if len(values):
+            self._zi[name] = None if np.isnan(values[-1]) else zi
+        return out
+
+    def process(self, block: "ProcessedBlock") -> "ProcessedBlock":
+        for name in self.columns:
+            if name in block:
+                block[f"{name}_filtered"] = self.filter(name, block[name])
+        return block
+
+
+class BeatDetector:
+    """Online heartbeat detector on one aligned (preferably low-passed) cap column
+
+    A beat is the steepest point of a pulse upstroke: a local maximum of the first difference that exceeds
+    threshold_ratio times an exponentially averaged level of the previous beats' slopes and comes at least refractory
+    seconds after the last beat. The level halves every max_ibi seconds without a beat so the detector re-acquires
+    after the signal weakens. Only the slope maxima are visited in Python, so the work per sample is O(1).
+
+    Adds `beat_ibi` (inter-beat interval in seconds on the row that confirms a beat, one sample after it; NaN
+    elsewhere) and `pulse_rate` (beats per minute from the averaged interval, held between beats) columns. Exact beat
+    times are kept in `beats`.
+    """
+
+    def __init__(self, column="cap1", polarity=1, threshold_ratio=0.5, refractory=0.3, max_ibi=2.0, alpha=0.125):
+        self.column = column
+        self.polarity = polarity
+        self.threshold_ratio = threshold_ratio
+        self.refractory = refractory
+        self.max_ibi = max_ibi
+        self.alpha = alpha
+        self.beats = deque(maxlen=64)  # (time, ibi) of the most recent beats
+        self.reset()
+
+    def reset(self):
+        self._last_value = np.nan
+        self._last_slope = np.full(2, np.nan)
+        self._last_time = np.nan
+        self._level = None
+        self._level_time = None
+        self._last_beat = None
+        self._ibi = None
+        self.beats.clear()
+
+    @property
+    def pulse_rate(self):
+        return np.nan if self._ibi is None else 60 / self._ibi
+
+    def _source(self, block):
+        for name in [f"{self.column}_filtered", self.column]:
+            if name in block:
+                return block[name]
+        return None
+
+    def _accept(self, t, slope):
+        if self._level is None:
+            self._level, self._level_time = slope, t
+            return False
+        if self._last_beat is not None and t - self._last_beat < self.refractory:
+            return False
+        halvings = int((t - self._level_time) // self.max_ibi)
+        if halvings:
+            self._level *= 0.5 ** halvings
+            self._level_time += halvings * self.max_ibi
+        if slope < self.threshold_ratio * self._level:
+            return False
+        self._level += self.alpha * (slope - self._level)
+        self._level_time = t
+        return True
+
+    def process(self, block: "ProcessedBlock") -> "ProcessedBlock":
+        values = self._source(block)
+        ibi = np.full(len(block), np.nan)
+        rate = np.full(len(block), np.nan)
+        if values is not None and len(block):
+            # slope j is the difference into sample j; the last two slopes of the previous batch are carried along
+            # so a peak on the batch boundary is still found
+            padded = np.concatenate([self._last_slope, self.polarity * np.diff(values, prepend=self._last_value)])
+            times = np.concatenate([[self._last_time], block.time])
+            peak = (padded[1:-1] > padded[:-2]) & (padded[1:-1] >= padded[2:]) & (padded[1:-1] > 0)
+            held = 0
+            # peak i is the slope into sample i - 1 and is confirmed by sample i, the row its interval is written to
+            for row in np.flatnonzero(peak):
+                t = times[row]
+                if np.isnan(t) or not self._accept(t, padded[row + 1]):
+                    continue
+                if row > held:
+                    rate[held:row] = self.pulse_rate
+                    held = row
+                if self._last_beat is not None and t - self._last_beat <= self.max_ibi:
+                    interval = t - self._last_beat
+                    self._ibi = interval if self._ibi is None else self._ibi + self.alpha * (interval - self._ibi)
+                    self.beats.append((t, interval))
+                    ibi[row] = interval
+                self._last_beat = t
+            rate[held:] = self.pulse_rate
+            self._last_value = values[-1]
+            self._last_slope = padded[-2:]
+            self._last_time = block.time[-1]
+        block["beat_ibi"], block["pulse_rate"] = ibi, rate
+        return block
+
+
+class PulseTransitEstimator:
+    """Pulse transit time between two aligned cap columns from a sliding FFT cross-correlation
+
+    Every hop seconds the last window seconds of both (preferably low-passed) signals are mean-removed, copied into
+    zero-padded buffers allocated once, and cross-correlated through one rfft/irfft pair; the lag of the correlation
+    peak within +/- max_lag, refined by a parabola through its neighbours, is the delay of the second column behind
+    the first. The cost per hop is fixed by the window, independent of the batch sizes.
+
+    Adds a `ptt` column (seconds, held between hops, NaN until the first full window or while it contains a gap).
+    """
+
+    def __init__(self, columns=("cap1", "cap2"), fs=TARGET_FS, window=4.0, hop=0.5, max_lag=0.5):
+        self.columns = tuple(columns)
+        self.fs = fs
+        self.window_rows = int(round(window * fs))
+        self.hop_rows = min(max(int(round(hop * fs)), 1), self.window_rows)
+        self.max_lag_rows = min(int(round(max_lag * fs)), self.window_rows - 1)
+        nfft = 1 << int(np.ceil(np.log2(self.window_rows + self.max_lag_rows)))
+        self._padded = np.zeros((2, nfft))
+        # circular correlation indices of lags -max_lag_rows .. +max_lag_rows
+        self._lag_index = np.arange(-self.max_lag_rows, self.max_lag_rows + 1) % nfft
+        self.estimates = deque(maxlen=256)  # (time, ptt) of the most recent hops
+        self.reset()
+
+    def reset(self):
+        self._buffer = np.full((2, 2 * self.window_rows), np.nan)
+        self._stop = 0
+        self._since_hop = 0
+        self.ptt = np.nan
+        self.estimates.clear()
+
+    def _sources(self, block):
+        sources = []
+        for column in self.columns:
+            names = [name for name in [f"{column}_filtered", column] if name in block]
+            if not names:
+                return None
+            sources.append(block[names[0]])
+        return np.vstack(sources)
+
+    def _append(self, values):
+        n = values.shape[1]
+        if self._stop + n > self._buffer.shape[1]:
+            keep = min(self._stop, self.window_rows)
+            self._buffer[:, :keep] = self._buffer[:, self._stop - keep:self._stop]
+            self._stop = keep
+        self._buffer[:, self._stop:self._stop + n] = values
+        self._stop += n
+
+    def _estimate(self):
+        if self._stop < self.window_rows:
+            return np.nan
+        window = self._buffer[:, self._stop - self.window_rows:self._stop]
+        if np.isnan(window).any():
+            return np.nan
+        self._padded[:, :self.window_rows] = window - window.mean(axis=1, keepdims=True)
+        spectrum = np.fft.rfft(self._padded, axis=1)
+        correlation = np.fft.irfft(np.conj(spectrum[0]) * spectrum[1], n=self._padded.shape[1])[self._lag_index]
+        k = int(np.argmax(correlation))
+        offset = 0.0
+        if 0 < k < len(correlation) - 1:
+            left, center, right = correlation[k - 1:k + 2]
+            curvature = left - 2 * center + right
+            if curvature < 0:
+                offset = 0.5 * (left - right) / curvature
+        return (k - self.max_lag_rows + offset) / self.fs
+
+    def process(self, block: "ProcessedBlock") -> "ProcessedBlock":
+        values = self._sources(block)
+        ptt = np.full(len(block), np.nan)
+        if values is None:
+            block["ptt"] = ptt
+            return block
+        start = 0
+        while start < len(block):
+            n = min(len(block) - start, self.hop_rows - self._since_hop)
+            self._append(values[:, start:start + n])
+            ptt[start:start + n] = self.ptt
+            start += n
+            self._since_hop += n
+            if self._since_hop == self.hop_rows:
+                self._since_hop = 0
+                self.ptt = self._estimate()
+                ptt[start - 1] = self.ptt
+                if not np.isnan(self.ptt):
+                    self.estimates.append((block.time[start - 1], self.ptt))
+        block["ptt"] = ptt
+        return block
+
+
+class ProcessingPipeline:
+    """Aligns incoming SampleBlocks onto the TARGET_FS grid and runs the derived-signal stages over the result
+
+    A stage is any object with process(ProcessedBlock) -> ProcessedBlock; stages run in order and usually add columns.
+    """
+
+    def __init__(self, aligner: "ChannelAligner" = None, stages=()):
+        self.aligner = ChannelAligner() if aligner is None else aligner
+        self.stages = list(stages)
+
+    def put(self, block: "SampleBlock") -> "ProcessedBlock":
+        processed = self.aligner.put(block)
+        if len(processed) == 0:
+            return processed
+        for stage in self.stages:
+            processed = stage.process(processed)
+        logger.debug(f"{processed}")
+        return processed
+
+    def reset(self):
+        self.aligner.reset()
+        for stage in self.stages:
+            if hasattr(stage, "reset"):
+                stage.reset()
@@ -0,0 +1,121 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from uci_cbp_demo.backend.bluetooth.callbacks import PACKET_DTYPE, SampleBlock, decode_packets
+from uci_cbp_demo.backend.journal import GroupCommit, repair_fixed
+from uci_cbp_demo.logging import logger
+
+# One record per notification payload, exactly as received from the board
+CAPTURE_DTYPE = np.dtype([("rx_time_ns", "<i8"), ("rx_monotonic_ns", "<i8"), ("channel", "u1"),
+                          ("payload", "u1", (PACKET_DTYPE.itemsize,))])
+# Every INDEX_EVERY-th record number with its monotonic receive time, so readers can bisect without touching the data
+# file; the wall clock may step backwards during a capture, the monotonic clock never does
+INDEX_DTYPE = np.dtype([("record", "<i8"), ("rx_monotonic_ns", "<i8")])
+
+
+class RawCaptureWriter:
+    """Appends notification payloads to capture.bin and every index_every-th record to capture.idx
+
+    write() runs in the notification callback and only buffers; a committer thread flushes and fsyncs both files
+    every fsync_interval seconds, so the event loop never waits on the disk.
+    """
+    DATA_FILE = "capture.bin"
+    INDEX_FILE = "capture.idx"
+    INDEX_EVERY = 1024
+
+    def __init__(self, output_directory, index_every=INDEX_EVERY, fsync_interval=1.0):
+        self._output_directory = Path(output_directory)
+        self._output_directory.mkdir(parents=True, exist_ok=True)
+        self.index_every = index_every
+        # appending after a torn record would shift every later one, so cut it off first
+        repair_fixed(self._output_directory / self.DATA_FILE, CAPTURE_DTYPE.itemsize)
+        repair_fixed(self._output_directory / self.INDEX_FILE, INDEX_DTYPE.itemsize)
+        self._data = open(self._output_directory / self.DATA_FILE, "ab")
+        self._index = open(self._output_directory / self.INDEX_FILE, "ab")
+        self.records = self._data.tell() // CAPTURE_DTYPE.itemsize
+        self.group_commit = GroupCommit(fsync_interval)
+        self._closed = threading.Event()
+        self._committer = threading.Thread(target=self._run, name="RawCaptureCommitter", daemon=True)
+        self._committer.start()
+        logger.info(f"Capturing raw notifications to {self._output_directory / self.DATA_FILE}")
+
+    def write(self, channel, rx_monotonic_ns, rx_time_ns, bytes_array):
+        payloads = np.frombuffer(bytes_array, dtype=np.uint8).reshape(-1, PACKET_DTYPE.itemsize)
+        records = np.empty(len(payloads), dtype=CAPTURE_DTYPE)
+        records["rx_time_ns"] = rx_time_ns
+        records["rx_monotonic_ns"] = rx_monotonic_ns
+        records["channel"] = channel
+        records["payload"] = payloads
+        first, self.records = self.records, self.records + len(records)
+        indexed = np.arange(-(-first // self.index_every) * self.index_every, self.records, self.index_every)
+        if len(indexed):
+            index = np.empty(len(indexed), dtype=INDEX_DTYPE)
+            index["record"] = indexed
+            index["rx_monotonic_ns"] = records["rx_monotonic_ns"][indexed - first]
+            self._index.write(index.tobytes())
+        self._data.write(records.tobytes())
+
+    def _run(self):
+        while not self._closed.wait(self.group_commit.interval):
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f"Failed to commit the raw capture: {e}")
+
+    def flush(self):
+        self.group_commit.commit(self._data, self._index)
+
+    def close(self):
+        self._closed.set()
+        self._committer.join()
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+
+class RawCaptureReader:
+    """Memory-maps a capture written by RawCaptureWriter; only the pages covering a requested range are read"""
+
+    def __init__(self, directory):
+        directory = Path(directory)
+        data_file = directory / RawCaptureWriter.DATA_FILE
+        n = data_file.stat().st_size // CAPTURE_DTYPE.itemsize
+        if n:
+            self.records = np.memmap(data_file, dtype=CAPTURE_DTYPE, mode="r", shape=(n,))
+        else:
+            self.records = np.empty(0, dtype=CAPTURE_DTYPE)
+        index_file = directory / RawCaptureWriter.INDEX_FILE
+        self.index = np.fromfile(index_file, dtype=INDEX_DTYPE) if index_file.is_file() else np.empty(0, INDEX_DTYPE)
+        self.index = self.index[self.index["record"] < n]
+        # epoch minus monotonic nanoseconds at the first record, to map wall-clock query bounds onto rx_monotonic_ns
+        self.clock_offset_ns = int(self.records["rx_time_ns"][0] - self.records["rx_monotonic_ns"][0]) if n else 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def _locate(self, rx_monotonic_ns, lo, hi):
+        if rx_monotonic_ns is None:
+            return None
+        i = np.searchsorted(self.index["rx_monotonic_ns"], rx_monotonic_ns, side="left")
+        if i > 0:
+            lo = max(lo, int(self.index["record"][i - 1]))
+        if i < len(self.index):
+            hi = min(hi, int(self.index["record"][i]))
+        return lo + int(np.searchsorted(self.records["rx_monotonic_ns"][lo:hi], rx_monotonic_ns, side="left"))
+
+    def read(self, start_ns=None, stop_ns=None):
+        """Records received in [start_ns, stop_ns) (epoch nanoseconds, as of the clock when the capture started)"""
+        start_ns, stop_ns = [None if t is None else t - self.clock_offset_ns for t in (start_ns, stop_ns)]
+        lo = self._locate(start_ns, 0, len(self))
+        hi = self._locate(stop_ns, 0 if lo is None else lo, len(self))
+        return self.records[lo:hi]
+
+    def read_samples(self, start_ns=None, stop_ns=None, no_imu=False):
+        records = self.read(start_ns, stop_ns)
+        columns = decode_packets(np.ascontiguousarray(records["payload"]).tobytes(), no_imu=no_imu)
+        return SampleBlock(columns["time"], records["channel"], columns["cap"], columns.get("acc"),
+                           columns.get("gyro"), columns.get("mag"), records["rx_monotonic_ns"], records["rx_time_ns"])
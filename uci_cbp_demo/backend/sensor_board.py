@@ -1,6 +1,8 @@
 #  MIT License
 #  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
 import logging
+import signal
+import sys
 
 from .bluetooth.callbacks import CapCallback
 from .bluetooth.utils import start_notify_uuid, run_until_complete
@@ -17,7 +19,14 @@ class SensorBoard:
     async def _notify(self, loop, callbacks, wait_time=None):
         await start_notify_uuid(self.addr, loop, self.pipe, callbacks, wait_time)
 
-    def start_session(self, queues=None, wait_time=None):
+    def start_session(self, queues=None, wait_time=None, transport=None):
         logger.info("Setting Up Bluetooth")
-        callback = CapCallback(queue=queues)
-        run_until_complete(self._notify, callback, wait_time)
+        callback = CapCallback(queue=queues, transport=transport)
+        # the GUI stops this process with terminate(); unwind normally so the raw capture gets closed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            run_until_complete(self._notify, callback, wait_time)
+        finally:
+            callback.flush()
+            if callback.raw_capture is not None:
+                callback.raw_capture.close()
@@ -0,0 +1,176 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+import json
+import lzma
+import os
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SampleBlock
+from uci_cbp_demo.logging import logger
+
+# column name -> (dtype, per-row shape, delta encoded)
+STORE_COLUMNS = {"time": ("<f8", (), False),
+                 "channel": ("i1", (), False),
+                 "cap": ("<f4", (), False),
+                 "acc": ("<f4", (3,), False),
+                 "gyro": ("<f4", (3,), False),
+                 "mag": ("<f4", (3,), False),
+                 "rx_monotonic_ns": ("<i8", (), True),
+                 "rx_time_ns": ("<i8", (), True)}
+
+CODECS = {"none": (lambda b: b, lambda b: b),
+          "zlib": (zlib.compress, zlib.decompress),
+          "lzma": (lzma.compress, lzma.decompress)}
+
+
+class ChunkedSessionWriter:
+    """Writes SampleBlocks as per-column chunk files plus a manifest.json with per-chunk row count and time range
+
+    Integer columns are delta encoded before compression. A chunk is written once chunk_rows rows are pending or the
+    oldest pending row is chunk_interval seconds old; its files are fsynced before the manifest is replaced atomically,
+    so chunk files the manifest does not list are leftovers of an interrupted write and are ignored by readers.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory, chunk_rows=4096, codec="zlib", chunk_interval=10.0):
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec {codec}, expected one of {list(CODECS)}")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.chunk_rows = chunk_rows
+        self.chunk_interval = chunk_interval
+        self.codec = codec
+        self._pending = []
+        self._pending_rows = 0
+        self._pending_since = None
+        manifest = self.directory / self.MANIFEST
+        if manifest.is_file():
+            self.manifest = json.loads(manifest.read_text())
+            self.codec = self.manifest["codec"]
+        else:
+            self.manifest = {"version": 1, "codec": codec, "chunks": [],
+                             "columns": {k: {"dtype": d, "shape": list(s), "delta": delta}
+                                         for k, (d, s, delta) in STORE_COLUMNS.items()}}
+
+    def put(self, block: "SampleBlock"):
+        if len(block) == 0:
+            return
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        self._pending.append(block)
+        self._pending_rows += len(block)
+        if self._pending_rows >= self.chunk_rows:
+            self.flush()
+        else:
+            self.tick()
+
+    def tick(self):
+        if self._pending_since is not None and time.monotonic() - self._pending_since >= self.chunk_interval:
+            self.flush()
+
+    def _encode(self, name, values):
+        dtype, shape, delta = STORE_COLUMNS[name]
+        values = np.ascontiguousarray(values, dtype=dtype)
+        if delta:
+            values = np.diff(values, prepend=values.dtype.type(0))
+        return CODECS[self.codec][0](values.tobytes())
+
+    def flush(self):
+        if self._pending_rows == 0:
+            return
+        block = SampleBlock.concatenate(self._pending)
+        self._pending, self._pending_rows, self._pending_since = [], 0, None
+        chunk_id = len(self.manifest["chunks"])
+        for name in STORE_COLUMNS:
+            with open(self.directory / f"{name}.{chunk_id:06d}", "wb") as f:
+                f.write(self._encode(name, getattr(block, name)))
+                f.flush()
+                os.fsync(f.fileno())
+        self.manifest["chunks"].append({"id": chunk_id, "rows": len(block),
+                                        "t_min": float(block.time.min()), "t_max": float(block.time.max()),
+                                        "rx_time_ns_min": int(block.rx_time_ns.min()),
+                                        "rx_time_ns_max": int(block.rx_time_ns.max())})
+        self._write_manifest()
+
+    def _write_manifest(self):
+        tmp = self.directory / (self.MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(json.dumps(self.manifest))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.directory / self.MANIFEST)
+
+    @classmethod
+    def repair(cls, directory):
+        """Delete chunk files not listed in the manifest; returns the number of bytes removed"""
+        directory = Path(directory)
+        manifest = directory / cls.MANIFEST
+        n_chunks = len(json.loads(manifest.read_text())["chunks"]) if manifest.is_file() else 0
+        removed = 0
+        for f in directory.iterdir():
+            name, _, suffix = f.name.rpartition(".")
+            orphan = name in STORE_COLUMNS and suffix.isdigit() and int(suffix) >= n_chunks
+            if orphan or f.name == cls.MANIFEST + ".tmp":
+                removed += f.stat().st_size
+                f.unlink()
+        return removed
+
+    def close(self):
+        self.flush()
+
+
+class ChunkedSessionReader:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.manifest = json.loads((self.directory / ChunkedSessionWriter.MANIFEST).read_text())
+        self.chunks = self.manifest["chunks"]
+        self._decompress = CODECS[self.manifest["codec"]][1]
+
+    def __len__(self):
+        return sum(c["rows"] for c in self.chunks)
+
+    @property
+    def columns(self):
+        return list(self.manifest["columns"])
+
+    def _load(self, name, chunk):
+        spec = self.manifest["columns"][name]
+        with open(self.directory / f"{name}.{chunk['id']:06d}", "rb") as f:
+            values = np.frombuffer(self._decompress(f.read()), dtype=spec["dtype"])
+        if spec["delta"]:
+            values = np.cumsum(values, dtype=values.dtype)
+        return values.reshape((chunk["rows"], *spec["shape"]))
+
+    def read(self, columns=None, start=None, stop=None):
+        """Columns for rows with start <= time < stop, decompressing only the chunks that overlap the range"""
+        columns = self.columns if columns is None else list(columns)
+        chunks = [c for c in self.chunks
+                  if (start is None or c["t_max"] >= start) and (stop is None or c["t_min"] < stop)]
+        logger.debug(f"Reading {columns} from {len(chunks)}/{len(self.chunks)} chunks")
+        load = columns if (start is None and stop is None) or "time" in columns else columns + ["time"]
+        parts = {name: [] for name in load}
+        for chunk in chunks:
+            data = {name: self._load(name, chunk) for name in load}
+            if start is not None or stop is not None:
+                keep = np.ones(chunk["rows"], dtype=bool)
+                if start is not None:
+                    keep &= data["time"] >= start
+                if stop is not None:
+                    keep &= data["time"] < stop
+                data = {name: values[keep] for name, values in data.items()}
+            for name in load:
+                parts[name].append(data[name])
+        result = {}
+        for name in columns:
+            spec = self.manifest["columns"][name]
+            result[name] = np.concatenate(parts[name]) if parts[name] else \
+                np.empty((0, *spec["shape"]), dtype=spec["dtype"])
+        return result
+
+    def read_samples(self, start=None, stop=None):
+        data = self.read(start=start, stop=stop)
+        return SampleBlock(*[data[c] for c in SampleBlock.__slots__])
@@ -0,0 +1,139 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+import numpy as np
+from scipy.signal import lfilter
+
+
+class RunningStats:
+    """Count, mean, variance, min and max of a stream, merged one batch at a time (Welford/Chan) and read in O(1)"""
+    __slots__ = ("count", "mean", "_m2", "min", "max")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = np.nan
+        self._m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        n = len(values)
+        if n == 0:
+            return self
+        mean = values.mean()
+        m2 = np.square(values - mean).sum()
+        if self.count == 0:
+            self.mean, self._m2 = mean, m2
+        else:
+            total = self.count + n
+            delta = mean - self.mean
+            self.mean += delta * n / total
+            self._m2 += m2 + delta ** 2 * self.count * n / total
+        self.count += n
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        return self
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def to_dict(self):
+        return {"count": self.count, "mean": self.mean, "std": self.std, "min": self.min, "max": self.max}
+
+
+class EWMA:
+    """Exponentially weighted mean and variance with smoothing factor alpha (span N gives alpha = 2 / (N + 1))
+
+    A batch is folded in with two first-order IIR filters, so no Python loop runs per value; batches shorter than
+    SMALL_BATCH run the same recurrence in plain Python, which is cheaper than setting up the filters.
+    """
+    __slots__ = ("alpha", "mean", "variance", "count")
+    SMALL_BATCH = 32
+
+    def __init__(self, alpha=None, span=100):
+        self.alpha = 2 / (span + 1) if alpha is None else alpha
+        self.reset()
+
+    def reset(self):
+        self.mean = np.nan
+        self.variance = 0.0
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return self
+        a = self.alpha
+        if self.count == 0:
+            self.mean = values[0]
+        if len(values) < self.SMALL_BATCH:
+            mean, variance = float(self.mean), self.variance
+            for x in values.tolist():
+                d = x - mean
+                mean += a * d
+                variance = (1 - a) * (variance + a * d * d)
+            self.mean, self.variance = mean, variance
+            self.count += len(values)
+            return self
+        # mean_i = (1 - a) mean_{i-1} + a x_i
+        means, _ = lfilter([a], [1, a - 1], values, zi=[(1 - a) * self.mean])
+        previous = np.concatenate([[self.mean], means[:-1]])
+        # var_i = (1 - a) (var_{i-1} + a (x_i - mean_{i-1})^2)
+        variances, _ = lfilter([1 - a], [1, a - 1], a * np.square(values - previous), zi=[(1 - a) * self.variance])
+        self.mean, self.variance = means[-1], variances[-1]
+        self.count += len(values)
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class RateMeter:
+    """Effective sample rate and timing jitter of a stream of sample timestamps (seconds)
+
+    Only forward steps count as intervals, so duplicated or reordered timestamps do not skew the estimate. `rate` and
+    `jitter` follow the recent intervals (EWMA over about `span` of them); `intervals` keeps whole-stream statistics.
+    """
+
+    def __init__(self, span=100):
+        self.interval = EWMA(span=span)
+        self.intervals = RunningStats()
+        self._last = None
+
+    def reset(self):
+        self.interval.reset()
+        self.intervals.reset()
+        self._last = None
+
+    def update(self, times):
+        times = np.asarray(times, dtype=np.float64)
+        if len(times) == 0:
+            return self
+        # each step is taken from the newest time seen so far, so a chunked stream gives the same steps as a whole one
+        newest = np.maximum.accumulate(np.concatenate([[times[0] if self._last is None else self._last], times]))
+        steps = times - newest[:-1]
+        steps = steps[steps > 0]
+        self.interval.update(steps)
+        self.intervals.update(steps)
+        self._last = newest[-1]
+        return self
+
+    @property
+    def rate(self):
+        return 1 / self.interval.mean if self.interval.count else np.nan
+
+    @property
+    def jitter(self):
+        return self.interval.std if self.interval.count > 1 else np.nan
+
+    def to_dict(self):
+        return {"rate": self.rate, "jitter": self.jitter, "intervals": self.intervals.count}
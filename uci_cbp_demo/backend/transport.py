@@ -0,0 +1,191 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+import multiprocessing
+import platform
+import time
+from queue import Empty
+
+import numpy as np
+
+from uci_cbp_demo.backend.bluetooth.callbacks import SampleBlock, SAMPLE_DTYPE
+from uci_cbp_demo.logging import logger
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+# Architectures with total store order, where SharedMemoryRing's unfenced index stores are safe
+TSO_MACHINES = {"x86_64", "amd64", "i386", "i686", "x86"}
+
+
+class TransportLag:
+    """How far behind the consumer was when it drained: pending samples and age of the oldest one (seconds)"""
+    __slots__ = ("depth", "remaining", "oldest_age")
+
+    def __init__(self, depth=0, remaining=0, oldest_age=0.0):
+        self.depth = depth
+        self.remaining = remaining
+        self.oldest_age = oldest_age
+
+    def __repr__(self):
+        return f"{self.depth} pending, {self.remaining} left, oldest {1000 * self.oldest_age:.1f} ms"
+
+
+def _age(rx_monotonic_ns):
+    return max(time.monotonic_ns() - int(rx_monotonic_ns), 0) / 1e9
+
+
+class QueueTransport:
+    """Moves SampleBlocks through one multiprocessing.Queue per cap channel (one pickle per block)
+
+    A shared counter of queued samples, raised before a block is queued and lowered once it is drained, reports lag
+    in samples like SharedMemoryRing does.
+    """
+
+    def __init__(self, queues: dict):
+        self.queues = queues
+        self._queued = multiprocessing.Value("q", 0)
+
+    def put(self, block: "SampleBlock"):
+        with self._queued.get_lock():
+            self._queued.value += len(block)
+        self.queues[f"cap{block.channel[0]}"].put(block)
+
+    def drain(self, max_items=None, time_budget=None):
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+        depth = self._queued.value
+        blocks, n = [], 0
+        exhausted = set()
+        while len(exhausted) < 2:
+            for ch in [1, 2]:
+                if ch in exhausted:
+                    continue
+                try:
+                    block = self.queues[f"cap{ch}"].get(block=False)
+                except Empty:
+                    exhausted.add(ch)
+                    continue
+                blocks.append(block)
+                n += len(block)
+            if (max_items is not None and n >= max_items) or (deadline is not None and time.perf_counter() > deadline):
+                break
+        with self._queued.get_lock():
+            self._queued.value -= n
+            remaining = self._queued.value
+        block = SampleBlock.concatenate(blocks)
+        oldest_age = _age(block.rx_monotonic_ns.min()) if len(block) else 0.0
+        return block, TransportLag(max(depth, n), remaining, oldest_age)
+
+    def get(self) -> "SampleBlock":
+        return self.drain()[0]
+
+    def close(self):
+        pass
+
+
+class SharedMemoryRing:
+    """Single-producer/single-consumer ring of SAMPLE_DTYPE records in multiprocessing.shared_memory
+
+    head (written by the producer only) and tail (written by the consumer only) are ever-increasing record counters,
+    each an aligned int64 on its own cache line, so publishing either one is a single store. The producer writes the
+    records before advancing head; the consumer copies everything between tail and head and then advances tail.
+    head and tail are published with plain numpy stores and no memory fence, so this relies on x86 TSO (total store
+    order): other cores see the payload stores before the index store that follows them. Weakly ordered CPUs such as
+    ARM do not give that guarantee, and the consumer could read records before they land, so default_transport()
+    only picks the ring on TSO_MACHINES.
+    Blocks that do not fit in the free space are truncated and counted in `dropped`; the first truncation and every
+    LOG_EVERY-th one after it are logged.
+    """
+    HEAD, TAIL, CAPACITY, DROPPED = 0, 8, 16, 24
+    HEADER_SIZE = 256
+    LOG_EVERY = 100
+
+    def __init__(self, capacity=1 << 15, name=None):
+        if shared_memory is None:
+            raise RuntimeError("SharedMemoryRing requires Python 3.8 or later")
+        self._owner = name is None
+        if self._owner:
+            size = self.HEADER_SIZE + capacity * SAMPLE_DTYPE.itemsize
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            # attaching processes are children of the owner and share its resource tracker, so the segment is only
+            # unlinked by the owner's close()
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._header = np.ndarray((self.HEADER_SIZE // 8,), dtype=np.int64, buffer=self._shm.buf)
+        if self._owner:
+            self._header[:] = 0
+            self._header[self.CAPACITY] = capacity
+        self.capacity = int(self._header[self.CAPACITY])
+        self._records = np.ndarray((self.capacity,), dtype=SAMPLE_DTYPE, buffer=self._shm.buf, offset=self.HEADER_SIZE)
+        self._truncations = 0
+
+    def __getstate__(self):
+        return {"name": self._shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(name=state["name"])
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def dropped(self):
+        return int(self._header[self.DROPPED])
+
+    def __len__(self):
+        return int(self._header[self.HEAD] - self._header[self.TAIL])
+
+    def _slices(self, start, n):
+        i = start % self.capacity
+        first = min(n, self.capacity - i)
+        return [(i, i + first, 0, first), (0, n - first, first, n)] if first < n else [(i, i + n, 0, n)]
+
+    def put(self, block: "SampleBlock"):
+        head = int(self._header[self.HEAD])
+        free = self.capacity - (head - int(self._header[self.TAIL]))
+        n = len(block)
+        if n > free:
+            self._header[self.DROPPED] += n - free
+            self._truncations += 1
+            if self._truncations == 1 or self._truncations % self.LOG_EVERY == 0:
+                logger.warning(f"Shared memory ring full, {self.dropped} samples dropped so far")
+            block, n = block.select(slice(0, free)), free
+        if n == 0:
+            return
+        records = block.to_records()
+        for a, b, c, d in self._slices(head, n):
+            self._records[a:b] = records[c:d]
+        self._header[self.HEAD] = head + n
+
+    def drain(self, max_items=None, time_budget=None):
+        # time_budget is accepted for interface parity; copying out of the ring is a single bounded memcpy
+        tail = int(self._header[self.TAIL])
+        depth = int(self._header[self.HEAD]) - tail
+        if depth == 0:
+            return SampleBlock.empty(), TransportLag()
+        oldest_age = _age(self._records[tail % self.capacity]["rx_monotonic_ns"])
+        n = depth if max_items is None else min(depth, max_items)
+        records = np.concatenate([self._records[a:b] for a, b, _, _ in self._slices(tail, n)])
+        self._header[self.TAIL] = tail + n
+        return SampleBlock.from_records(records), TransportLag(depth, depth - n, oldest_age)
+
+    def get(self) -> "SampleBlock":
+        return self.drain()[0]
+
+    def close(self):
+        self._header = None
+        self._records = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def default_transport(queues=None):
+    if shared_memory is not None and platform.machine().lower() in TSO_MACHINES:
+        return SharedMemoryRing()
+    if queues is None:
+        from multiprocessing import Queue
+        queues = {"cap1": Queue(), "cap2": Queue()}
+    return QueueTransport(queues)
@@ -27,9 +27,10 @@ def cli(debug=False):
 @click.option('--addr', default=None)
 @click.option('--ch1/--no-ch1', default=True)
 @click.option('--ch2/--no-ch2', default=True)
-def tui(addr=None, ch1=True, ch2=True):
+@click.option('--capture', default=None, help="Directory to capture raw notifications into")
+def tui(addr=None, ch1=True, ch2=True, capture=None):
     from uci_cbp_demo.ui import tui_main
-    tui_main(addr, ch1, ch2)
+    tui_main(addr, ch1, ch2, capture)
 
 
 @cli.command()
@@ -52,9 +53,40 @@ def list_char(addr):
 
 
 @cli.command()
-def gui():
+@click.option('--since', type=click.DateTime(), default=None, help="Sessions started at or after this time")
+@click.option('--until', type=click.DateTime(), default=None, help="Sessions started before this time")
+@click.option('--mac', default=None)
+@click.option('--channel', type=click.IntRange(1, 2), default=None, help="Sessions recording this cap channel")
+@click.option('--min-duration', type=float, default=None, help="Seconds")
+@click.option('--max-duration', type=float, default=None, help="Seconds")
+@click.option('--dac1', type=int, default=None)
+@click.option('--dac2', type=int, default=None)
+@click.option('--prefix', default=None)
+@click.option('--rescan', is_flag=True, help="Add session directories missing from the catalog first")
+def sessions(since=None, until=None, mac=None, channel=None, min_duration=None, max_duration=None, dac1=None,
+             dac2=None, prefix=None, rescan=False):
+    import datetime
+    from appdirs import user_data_dir
+    from uci_cbp_demo.backend.catalog import SessionCatalog
+    catalog = SessionCatalog(user_data_dir(uci_cbp_demo.__appname__, uci_cbp_demo.__author__))
+    if rescan:
+        catalog.scan()
+    for s in catalog.query(since=since, until=until, mac=mac, channel=channel, min_duration=min_duration,
+                           max_duration=max_duration, dac1=dac1, dac2=dac2, prefix=prefix):
+        started = datetime.datetime.fromtimestamp(s["started_ns"] / 1e9).isoformat(sep=" ", timespec="seconds")
+        duration = "open" if s["ended_ns"] is None else f"{s['duration'] or 0:.1f} s"
+        rates = "".join(f" cap{c}={s[f'cap{c}_rate']:.1f} Hz" for c in [1, 2] if s[f"cap{c}_rate"] is not None)
+        logger.info(f"{started} {duration} ch={s['channels']} mac={s['mac']} dac=({s['dac1']}, {s['dac2']}) "
+                    f"samples={s['samples']}{rates} {s['path']}")
+    catalog.close()
+
+
+@cli.command()
+@click.option('--backend', type=click.Choice(["matplotlib", "tk"]), default=None,
+              help="Plotting backend, overrides the preference for this run")
+def gui(backend=None):
     from uci_cbp_demo.ui import main
-    main()
+    main(backend)
 
 
 if __name__ == "__main__":
@@ -41,6 +41,20 @@ class StringDescriptor(Descriptor):
         return str(self.data)
 
 
+class FloatDescriptor(Descriptor):
+    data = 0.0
+
+    def __get__(self, instance, owner):
+        return float(self.data)
+
+
+class IntDescriptor(Descriptor):
+    data = 0
+
+    def __get__(self, instance, owner):
+        return int(self.data)
+
+
 class Section:
     @property
     def attributes(self):
@@ -81,6 +95,8 @@ class PlottingSection(Section):
     ch1_en = BooleanAsIntDescriptor(True)
     ch2_en = BooleanAsIntDescriptor(True)
     autoscale_cap = BooleanAsIntDescriptor(True)
+    target_fps = IntDescriptor(30)
+    backend = StringDescriptor("matplotlib")
 
 
 class BoardSection(Section):
@@ -90,6 +106,21 @@ class BoardSection(Section):
     dac2 = Descriptor(0)
 
 
+class RecordingSection(Section):
+    name = "recording"
+    raw_capture = BooleanAsIntDescriptor(False)
+    columnar_store = BooleanAsIntDescriptor(False)
+    fsync_interval = FloatDescriptor(1.0)
+    export_processed = BooleanAsIntDescriptor(False)
+
+
+class ProcessingSection(Section):
+    name = "processing"
+    filter_cap1 = BooleanAsIntDescriptor(True)
+    filter_cap2 = BooleanAsIntDescriptor(True)
+    beat_channel = IntDescriptor(1)
+
+
 class DefaultSection(Section):
     name = "DEFAULT"
     log_dir = StringDescriptor(user_log_dir(uci_cbp_demo.__appname__, uci_cbp_demo.__author__))
@@ -98,13 +129,15 @@ class DefaultSection(Section):
 
 class Configuration:
     DEFAULT_CONFIG = Path(os.path.dirname(os.path.realpath(__file__))) / "config.ini"
-    SECTIONS = ["DEFAULT", "plotting", "board"]
+    SECTIONS = ["DEFAULT", "plotting", "board", "recording", "processing"]
 
     def __init__(self, c: "ConfigObj"):
         self._config = c
         logger.info(f"Init with: {c}")
         self.plotting = PlottingSection(self)
         self.board = BoardSection(self)
+        self.recording = RecordingSection(self)
+        self.processing = ProcessingSection(self)
         self.DEFAULT = DefaultSection(self)
         self.sections = {section: getattr(self, section) for section in self.SECTIONS}
         for section_name, section in self.sections.items():
@@ -1,30 +1,48 @@
 #  MIT License
 #  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+import threading
 import time
 import tkinter
-from multiprocessing import Pipe, Process, Queue
-from queue import Empty
+from collections import deque
+from multiprocessing import Pipe, Process
 from tkinter import messagebox, DISABLED, ACTIVE
-from typing import List
+from typing import Tuple
+
+import numpy as np
 
 import uci_cbp_demo
 from uci_cbp_demo.backend import FileExporter, FileExporterConf
-from uci_cbp_demo.backend.bluetooth import CapData
+from uci_cbp_demo.backend.bluetooth import SampleBlock
+from uci_cbp_demo.backend.processing import BeatDetector, ChannelAligner, ProcessedBlock, ProcessingPipeline, \
+    PulseTransitEstimator, StreamingSOSFilter
+from uci_cbp_demo.backend.stats import RateMeter
+from uci_cbp_demo.backend.transport import TransportLag
 from uci_cbp_demo.config import config
 from uci_cbp_demo.logging import logger
 from uci_cbp_demo.ui.widget_about import AboutViewSingleton
-from uci_cbp_demo.ui.widget_canvas import PlotCanvas, PlotCanvasModel
+from uci_cbp_demo.ui.plot_model import PLOT_BACKENDS, PlotCanvasModel
 from uci_cbp_demo.ui.widget_dac_control import DACControl
 from uci_cbp_demo.ui.widget_preferences import PreferencesViewSingleton
 from uci_cbp_demo.ui.widget_scan import ScanViewSingleton
 
 
+def plot_canvas(backend):
+    """PlotCanvas class of a plotting backend, imported on demand so the Tk backend never loads matplotlib"""
+    if backend not in PLOT_BACKENDS:
+        raise ValueError(f"unknown plotting backend {backend}, expected one of {PLOT_BACKENDS}")
+    if backend == "tk":
+        from uci_cbp_demo.ui.widget_tk_canvas import TkPlotCanvas
+        return TkPlotCanvas
+    from uci_cbp_demo.ui.widget_canvas import PlotCanvas
+    return PlotCanvas
+
+
 class GUIView(tkinter.Tk):
     TITLE = f"UCI Continuous Blood Pressure {uci_cbp_demo.__version__}"
     MIN_WIDTH = 640
     MIN_HEIGHT = 480
 
-    def __init__(self, model: "GUIModel"):
+    def __init__(self, model: "GUIModel", backend=None):
         super(GUIView, self).__init__()
         self.model: GUIModel = model
         self.model = model
@@ -64,7 +82,9 @@ class GUIView(tkinter.Tk):
         self.menubar.add_cascade(label="About", menu=self.aboutmenu, state=ACTIVE)
         self.config(menu=self.menubar)
 
-        self.canvas = PlotCanvas(self, PlotCanvasModel(model))
+        backend = config.plotting.backend if backend is None else backend
+        logger.info(f"Plotting with the {backend} backend")
+        self.canvas = plot_canvas(backend)(self, PlotCanvasModel(model))
         self.canvas.make_axes(self.model.signals)
         # buttons
         self.button_ch1 = tkinter.Button(master=self, text="CH 1", state=ACTIVE,
@@ -102,8 +122,15 @@ class GUIView(tkinter.Tk):
         self.file_prefix = tkinter.Entry(master=self, textvariable=self.file_prefix_var)
         self.file_prefix.pack(side=tkinter.LEFT)
 
+        self.status_label = tkinter.Label(master=self, textvariable=self.canvas.status_var, anchor=tkinter.E)
+        self.status_label.pack(side=tkinter.RIGHT)
+
 
 class GUIModel:
+    DRAIN_MAX_ITEMS = None  # catch up on everything pending
+    DRAIN_TIME_BUDGET = 0.02  # seconds
+    LAG_WARNING = 1.0  # seconds
+    LAG_LOG_EVERY = 250  # lagging drains between warnings, about 5 s at the pump rate
 
     @property
     def dac1(self):
@@ -134,8 +161,27 @@ class GUIModel:
     def notify(self, message, payload=None):
         _msg = (message, payload)
         logger.info(f"Sending {_msg}")
+        # the pump only reads ACKs while it runs; reading them here too keeps them from filling the pipe when it is
+        # stopped, which would block the BLE process's send inside its event loop
+        self.poll_messages()
+        self._pending_acks.setdefault(message, deque()).append(time.perf_counter())
         self.pipe.send(_msg)
 
+    def handle_message(self, message):
+        command, payload = message
+        if command == "ACK":
+            acked, _ = payload
+            if self._pending_acks.get(acked):
+                self.command_latency[acked] = time.perf_counter() - self._pending_acks[acked].popleft()
+                logger.debug(f"{acked} acknowledged after {1000 * self.command_latency[acked]:.1f} ms")
+        return command
+
+    def poll_messages(self):
+        """Handle everything the BLE process sent; runs on the pump thread and the Tk thread, one at a time"""
+        with self._pipe_lock:
+            while self.pipe.poll():
+                self.handle_message(self.pipe.recv())
+
     def start(self):
         self.notify("START")
 
@@ -148,6 +194,7 @@ class GUIModel:
     def set_ch_status(self, ch, status):
         self.notify(f"CH{ch}", status)
         setattr(self, f"ch{ch}", status)
+        self.submit(self.pipeline.aligner.set_channels, self.caps)
 
     def stop(self):
         self.notify("STOP")
@@ -164,12 +211,14 @@ class GUIModel:
         if self.view is not None:
             self.view.mac_str_var.set(self.mac_addr)
 
-    def init(self, mac_addr):
+    def init(self, mac_addr, capture_directory=None):
         self.mac_addr = mac_addr
         self.set_ch_status(1, self.ch1)
         self.set_ch_status(2, self.ch2)
         self.notify("DAC1", self.dac1)
         self.notify("DAC2", self.dac2)
+        if capture_directory is not None:
+            self.notify("CAPTURE", str(capture_directory))
         self.connect()
 
     @property
@@ -181,24 +230,49 @@ class GUIModel:
             _caps.append(2)
         return _caps
 
-    def pop_queue(self, c) -> CapData:
-        try:
-            d = self.queues[f'cap{c}'].get(block=False)  # type:CapData
-            for orientation in ["x", "y", "z"]:
-                setattr(d.gyro, orientation, 100 * getattr(d.gyro, orientation))
-            return d
-        except Empty:
-            pass
+    def submit(self, function, *args):
+        """Run function(*args) on the thread that moves data, before its next batch
+
+        The processing pipeline is only touched from get_sample(), which runs on the data pump thread, so changes
+        requested from the Tk thread are queued here instead of racing it.
+        """
+        self._commands.append((function, args))
+
+    def get_sample(self) -> "Tuple[SampleBlock, ProcessedBlock]":
+        while self._commands:
+            function, args = self._commands.popleft()
+            function(*args)
+        self.poll_messages()
+        block, self.lag = self.transport.drain(max_items=self.DRAIN_MAX_ITEMS, time_budget=self.DRAIN_TIME_BUDGET)
+        if self.lag.oldest_age > self.LAG_WARNING:
+            self.lagging_drains += 1
+            if self.lagging_drains == 1 or self.lagging_drains % self.LAG_LOG_EVERY == 0:
+                logger.warning(f"Display is lagging behind the sensor: {self.lag} "
+                               f"({self.lagging_drains} lagging drains so far)")
+        if len(block) == 0:
+            return block, ProcessedBlock.empty()
+        for c in [1, 2]:
+            mine = block.channel == c
+            if np.any(mine):
+                self.rates[f"cap{c}"].update(block.time[mine])
+        imu = block.has_imu
+        if np.any(imu):
+            self.rates["imu"].update(np.sort(block.time[imu]))
+        block.gyro *= 100
+        processed = self.pipeline.put(block)
+        if self._exporter is not None:
+            self._exporter.put(block)
+            if len(processed):
+                self._exporter.put(processed)
+        return block, processed
 
-    def get_sample(self) -> List[CapData]:
-        _return = []
-        for i in range(40):
-            for ch in [1, 2]:
-                new_data = self.pop_queue(ch)
-                if new_data is not None:
-                    self._exporter.put(new_data)
-                    _return.append(new_data)
-        return _return
+    @property
+    def filtered_signals(self):
+        return [f"cap{c}" for c in [1, 2] if getattr(config.processing, f"filter_cap{c}")]
+
+    def set_filter_status(self, ch, status):
+        setattr(config.processing, f"filter_cap{ch}", status)
+        self.submit(self.filter.set_columns, self.filtered_signals)
 
     @property
     def signals(self):
@@ -207,7 +281,7 @@ class GUIModel:
             _signals.extend(['acc', 'gyro', 'mag'])
         return _signals
 
-    def __init__(self, queues, pipe, a=1, b=0, ch1=None, ch2=None, addr="DC:4E:6D:9F:E3:BA"):
+    def __init__(self, transport, pipe, a=1, b=0, ch1=None, ch2=None, addr="DC:4E:6D:9F:E3:BA"):
         self.a = a
         self.b = b
         self._view = None
@@ -217,7 +291,19 @@ class GUIModel:
         self.ch2 = config.plotting.ch2_en if ch2 is None else ch2
         self.imu = config.plotting.imu_en
         self.pipe = pipe
-        self.queues = queues
+        self.transport = transport
+        self.lag = TransportLag()
+        self.lagging_drains = 0
+        self.command_latency = {}
+        self._pending_acks = {}
+        self._pipe_lock = threading.Lock()
+        self._commands = deque()
+        self.rates = {"cap1": RateMeter(), "cap2": RateMeter(), "imu": RateMeter()}
+        self.filter = StreamingSOSFilter(columns=self.filtered_signals)
+        self.beats = BeatDetector(column=f"cap{config.processing.beat_channel}")
+        self.transit = PulseTransitEstimator()
+        self.pipeline = ProcessingPipeline(ChannelAligner(channels=self.caps),
+                                           stages=[self.filter, self.beats, self.transit])
 
     def attach_exporter(self, exporter: "FileExporter"):
         self._exporter = exporter
@@ -244,25 +330,29 @@ class GUIController:
         self._view.mac_entry.configure(state=DISABLED)
 
     def stop(self):
-        self.model.stop()
+        # joins the data pump, so nothing is put into the session after it closes
         self._view.canvas.timer.stop()
+        self.model.stop()
+        self.exporter.close_session()
         self._view.button_pause.configure(state=DISABLED)
         self._view.button_start.configure(state=ACTIVE)
 
     def connect(self):
         config.board.mac = self._view.mac_str_var.get()
-        self.exporter.new_session(self._view.file_prefix_var.get())
+        self.exporter.new_session(self._view.file_prefix_var.get(),
+                                  metadata={"mac": self._view.mac_str_var.get(), "channels": self.model.caps,
+                                            "dac1": self.model.dac1, "dac2": self.model.dac2})
         if self.model.imu:
             self.exporter.incite_imu()
         else:
             self.exporter.suppress_imu()
         self.model.attach_exporter(self.exporter)
-        self.model.init(self._view.mac_str_var.get())
-        self.model.pipe.poll(None)
-        c = self.model.pipe.recv()
-        if c[0] == "CONNECTED":
-            logger.info("Bluetooth connected received by GUI")
-            self.start()
+        capture_directory = self.exporter.session_directory if config.recording.raw_capture else None
+        self.model.init(self._view.mac_str_var.get(), capture_directory)
+        while self.model.handle_message(self.model.pipe.recv()) != "CONNECTED":
+            pass
+        logger.info("Bluetooth connected received by GUI")
+        self.start()
 
     def imu_toggle(self):
         _btn = getattr(self._view, f"button_imu")
@@ -302,13 +392,15 @@ class GUIController:
 
     def ask_quit(self):
         if messagebox.askokcancel("Quit", "You want to quit now? *sniff*"):
+            self._view.canvas.timer.stop()
             self.model.stop()
+            self.exporter.close_session()
             time.sleep(3)
             logger.info("destroying root")
             self._view.destroy()
             logger.info("finish destroying root")
 
-    def __init__(self, model: "GUIModel"):
+    def __init__(self, model: "GUIModel", backend=None):
 
         model.mac_addr = config.board.mac
         model.ch1 = config.plotting.ch1_en
@@ -318,10 +410,14 @@ class GUIController:
         from appdirs import user_data_dir
         _fe_conf = FileExporterConf()
         _fe_conf.app_data_directory = user_data_dir(uci_cbp_demo.__appname__, uci_cbp_demo.__author__)
+        _fe_conf.columnar_store = bool(config.recording.columnar_store)
+        _fe_conf.fsync_interval = config.recording.fsync_interval
+        _fe_conf.export_processed = bool(config.recording.export_processed)
         self.exporter = FileExporter(_fe_conf)
+        self.exporter.recover()
 
         self.model = model
-        self._view = GUIView(self.model)
+        self._view = GUIView(self.model, backend)
 
         self._view.protocol("WM_DELETE_WINDOW", self.ask_quit)
 
@@ -339,13 +435,15 @@ class GUIController:
         self._view.mainloop()
 
 
-def main():
+def main(backend=None):
     from uci_cbp_demo.backend import SensorBoard
+    from uci_cbp_demo.backend.transport import default_transport
     pipe_1, pipe_2 = Pipe()
-    q = {"cap1": Queue(), "cap2": Queue(), "acc": Queue(), "gyro": Queue(), "mag": Queue()}
+    transport = default_transport()
     sensor = SensorBoard(addr="DC:4E:6D:9F:E3:BA", pipe=pipe_2)
-    _gui = GUIController(GUIModel(q, pipe_1, addr="DC:4E:6D:9F:E3:BA"))
-    p = Process(target=sensor.start_session, args=(q,))
+    _gui = GUIController(GUIModel(transport, pipe_1, addr="DC:4E:6D:9F:E3:BA"), backend)
+    p = Process(target=sensor.start_session, kwargs={"transport": transport})
     p.start()
     _gui.start_gui()
     p.terminate()
+    transport.close()
@@ -0,0 +1,317 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+"""State shared by the plotting backends: display buffers, labels, axis limit policy, data pump and frame scheduling"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from uci_cbp_demo.backend.bluetooth.constants import DISPLAY_WINDOW, FS
+from uci_cbp_demo.backend.datastructures import CapDisplayDataQueue, IMUDisplayDataQueue, MinMaxDecimator
+from uci_cbp_demo.backend.stats import EWMA, RateMeter
+from uci_cbp_demo.logging import logger
+
+if TYPE_CHECKING:
+    from uci_cbp_demo.ui.gui import GUIModel
+
+PLOT_BACKENDS = ["matplotlib", "tk"]
+Y_LABEL = {"cap1": "Cap 1 (pF)", "cap2": "Cap 2 (pF)", "acc": "Acc (G)", "gyro": "Gyro (dps X100)", "mag": "Mag (uT)"}
+Y_LIM = {"cap1": (0, 8), "cap2": (0, 8), "acc": (-2, 2), "gyro": (-1, 1), "mag": (-10, 10)}
+
+
+class DisplayBuffer(dict):
+    """One copy of the display queues; `applied` counts the published batches it holds"""
+
+    def __init__(self, queues, index):
+        super(DisplayBuffer, self).__init__(queues)
+        self.index = index
+        self.applied = 0
+
+
+class DisplayBuffers:
+    """Two copies of the display queues, written by the data pump and read by the Tk thread without locks
+
+    publish() applies a batch of (signal, time, values) to the back copy and swaps it to the front; a copy taken over
+    as back first gets the batches it missed, so both see every batch once and in order. The reader marks the copy it
+    draws from in acquire() and clears the mark in release(). The pump never writes to a marked copy: it keeps the
+    batch for its next publish() instead, so neither side ever waits for the other. Only single reference assignments
+    are shared between the threads, which the interpreter makes atomic.
+    """
+
+    def __init__(self, factory):
+        self.buffers = [DisplayBuffer(factory(), i) for i in range(2)]
+        self.front, self._back = self.buffers
+        self.published = 0
+        self.deferred = 0
+        self._reading = None
+        self._log = []  # batches the back copy may still miss
+        self._base = 0  # number of batches dropped from the head of the log
+
+    def __iter__(self):
+        return iter(self.buffers)
+
+    def acquire(self):
+        while True:
+            front = self.front
+            self._reading = front
+            # a swap in between may already have handed this copy to the pump; then take the new front
+            if self.front is front:
+                return front
+
+    def release(self):
+        self._reading = None
+
+    def publish(self, batch):
+        """Make batch visible to the reader; False if the reader still holds the back copy and it has to wait"""
+        if batch:
+            self._log.append(batch)
+            self.published += 1
+        back = self._back
+        if back.applied == self.published:
+            return False
+        if self._reading is back:
+            self.deferred += 1
+            return False
+        for missed in self._log[back.applied - self._base:]:
+            for name, t, values in missed:
+                back[name].extend(t, values)
+        back.applied = self.published
+        self._back = self.front
+        self.front = back
+        done = self._back.applied - self._base
+        del self._log[:done]
+        self._base += done
+        return True
+
+
+class PlotCanvasModel:
+    PAGE_STEP = 0.25  # fraction of the window the x axis advances by when the data reaches its right edge
+    Y_MARGIN = 0.1  # autoscaled y limits are padded by this fraction of the data range ...
+    Y_SHRINK = 0.5  # ... and only tightened once the data spans less than this fraction of them
+
+    def __init__(self, model: "GUIModel"):
+        self.model = model
+        # IMU rows arrive with either cap channel, so their buffers see twice the per-channel rate
+        cap_capacity = int(np.ceil(1.5 * FS * DISPLAY_WINDOW))
+        self.buffers = DisplayBuffers(lambda: {
+            "cap1": CapDisplayDataQueue(window_size=DISPLAY_WINDOW, capacity=cap_capacity),
+            "cap2": CapDisplayDataQueue(window_size=DISPLAY_WINDOW, capacity=cap_capacity),
+            "acc": IMUDisplayDataQueue(window_size=DISPLAY_WINDOW, capacity=2 * cap_capacity),
+            "gyro": IMUDisplayDataQueue(window_size=DISPLAY_WINDOW, capacity=2 * cap_capacity),
+            "mag": IMUDisplayDataQueue(window_size=DISPLAY_WINDOW, capacity=2 * cap_capacity),
+        })
+        # the copy being drawn from; only valid inside frame()
+        self.display_queue = self.buffers.front
+        self.pump = DataPump(self.empty_queue)
+        self._frames = 0
+
+    @property
+    def signals(self):
+        return self.model.signals
+
+    def rate(self, signal):
+        """RateMeter of the stream a display signal comes from (all IMU signals share one)"""
+        return self.model.rates[signal if "cap" in signal else "imu"]
+
+    @property
+    def lag(self):
+        return self.model.lag
+
+    @property
+    def beat_signal(self):
+        return self.model.beats.column
+
+    @property
+    def pulse_rate(self):
+        return self.model.beats.pulse_rate
+
+    @property
+    def ptt(self):
+        return self.model.transit.ptt
+
+    @contextmanager
+    def frame(self):
+        """Hold display_queue still for drawing; may be nested"""
+        if self._frames == 0:
+            self.display_queue = self.buffers.acquire()
+        self._frames += 1
+        try:
+            yield self.display_queue
+        finally:
+            self._frames -= 1
+            if self._frames == 0:
+                self.buffers.release()
+
+    def decimators(self, key):
+        """A MinMaxDecimator per display buffer copy for a line key (signal, or signal_axis for the IMU)"""
+        signal, _, axis = key.partition("_")
+        return [MinMaxDecimator(buffer[signal], axis or "cap") for buffer in self.buffers]
+
+    def label(self, signal):
+        """Rate label of a signal, None until its rate estimate has settled"""
+        rate = self.rate(signal)
+        if rate.interval.count <= 10:
+            return None
+        text = f"{rate.rate:.1f} Hz, jitter {1000 * rate.jitter:.1f} ms ({len(self.display_queue[signal])} samples)"
+        if signal == self.beat_signal and not np.isnan(self.pulse_rate):
+            text += f", pulse {self.pulse_rate:.0f} bpm"
+        if signal == "cap2" and not np.isnan(self.ptt):
+            text += f", PTT {1000 * self.ptt:.0f} ms"
+        return text
+
+    def page_xlim(self, xlim, t_max):
+        """x limits advanced by whole page steps once t_max passes the right edge, None if they can stay"""
+        lo, hi = xlim
+        if lo <= t_max <= hi:
+            return None
+        step = self.PAGE_STEP * DISPLAY_WINDOW
+        if t_max > hi:
+            lo += step * np.ceil((t_max - hi) / step)
+        else:  # time went backwards, e.g. the board restarted
+            lo = t_max - DISPLAY_WINDOW + step
+        return lo, lo + DISPLAY_WINDOW
+
+    def scale_ylim(self, ylim, low, high):
+        """y limits moved only when the data leaves them or shrinks well inside them, None if they can stay"""
+        lo, hi = ylim
+        if np.isnan(low) or low >= lo and high <= hi and high - low >= self.Y_SHRINK * (hi - lo):
+            return None
+        margin = self.Y_MARGIN * max(high - low, 1e-3)
+        return low - margin, high + margin
+
+    def cap_ylim(self, signal, ylim, autoscale):
+        """y limits of a cap signal: autoscaled from the display buffer extrema, else the fixed default"""
+        if autoscale:
+            return self.scale_ylim(ylim, *self.display_queue[signal].extrema("cap"))
+        return None if tuple(ylim) == Y_LIM[signal] else Y_LIM[signal]
+
+    def empty_queue(self):
+        """Drain the model and publish what arrived to the display buffers; runs on the data pump thread"""
+        block, processed = self.model.get_sample()
+        batch = []
+        # cap signals come off the common TARGET_FS grid (low-passed where enabled), the IMU straight from the
+        # notifications
+        for c in [1, 2]:
+            for name in [f"cap{c}_filtered", f"cap{c}"]:
+                if name in processed:
+                    batch.append((f'cap{c}', *processed.valid(name)))
+                    break
+        if len(block):
+            block = block.select(np.argsort(block.time, kind="stable"))
+            imu = block.has_imu
+            for s in ['acc', 'gyro', 'mag']:
+                batch.append((s, block.time[imu], getattr(block, s)[imu]))
+        self.buffers.publish(batch)
+
+
+class DataPump:
+    """Calls ingest() every INTERVAL seconds on a background thread, so data keeps moving while Tk is busy
+
+    Window drags, menus and modal dialogs hold up the Tk event loop but not the pump. start() and stop() may be
+    called repeatedly; stop() waits for the current ingest() to return.
+    """
+    INTERVAL = 0.02  # seconds
+
+    def __init__(self, ingest, interval=INTERVAL):
+        self.ingest = ingest
+        self.interval = interval
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="DataPump", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            try:
+                self.ingest()
+            except Exception as e:
+                self.errors += 1
+                logger.exception(f"Data pump failed to ingest: {e}")
+            # a drain that used up its time budget is followed by the next one right away
+            self._stop.wait(max(self.interval - (time.perf_counter() - start), 0))
+
+
+class PlotScheduler:
+    """Schedules rendering on the Tk event loop and runs the data pump alongside it
+
+    Ingestion happens on the pump thread regardless of how long frames take. render() runs at target_fps, or slower
+    when frames run long: the interval stretches to HEADROOM times the average frame time so the event loop keeps time
+    for user input. Frames missed against the target rate are counted as dropped.
+    """
+    HEADROOM = 1.5
+
+    def __init__(self, widget, render, target_fps=30, pump: "DataPump" = None):
+        self.widget = widget
+        self.render = render
+        self.pump = pump
+        self.target_fps = target_fps
+        self.frame_time = EWMA(span=30)
+        self.frame_rate = RateMeter(span=30)
+        self.dropped = 0
+        self._jobs = {}
+        self._last_render = None
+
+    @property
+    def running(self):
+        return bool(self._jobs)
+
+    @property
+    def interval(self):
+        """seconds between frames, adapted to how long frames have been taking"""
+        target = 1 / self.target_fps
+        if self.frame_time.count == 0:
+            return target
+        return max(target, self.HEADROOM * self.frame_time.mean)
+
+    def start(self):
+        if not self.running:
+            self._last_render = None
+            if self.pump is not None:
+                self.pump.start()
+            self._schedule("render", 0, self._render)
+
+    def stop(self):
+        for job in self._jobs.values():
+            self.widget.after_cancel(job)
+        self._jobs = {}
+        if self.pump is not None:
+            self.pump.stop()
+
+    def _schedule(self, name, delay, callback):
+        self._jobs[name] = self.widget.after(int(1000 * delay), callback)
+
+    def _render(self):
+        start = time.perf_counter()
+        if self._last_render is not None:
+            self.dropped += max(round((start - self._last_render) * self.target_fps) - 1, 0)
+        self._last_render = start
+        self.render()
+        elapsed = time.perf_counter() - start
+        self.frame_time.update([elapsed])
+        self.frame_rate.update([start])
+        self._schedule("render", max(self.interval - elapsed, 0), self._render)
+
+    @property
+    def status(self):
+        if self.frame_time.count == 0:
+            return f"Target {self.target_fps} fps"
+        return f"{self.frame_rate.rate:.1f} fps (target {self.target_fps}), frame {1000 * self.frame_time.mean:.1f} " \
+               f"ms, {self.dropped} dropped"
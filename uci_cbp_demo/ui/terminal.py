@@ -21,17 +21,29 @@ class TerminalManager:
         self.pipe = pipe
 
     def wait_for_connection(self):
-        while not self.pipe.poll():
-            time.sleep(1)  # wait for connection
+        while True:
+            while not self.pipe.poll():
+                time.sleep(1)  # wait for connection
+            if self.pipe.recv()[0] == "CONNECTED":
+                break
+
+    def drain_messages(self, timeout=0.0):
+        """Read whatever the sensor process sent (command ACKs), waiting up to timeout seconds for the first one"""
+        while self.pipe.poll(timeout):
+            command, payload = self.pipe.recv()
+            logger.debug(f"{command} {payload} received")
+            timeout = 0.0
 
     def handle_session(self):
         self.wait_for_connection()
         if platform.system() == "Linux":
             tty.setcbreak(sys.stdin.fileno())
             while not is_data():
-                pass
+                self.drain_messages(timeout=0.1)
         else:
-            time.sleep(20)
+            deadline = time.monotonic() + 20
+            while time.monotonic() < deadline:
+                self.drain_messages(timeout=0.1)
         self.pipe.send(("STOP", None))
         logger.info("Restoring tty...")
         if platform.system() == "Linux":
@@ -3,7 +3,7 @@
 from multiprocessing import Process, Pipe
 
 
-def tui_main(addr=None, ch1=True, ch2=True):
+def tui_main(addr=None, ch1=True, ch2=True, capture=None):
     from uci_cbp_demo.ui.terminal import TerminalManager
 
     from uci_cbp_demo.backend import SensorBoard
@@ -17,4 +17,6 @@ def tui_main(addr=None, ch1=True, ch2=True):
         pipe_1.send(("CH1", None))
     if ch2:
         pipe_1.send(("CH2", None))
+    if capture is not None:
+        pipe_1.send(("CAPTURE", capture))
     tm.handle_session()
@@ -2,8 +2,8 @@
 #  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
 
 import logging
+import time
 import tkinter
-from typing import TYPE_CHECKING
 
 import numpy as np
 from matplotlib import pyplot as plt
@@ -11,42 +11,25 @@ from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 
 from uci_cbp_demo.backend.bluetooth.constants import DISPLAY_WINDOW
-from uci_cbp_demo.backend.datastructures import CapDisplayDataQueue, IMUDisplayDataQueue
+from uci_cbp_demo.backend.datastructures import IMUDisplayDataQueue
 from uci_cbp_demo.config import config
+from uci_cbp_demo.ui.plot_model import PlotCanvasModel, PlotScheduler, Y_LABEL, Y_LIM
 
 logger = logging.getLogger("bp_demo")
 
-if TYPE_CHECKING:
-    from uci_cbp_demo.ui.gui import GUIModel
-
-
-class PlotCanvasModel:
-    def __init__(self, model: "GUIModel"):
-        self.model = model
-        self.display_queue = {"cap1": CapDisplayDataQueue(window_size=DISPLAY_WINDOW),
-                              "cap2": CapDisplayDataQueue(window_size=DISPLAY_WINDOW),
-                              "acc": IMUDisplayDataQueue(window_size=DISPLAY_WINDOW),
-                              "gyro": IMUDisplayDataQueue(window_size=DISPLAY_WINDOW),
-                              "mag": IMUDisplayDataQueue(window_size=DISPLAY_WINDOW),
-                              }
-
-    @property
-    def signals(self):
-        return self.model.signals
-
-    def empty_queue(self):
-        d = self.model.get_sample()
-        for di in d:
-            self.display_queue[f'cap{di.channel}'].put(di)
-            self.display_queue['acc'].put(di.acc)
-            self.display_queue['gyro'].put(di.gyro)
-            self.display_queue['mag'].put(di.mag)
-
 
 class PlotCanvas(FigureCanvasTkAgg):
+    """Stacked signal axes redrawn by blitting
+
+    A full draw happens only when the layout or an axis limit changes (resize, signal set change, x paging, y
+    autoscale leaving its hysteresis band); it caches every axis background. Other frames restore those backgrounds
+    and redraw just the animated lines. Rate labels are refreshed every LABEL_INTERVAL seconds by drawing them onto the
+    cached background, so text is not rendered every frame.
+    """
     PIXELS_LEFT = 70
     PIXELS_DOWN = 50
     DPI = 100
+    LABEL_INTERVAL = 0.5  # seconds
 
     def __init__(self, parent, model: "PlotCanvasModel"):
         self.fig = Figure(dpi=self.DPI)
@@ -55,11 +38,17 @@ class PlotCanvas(FigureCanvasTkAgg):
         self.parent = parent
 
         self.mpl_connect("resize_event", self.on_resize)
-        self.timer = self.new_timer(interval=1)
-        self.timer.add_callback(self.update_plot)
+        self.mpl_connect("draw_event", self.on_draw)
+        self.timer = PlotScheduler(self.get_tk_widget(), self.update_plot, target_fps=config.plotting.target_fps,
+                                   pump=self.model.pump)
+        self.status_var = tkinter.StringVar()
         self.fs = {}
         self.ax = {}
         self.line = {}
+        self.decimator = {}
+        self._background = None
+        self._labelled = {}
+        self._label_time = 0
         self.make_axes(["cap1", "cap2", "acc", "gyro", "mag"])
         self.autoscale = tkinter.IntVar()
         self.autoscale.set(config.plotting.autoscale_cap)
@@ -69,11 +58,55 @@ class PlotCanvas(FigureCanvasTkAgg):
         logger.debug(f"resize_event: {event.width} {event.height}")
         self.tight_layout()
 
+    def on_draw(self, event):
+        # a full redraw can come from a resize as well as from update_plot, so hold the display buffer still here too
+        with self.model.frame():
+            for key, decimators in self.decimator.items():
+                for decimator in decimators:
+                    decimator.set_bucket(DISPLAY_WINDOW / max(self.ax[key.split("_")[0]].bbox.width, 1))
+            self._background = {s: self.copy_from_bbox(ax.bbox) for s, ax in self.ax.items()}
+            for s in self.ax:
+                self._draw_label(s)
+                self._draw_lines(s)
+
+    def _lines(self, signal):
+        return [self.line[signal]] if signal in self.line else [self.line[f"{signal}_{o}"] for o in "xyz"]
+
+    def _draw_lines(self, signal):
+        for line in self._lines(signal):
+            self.ax[signal].draw_artist(line)
+
+    def _draw_label(self, signal):
+        """Render the label onto a copy of the axis background that the following frames restore"""
+        self.restore_region(self._background[signal])
+        self.ax[signal].draw_artist(self.fs[signal])
+        self._labelled[signal] = self.copy_from_bbox(self.ax[signal].bbox)
+
+    def _decimate(self, key):
+        return self.decimator[key][self.model.display_queue.index]()
+
     def update_plot(self):
-        self.model.empty_queue()
+        with self.model.frame():
+            self._update_plot()
+
+    def _update_plot(self):
+        relabel = time.monotonic() - self._label_time >= self.LABEL_INTERVAL
+        if relabel:
+            self._label_time = time.monotonic()
+            self.status_var.set(f"{self.timer.status} | {self.model.lag}")
+        relimit = False
         for s in self.model.signals:
-            self._redraw_signal(s)
-        self.tight_layout()
+            relimit |= self._redraw_signal(s, relabel)
+        if relimit or self._background is None:
+            self.draw()
+            return
+        for s in self.model.signals:
+            if relabel:
+                self._draw_label(s)
+            else:
+                self.restore_region(self._labelled[s])
+            self._draw_lines(s)
+            self.blit(self.ax[s].bbox)
 
     def tight_layout(self):
         self.fig.tight_layout(pad=0, h_pad=None, w_pad=None, rect=None)
@@ -84,58 +117,68 @@ class PlotCanvas(FigureCanvasTkAgg):
 
         self.draw()
 
-    def _redraw_signal(self, signal):
-        _t = self.model.display_queue[signal].time
-
-        if isinstance(self.model.display_queue[signal], IMUDisplayDataQueue):
-            orientations = ['x', 'y', 'z']
-            for o in orientations:
-                value = getattr(self.model.display_queue[signal], o)
-                self.line[f"{signal}_{o}"].set_data(_t, value)
+    def _page_x(self, signal, t_max):
+        """Page the x axis once t_max passes its right edge; True if it moved"""
+        xlim = self.model.page_xlim(self.ax[signal].get_xlim(), t_max)
+        if xlim is None:
+            return False
+        self.ax[signal].set_xlim(*xlim)
+        self.ax[signal].set_xticks(np.arange(np.ceil(xlim[0]), xlim[1] + 1).astype(int))
+        return True
+
+    def _scale_y(self, signal):
+        """Apply the cap y limit policy; True if the limits moved"""
+        ylim = self.model.cap_ylim(signal, self.ax[signal].get_ylim(), self.autoscale.get() == 1)
+        if ylim is None:
+            return False
+        self.ax[signal].set_ylim(*ylim)
+        return True
+
+    def _redraw_signal(self, signal, relabel=True):
+        """Update the artists of one signal; True if its axis limits changed and a full draw is needed"""
+        queue = self.model.display_queue[signal]
+        _t = queue.time
+        n_samples = len(_t)
+
+        if isinstance(queue, IMUDisplayDataQueue):
+            for o in queue.COLUMNS:
+                self.line[f"{signal}_{o}"].set_data(*self._decimate(f"{signal}_{o}"))
         else:
-            value = self.model.display_queue[signal].cap
-            self.line[signal].set_data(_t, value)
-
-        if self.model.display_queue[signal].non_empty > 10:
-            self.fs[signal].set_text(f"{1 / np.mean(_t[1:] - _t[:-1]):.1f} Hz "
-                                     f"({self.model.display_queue[signal].non_empty} samples)")
-
-        try:
-            _min_time = min(_t)
-            _max_time = max(np.max(_t), DISPLAY_WINDOW)
-            self.ax[signal].set_xticks(np.arange(_min_time, _max_time + 1).astype(int))
-            self.ax[signal].set_xlim(_min_time, _max_time)
-            self.fs[signal].set_x(_min_time)
-            if "cap" in signal:
-                if self.autoscale.get() == 1:
-                    self.fs[signal].set_y(min(value))
-                    self.ax[signal].set_ylim(min(value), max(value))
-                else:
-                    self.fs[signal].set_y(0)
-                    self.ax[signal].set_ylim(0, 8)
-
-        except ValueError:
+            self.line[signal].set_data(*self._decimate(signal))
+
+        text = self.model.label(signal) if relabel else None
+        if text is not None:
+            self.fs[signal].set_text(text)
+
+        if n_samples == 0:
             logger.debug(f"{signal} time axis is empty?")
+            return False
+        relimit = self._page_x(signal, _t[-1])
+        if "cap" in signal:
+            relimit |= self._scale_y(signal)
+        return relimit
 
     def make_axes(self, signals):
         self.ax = {s: plt.subplot2grid((len(signals), 1), (i, 0), fig=self.fig)
                    for i, s in enumerate(signals)}
+        self._background = None
+        self._labelled = {}
         t = np.linspace(0, DISPLAY_WINDOW)
         caps = [s for s in signals if "cap" in s]
-        self.line = {c: self.ax[c].plot(t, np.zeros_like(t))[0] for c in caps}
-        self.line.update({f"{s}_{o}": self.ax[s].plot(t, np.zeros_like(t), label=o.upper())[0]
+        self.line = {c: self.ax[c].plot(t, np.zeros_like(t), animated=True)[0] for c in caps}
+        self.line.update({f"{s}_{o}": self.ax[s].plot(t, np.zeros_like(t), label=o.upper(), animated=True)[0]
                           for s in set(signals) - {'cap1', 'cap2'}
                           for o in ['x', 'y', 'z']})
-        y_label = {"cap1": f"Cap 1 (pF)", "cap2": f"Cap 2 (pF)", "acc": "Acc (G)", "gyro": "Gyro (dps X100)",
-                   "mag": "Mag (uT)"}
-        y_lim = {"cap1": (0, 8), "cap2": (0, 8), "acc": (-2, 2), "gyro": (-1, 1), "mag": (-10, 10)}
+        # at most two points per pixel column reach the line artists; buckets are sized once the layout is known
+        self.decimator = {key: self.model.decimators(key) for key in self.line}
         for s in set(signals) - {'cap1', 'cap2'}:
             self.ax[s].legend(loc='upper right')
         for s in set(signals):
-            self.ax[s].set_ylabel(y_label[s])
-            self.ax[s].set_ylim(*y_lim[s])
+            self.ax[s].set_ylabel(Y_LABEL[s])
+            self.ax[s].set_ylim(*Y_LIM[s])
 
-            self.fs[s] = self.ax[s].text(0.1, y_lim[s][0], f"--- Hz")
+            # axes coordinates keep the label in the lower left corner whatever the limits
+            self.fs[s] = self.ax[s].text(0.01, 0.02, f"--- Hz", transform=self.ax[s].transAxes, animated=True)
             self.ax[s].set_xlim(0, DISPLAY_WINDOW)
             self.ax[s].grid()
             self.ax[s].set_title("")
@@ -6,6 +6,7 @@ from tkinter import ttk
 from typing import TYPE_CHECKING
 
 from uci_cbp_demo.config import config
+from uci_cbp_demo.ui.plot_model import PLOT_BACKENDS
 
 if TYPE_CHECKING:
     from uci_cbp_demo.ui.gui import GUIView
@@ -56,6 +57,29 @@ class PreferencesView(tkinter.Toplevel):
         txtfld2.grid(row=1, column=1)
         tab1.grid_rowconfigure("all", pad=10)
 
+        tab2 = ttk.Frame(tab_parent)
+        tab_parent.add(tab2, text="Processing")
+        self.filter_intvar = {}
+        for row, c in enumerate([1, 2]):
+            self.filter_intvar[c] = tkinter.IntVar()
+            self.filter_intvar[c].set(getattr(config.processing, f"filter_cap{c}"))
+            tkinter.Checkbutton(tab2, text=f"Low-pass filter Cap {c}", variable=self.filter_intvar[c],
+                                command=lambda c=c: self.parent.model.set_filter_status(c, self.filter_intvar[c].get())
+                                ).grid(row=row, sticky=tkinter.W)
+        tab2.grid_rowconfigure("all", pad=10)
+
+        tab3 = ttk.Frame(tab_parent)
+        tab_parent.add(tab3, text="Plotting")
+        tkinter.Label(tab3, text="Plotting backend (applies on restart)", font=("Helvetica", 8),
+                      justify=tkinter.LEFT).grid(row=0, sticky=tkinter.W)
+        self.backend_strvar = tkinter.StringVar()
+        self.backend_strvar.set(config.plotting.backend)
+        for row, backend in enumerate(PLOT_BACKENDS, start=1):
+            tkinter.Radiobutton(tab3, text=backend, value=backend, variable=self.backend_strvar,
+                                command=lambda: setattr(config.plotting, "backend", self.backend_strvar.get())
+                                ).grid(row=row, sticky=tkinter.W)
+        tab3.grid_rowconfigure("all", pad=10)
+
         self.protocol("WM_DELETE_WINDOW", self.hide)
 
 
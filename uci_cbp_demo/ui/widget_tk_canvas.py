@@ -0,0 +1,165 @@
+#  MIT License
+#  Copyright (C) Michael Tao-Yi Lee (taoyil AT UCI EDU)
+
+import logging
+import time
+import tkinter
+
+import numpy as np
+
+from uci_cbp_demo.backend.bluetooth.constants import DISPLAY_WINDOW
+from uci_cbp_demo.config import config
+from uci_cbp_demo.ui.plot_model import PlotCanvasModel, PlotScheduler, Y_LABEL, Y_LIM
+
+logger = logging.getLogger("bp_demo")
+
+
+def nice_ticks(lo, hi, n=5):
+    """About n tick values on a 1-2-2.5-5 step between lo and hi"""
+    raw = (hi - lo) / n
+    magnitude = 10 ** np.floor(np.log10(raw))
+    step = magnitude * next(m for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    return np.arange(np.ceil(lo / step) * step, hi + step * 1e-6, step)
+
+
+class TkPlotCanvas(tkinter.Canvas):
+    """Stacked signal panels drawn as polylines on a plain Tk Canvas, without importing matplotlib
+
+    Each line is one canvas item created by make_axes; frames only move its coordinates in place. Frames, grids and
+    tick labels of a panel are redrawn only when its limits change, and rate labels every LABEL_INTERVAL seconds.
+    Samples are mapped to pixels with numpy, so a frame costs one coords() call per line.
+    """
+    PIXELS_LEFT = 70
+    PIXELS_DOWN = 50
+    PIXELS_RIGHT = 10
+    PIXELS_UP = 10
+    LABEL_INTERVAL = 0.5  # seconds
+    COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c"]  # the matplotlib backend's first three line colors
+    GRID = "#b0b0b0"
+    FONT = ("Helvetica", 9)
+
+    def __init__(self, parent, model: "PlotCanvasModel"):
+        tkinter.Canvas.__init__(self, parent, background="white", highlightthickness=0)
+        self.model = model
+        self.parent = parent
+
+        self.bind("<Configure>", self.on_resize)
+        self.timer = PlotScheduler(self, self.update_plot, target_fps=config.plotting.target_fps, pump=self.model.pump)
+        self.status_var = tkinter.StringVar()
+        self.signals = []
+        self.box = {}
+        self.xlim = {}
+        self.ylim = {}
+        self.fs = {}
+        self.line = {}
+        self.decimator = {}
+        self._label_time = 0
+        self.make_axes(["cap1", "cap2", "acc", "gyro", "mag"])
+        self.autoscale = tkinter.IntVar()
+        self.autoscale.set(config.plotting.autoscale_cap)
+        self.pack(side=tkinter.TOP, fill=tkinter.BOTH, expand=True, pady=0)
+
+    def on_resize(self, event):
+        logger.debug(f"resize_event: {event.width} {event.height}")
+        self.tight_layout()
+
+    def tight_layout(self):
+        """Split the canvas into one panel per signal, stacked without gaps, and redraw everything"""
+        width, height = max(self.winfo_width(), 1), max(self.winfo_height(), 1)
+        left, right = self.PIXELS_LEFT, max(width - self.PIXELS_RIGHT, self.PIXELS_LEFT + 1)
+        edges = np.linspace(self.PIXELS_UP, max(height - self.PIXELS_DOWN, self.PIXELS_UP + 1), len(self.signals) + 1)
+        self.box = {s: (left, edges[i], right, edges[i + 1]) for i, s in enumerate(self.signals)}
+        for decimators in self.decimator.values():
+            for decimator in decimators:
+                decimator.set_bucket(DISPLAY_WINDOW / (right - left))
+        with self.model.frame():
+            for s, (x0, y0, x1, y1) in self.box.items():
+                self.coords(self.fs[s], x0 + 6, y1 - 4)
+                self._draw_axes(s)
+                self._draw_lines(s)
+
+    def _keys(self, signal):
+        return [signal] if signal in self.line else [f"{signal}_{o}" for o in "xyz"]
+
+    def _draw_axes(self, signal):
+        """Frame, grid, ticks and legend of one panel; the lines and rate label stay on top"""
+        tag = f"axes_{signal}"
+        self.delete(tag)
+        x0, y0, x1, y1 = self.box[signal]
+        (lo, hi), (y_lo, y_hi) = self.xlim[signal], self.ylim[signal]
+        last = signal == self.signals[-1]
+        for t in np.arange(np.ceil(lo), hi + 1e-6):
+            x = x0 + (t - lo) * (x1 - x0) / (hi - lo)
+            self.create_line(x, y0, x, y1, fill=self.GRID, dash=(2, 2), tags=tag)
+            if last:
+                self.create_text(x, y1 + 4, text=f"{t:g}", anchor=tkinter.N, font=self.FONT, tags=tag)
+        for v in nice_ticks(y_lo, y_hi):
+            y = y1 - (v - y_lo) * (y1 - y0) / (y_hi - y_lo)
+            self.create_line(x0, y, x1, y, fill=self.GRID, dash=(2, 2), tags=tag)
+            self.create_text(x0 - 4, y, text=f"{v:g}", anchor=tkinter.E, font=self.FONT, tags=tag)
+        self.create_rectangle(x0, y0, x1, y1, outline="black", tags=tag)
+        self.create_text(12, (y0 + y1) / 2, text=Y_LABEL[signal], angle=90, font=self.FONT, tags=tag)
+        if last:
+            self.create_text((x0 + x1) / 2, y1 + 22, text="Time (s)", anchor=tkinter.N, font=self.FONT, tags=tag)
+        if signal not in self.line:
+            for i, o in enumerate("XYZ"):
+                self.create_text(x1 - 6 - 14 * (2 - i), y0 + 4, text=o, fill=self.COLORS[i], anchor=tkinter.NE,
+                                 font=self.FONT, tags=tag)
+        self.tag_lower(tag)
+
+    def _decimate(self, key):
+        return self.decimator[key][self.model.display_queue.index]()
+
+    def _draw_lines(self, signal):
+        x0, y0, x1, y1 = self.box[signal]
+        (lo, hi), (y_lo, y_hi) = self.xlim[signal], self.ylim[signal]
+        for key in self._keys(signal):
+            t, v = self._decimate(key)
+            # a canvas line has no notion of missing values, so gaps are bridged rather than broken
+            keep = (t >= lo) & ~np.isnan(v)
+            if np.count_nonzero(keep) < 2:
+                self.itemconfigure(self.line[key], state=tkinter.HIDDEN)
+                continue
+            x = x0 + (t[keep] - lo) * ((x1 - x0) / (hi - lo))
+            y = y1 - (np.clip(v[keep], y_lo, y_hi) - y_lo) * ((y1 - y0) / (y_hi - y_lo))
+            self.coords(self.line[key], np.column_stack([x, y]).ravel().tolist())
+            self.itemconfigure(self.line[key], state=tkinter.NORMAL)
+
+    def update_plot(self):
+        relabel = time.monotonic() - self._label_time >= self.LABEL_INTERVAL
+        if relabel:
+            self._label_time = time.monotonic()
+            self.status_var.set(f"{self.timer.status} | {self.model.lag}")
+        with self.model.frame():
+            for s in self.model.signals:
+                self._redraw_signal(s, relabel)
+
+    def _redraw_signal(self, signal, relabel=True):
+        queue = self.model.display_queue[signal]
+        text = self.model.label(signal) if relabel else None
+        if text is not None:
+            self.itemconfigure(self.fs[signal], text=text)
+        if len(queue) == 0:
+            logger.debug(f"{signal} time axis is empty?")
+            return
+        xlim = self.model.page_xlim(self.xlim[signal], queue.time[-1])
+        ylim = self.model.cap_ylim(signal, self.ylim[signal], self.autoscale.get() == 1) if "cap" in signal else None
+        if xlim is not None or ylim is not None:
+            self.xlim[signal] = self.xlim[signal] if xlim is None else xlim
+            self.ylim[signal] = self.ylim[signal] if ylim is None else ylim
+            self._draw_axes(signal)
+        self._draw_lines(signal)
+
+    def make_axes(self, signals):
+        self.delete(tkinter.ALL)
+        self.signals = list(signals)
+        self.xlim = {s: (0, DISPLAY_WINDOW) for s in signals}
+        self.ylim = {s: Y_LIM[s] for s in signals}
+        self.line = {s: self.create_line(0, 0, 0, 0, fill=self.COLORS[0], state=tkinter.HIDDEN)
+                     for s in signals if "cap" in s}
+        self.line.update({f"{s}_{o}": self.create_line(0, 0, 0, 0, fill=self.COLORS[i], state=tkinter.HIDDEN)
+                          for s in signals if "cap" not in s
+                          for i, o in enumerate("xyz")})
+        self.decimator = {key: self.model.decimators(key) for key in self.line}
+        self.fs = {s: self.create_text(0, 0, text="--- Hz", anchor=tkinter.SW, font=self.FONT) for s in signals}
+        self.tight_layout()